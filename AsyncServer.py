@@ -0,0 +1,195 @@
+import asyncio, socket, logging
+
+from ServerWorker import ServerWorker, RTSP_BUFFER_SIZE
+from RtspParser import RtspParser, InterleavedFrame, formatInterleaved
+from Interleaved import TCP_QUEUE_BYTES, limitSendBuffer
+from ServerStats import serverStats
+from SessionManager import sessionManager
+
+logger = logging.getLogger(__name__)
+
+class AsyncServerWorker(ServerWorker):
+	"""ServerWorker driven by an asyncio event loop instead of two threads per client.
+
+	RTSP goes over asyncio streams, RTP and RTCP over the server's shared
+	datagram transports, and frames are paced with loop timers.
+	"""
+
+	def __init__(self, clientInfo, serverInfo, server):
+		super().__init__(clientInfo, serverInfo)
+		self.server = server
+		self.loop = asyncio.get_running_loop()
+		self.timer = None
+		self.playing = False
+		self.playGen = 0
+
+	async def handle(self, reader, writer):
+		"""Process RTSP requests until the client disconnects."""
+		self.writer = writer
+		self.clientInfo['address'] = writer.get_extra_info('peername')[0]
+		sessionManager.register(self)
+		parser = RtspParser()
+		try:
+			while True:
+				data = await reader.read(RTSP_BUFFER_SIZE)
+				if not data:
+					break
+				sessionManager.touch(self)
+				for request in parser.feed(data):
+					if isinstance(request, InterleavedFrame):
+						self.receiveInterleaved(request)
+						continue
+					logger.debug("Request received:\n%s", request.startLine)
+					self.processRtspRequest(request)
+		except (ConnectionError, ValueError):
+			pass
+		finally:
+			self.closeSession()
+			writer.close()
+
+	def expire(self):
+		"""Closing the transport from the loop ends handle() with EOF."""
+		serverStats.incr('sessionsExpired')
+		self.loop.call_soon_threadsafe(self.writer.close)
+
+	def openRtp(self):
+		"""RTP goes out through the server's shared datagram transport; RTCP from the client is routed back here."""
+		if not self.interleaved:
+			self.server.rtcpSessions[self.rtcpAddress()] = self
+
+	def closeRtp(self):
+		if 'rtpPort' in self.clientInfo and self.server.rtcpSessions.get(self.rtcpAddress()) is self:
+			del self.server.rtcpSessions[self.rtcpAddress()]
+		if 'videoStream' in self.clientInfo:
+			self.clientInfo['videoStream'].close()
+
+	def startRtp(self):
+		self.clientInfo['videoStream'].startPrefetch()
+		self.playing = True
+		self.playGen += 1
+		self.starting = True
+		self.pacer.restart(self.loop.time())
+		self.scheduleFrame()
+
+	def stopRtp(self):
+		self.playing = False
+		if self.timer:
+			self.timer.cancel()
+			self.timer = None
+		if self.history:
+			self.history.clear()
+
+	def scheduleFrame(self):
+		"""Arm the timer for the next frame deadline."""
+		self.timer = self.loop.call_at(self.pacer.deadline(), self.tick)
+
+	def tick(self):
+		self.timer = None
+		gen = self.playGen
+		# The first frame is accounted for once it is ready, see frameReady
+		skipped = 0 if self.starting else self.pacer.tick(self.loop.time())
+		if self.clientInfo['videoStream'].store:
+			# Pre-encoded frames are a slice of the mapping, cheap enough for the loop
+			self.frameReady(self.fetchFrame(skipped), gen)
+		else:
+			future = self.loop.run_in_executor(None, self.fetchFrame, skipped)
+			future.add_done_callback(lambda f: self.frameReady(None if f.exception() else f.result(), gen))
+
+	def frameReady(self, data, gen):
+		# Drop frames that finish decoding after PAUSE, TEARDOWN or a new PLAY
+		if not self.playing or gen != self.playGen:
+			return
+		if self.starting:
+			# The schedule starts with the first frame that is ready, not with its encode
+			self.starting = False
+			self.pacer.restart(self.loop.time())
+			self.pacer.tick(self.loop.time())
+		if data:
+			self.sendFrame(data)
+		self.scheduleFrame()
+
+	def sendPacket(self, packet):
+		try:
+			# Scatter/gather straight from the frame buffer; the transport would copy it
+			self.server.rtpSocket.sendmsg(packet, [], 0, self.rtpAddress())
+		except BlockingIOError:
+			# A full socket buffer drops the packet, as the network would
+			pass
+
+	def rtpAddress(self):
+		return (self.clientInfo['address'], int(self.clientInfo['rtpPort']))
+
+	def sendRtcp(self, data):
+		if self.interleaved:
+			self.writeInterleaved(formatInterleaved(self.interleaved[1], data))
+			return
+		self.server.rtcpTransport.sendto(data, self.rtcpAddress())
+
+	def startInterleaved(self):
+		"""The stream writer already buffers without blocking the loop; only the kernel buffer needs bounding."""
+		sock = self.writer.get_extra_info('socket')
+		if sock is not None:
+			limitSendBuffer(sock)
+
+	def stopInterleaved(self):
+		"""Replies and frames share the stream writer's buffer, in order, either way."""
+		pass
+
+	def interleavedRoom(self, size):
+		return self.writer.transport.get_write_buffer_size() + size <= TCP_QUEUE_BYTES
+
+	def writeInterleaved(self, data):
+		if not self.interleavedRoom(len(data)):
+			return False
+		self.writer.write(data)
+		return True
+
+	def receiveRtcp(self):
+		"""Receiver reports are delivered by the server's RTCP protocol."""
+		pass
+
+	def sendRtspReply(self, reply):
+		self.writer.write(reply)
+
+class RtcpProtocol(asyncio.DatagramProtocol):
+	"""Hand incoming RTCP packets to the session streaming to their source address."""
+
+	def __init__(self, sessions):
+		self.sessions = sessions
+
+	def datagram_received(self, data, addr):
+		worker = self.sessions.get(addr[:2])
+		if worker:
+			worker.processRtcp(data)
+
+class AsyncServer:
+	"""Single event loop serving every RTSP session and its RTP stream."""
+
+	def __init__(self, serverInfo, port, reusePort=False):
+		self.serverInfo = serverInfo
+		self.port = port
+		self.reusePort = reusePort
+		self.rtpTransport = None
+		self.rtpSocket = None
+		self.rtcpTransport = None
+		# (client address, client RTCP port) -> worker
+		self.rtcpSessions = {}
+
+	async def serve(self):
+		loop = asyncio.get_running_loop()
+		self.rtpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.rtpSocket.bind(('0.0.0.0', 0))
+		self.rtpTransport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, sock=self.rtpSocket)
+		self.rtcpTransport, _ = await loop.create_datagram_endpoint(lambda: RtcpProtocol(self.rtcpSessions),
+			local_addr=('0.0.0.0', 0))
+		server = await asyncio.start_server(self.handleClient, '', self.port, reuse_port=self.reusePort or None)
+		async with server:
+			await server.serve_forever()
+
+	async def handleClient(self, reader, writer):
+		clientInfo = {}
+		clientInfo['rtspPort'] = self.port
+		await AsyncServerWorker(clientInfo, self.serverInfo, self).handle(reader, writer)
+
+	def run(self):
+		asyncio.run(self.serve())
@@ -0,0 +1,246 @@
+import socket, threading, time, ipaddress, logging
+from random import randint
+
+from ServerWorker import ServerWorker, RTCP_INTERVAL
+from VideoStream import VideoStream
+from RtpPacket import JpegPacketizer, CLOCK_RATE
+from Pacer import Pacer
+from SendLoop import sendLoop
+from ServerStats import serverStats, stageTimings
+import RtcpPacket
+
+logger = logging.getLogger(__name__)
+
+MULTICAST_PORT = 5004
+MULTICAST_TTL = 1
+
+class Channel:
+	"""One title played live: paced and encoded once, whatever the number of viewers.
+
+	The channel clock starts with the channel and keeps running while nobody
+	watches, so a viewer joining with PLAY gets the frame on air now, and the
+	title loops at its end. Frames go to the channel's multicast group, or
+	through the send loop to every unicast subscriber in one batch that
+	shares the payload. Frame numbers count channel frames, so they keep
+	growing across loops of the title.
+	"""
+
+	def __init__(self, filename, meta, destination=None):
+		self.filename = filename
+		self.meta = meta
+		self.fps = meta['fps'] if meta else 25
+		self.frameCnt = meta['frames'] if meta else 0
+		# (group, port) of the multicast channel, None to send to each subscriber
+		self.destination = destination
+		self.epoch = time.monotonic()
+		self.ssrc = randint(1, 0xFFFFFFFF)
+		self.packetizer = JpegPacketizer(randint(0, 0xFFFF), self.ssrc)
+		self.pacer = Pacer(self.fps)
+		self.timestampBase = randint(0, 0xFFFFFFFF)
+		self.lastTimestamp = self.timestampBase
+		# Serializes joins and leaves, which start and stop the channel
+		self.lock = threading.Lock()
+		# worker -> (RTP address, RTCP address)
+		self.subscribers = {}
+		self.videoStream = None
+		self.rtcpSocket = None
+		# Channel frame at which the pacer was last restarted
+		self.startFrame = 0
+		self.framesSent = 0
+		self.packetsSent = 0
+		self.octetsSent = 0
+		self.queuedBytes = 0
+		self.lastSenderReport = 0
+
+	def position(self, now=None):
+		"""Return the channel frame on air at `now`."""
+		if now is None:
+			now = time.monotonic()
+		return int((now - self.epoch) * self.fps)
+
+	def transport(self, worker):
+		"""Return the Transport header telling a subscriber where the RTP comes from."""
+		if self.destination:
+			group, port = self.destination
+			return "RTP/AVP;multicast;destination={};port={}-{};ttl={}".format(group, port, port + 1, channels.ttl)
+		port = int(worker.clientInfo['rtpPort'])
+		return "RTP/AVP;unicast;client_port={}-{}".format(port, port + 1)
+
+	def subscribe(self, worker):
+		with self.lock:
+			self.subscribers[worker] = (worker.rtpAddress(), worker.rtcpAddress())
+			if len(self.subscribers) == 1:
+				self.start()
+
+	def unsubscribe(self, worker):
+		with self.lock:
+			if self.subscribers.pop(worker, None) and not self.subscribers:
+				self.stop()
+
+	def start(self):
+		"""Start sending at the current position; the first viewer of an idle channel starts its decoder."""
+		self.videoStream = VideoStream(self.filename, self.meta)
+		self.rtcpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.rtcpSocket.bind(('', 0))
+		self.rtcpSocket.setblocking(False)
+		self.startFrame = self.position()
+		self.pacer.restart(self.epoch + self.startFrame / self.fps)
+		sendLoop.add(self, self.pacer.deadline())
+		logger.info("channel %s on air at frame %d", self.filename, self.startFrame)
+
+	def stop(self):
+		"""The last viewer left: stop sending and decoding; the channel clock runs on."""
+		sendLoop.remove(self)
+		self.videoStream.close()
+		self.videoStream = None
+		self.rtcpSocket.close()
+		self.rtcpSocket = None
+		logger.info("channel %s off air", self.filename)
+
+	def queueFrame(self, batch, now):
+		"""Called by the send loop: queue the frame on air for the group or for every subscriber."""
+		skipped = self.pacer.behind(now)
+		frame = self.startFrame + self.pacer.count + skipped
+		index = frame % self.frameCnt if self.frameCnt else frame
+		start = time.perf_counter()
+		data = self.videoStream.peekFrame(index)
+		stageTimings.record('fetch', time.perf_counter() - start)
+		if data is None:
+			return None
+		self.pacer.tick(now)
+		if skipped:
+			serverStats.incr('deadlineMisses')
+			serverStats.incr('framesSkipped', skipped)
+		if not data:
+			return 0
+
+		start = time.perf_counter()
+		timestamp = (self.timestampBase + round(frame * CLOCK_RATE / self.fps)) & 0xFFFFFFFF
+		self.lastTimestamp = timestamp
+		self.framesSent += 1
+		# Built once; every destination gets the same headers and fragments
+		packets = [(bytes(header), fragment) for header, fragment in
+			self.packetizer.packets(data, self.framesSent, frame + 1, timestamp)]
+		if self.destination:
+			destinations = [self.destination]
+		else:
+			destinations = [rtp for rtp, rtcp in list(self.subscribers.values())]
+		queued = 0
+		for address in destinations:
+			queued += batch.addFrame(packets, data, address)
+		stageTimings.record('packetize', time.perf_counter() - start)
+		self.packetsSent += len(packets)
+		self.octetsSent += len(data)
+		self.queuedBytes = queued
+		return queued
+
+	def frameSent(self, seconds):
+		stageTimings.record('send', seconds)
+		serverStats.incr('framesSent')
+		serverStats.incr('bytesSent', self.queuedBytes)
+		self.serviceRtcp()
+
+	def serviceRtcp(self):
+		"""Send each subscriber a sender report when one is due.
+
+		Receiver reports are read and dropped: every viewer shares the one
+		encoding, so the channel does not adapt to any of them.
+		"""
+		now = time.monotonic()
+		if now - self.lastSenderReport >= RTCP_INTERVAL:
+			self.lastSenderReport = now
+			report = RtcpPacket.makeSenderReport(self.ssrc, self.lastTimestamp, self.packetsSent, self.octetsSent)
+			for rtp, rtcp in list(self.subscribers.values()):
+				try:
+					self.rtcpSocket.sendto(report, rtcp)
+				except OSError:
+					pass
+		while True:
+			try:
+				self.rtcpSocket.recv(2048)
+			except OSError:
+				break
+
+	def stats(self):
+		stats = {
+			'subscribers': len(self.subscribers),
+			'position': self.position(),
+			'framesSent': self.framesSent,
+			'packetsSent': self.packetsSent,
+			'octetsSent': self.octetsSent,
+		}
+		stats.update(self.pacer.stats())
+		return stats
+
+class ChannelRegistry:
+	"""The live channels of this process, one per title, created on first use."""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.channels = {}
+		self.group = None
+		self.port = MULTICAST_PORT
+		self.ttl = MULTICAST_TTL
+
+	def configure(self, group=None, port=MULTICAST_PORT, ttl=MULTICAST_TTL, interface=None):
+		"""Send channels to multicast groups from `group` upwards, one per title, or to each viewer if group is None."""
+		self.group = ipaddress.IPv4Address(group) if group else None
+		self.port = port
+		self.ttl = ttl
+		if self.group:
+			sock = sendLoop.rtpSocket()
+			sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+			if interface:
+				sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+
+	def channel(self, filename, meta):
+		with self.lock:
+			channel = self.channels.get(filename)
+			if channel is None:
+				destination = (str(self.group + len(self.channels)), self.port) if self.group else None
+				channel = self.channels[filename] = Channel(filename, meta, destination)
+				serverStats.registerChannel(filename, channel)
+			return channel
+
+class BroadcastWorker(ServerWorker):
+	"""ServerWorker whose PLAY joins the live channel of its title instead of starting a stream of its own.
+
+	Seeking is not possible on a channel: the Frame header of PLAY is
+	ignored, and PAUSE followed by PLAY rejoins at the live position.
+	"""
+
+	# A channel's packets are shared by every viewer, so none gets parity or retransmissions of its own
+	fecGroup = 0
+	retransmitDeadline = 0
+	# Channels are sent over UDP only
+	tcpTransport = False
+
+	def __init__(self, clientInfo, serverInfo):
+		super().__init__(clientInfo, serverInfo)
+		self.channel = None
+
+	def currentChannel(self):
+		filename = self.clientInfo['videoStream'].filename
+		return channels.channel(filename, self.serverInfo.get(filename))
+
+	def openRtp(self):
+		"""Nothing to open: the channel sends the sender reports and reads the receiver reports on its own socket."""
+		pass
+
+	def startRtp(self):
+		self.channel = self.currentChannel()
+		self.channel.subscribe(self)
+
+	def stopRtp(self):
+		if self.channel:
+			self.channel.unsubscribe(self)
+			self.channel = None
+
+	def streamHeaders(self):
+		"""A channel is live: no frame count, and the Transport says where to listen."""
+		channel = self.currentChannel()
+		return [('Session', self.sessionHeader()), ('Frames', 0), ('Fps', round(channel.fps)),
+			('Transport', channel.transport(self))]
+
+# Live channels of the current process, used when the server runs with --broadcast
+channels = ChannelRegistry()
@@ -1,12 +1,24 @@
 from tkinter import *
 import tkinter.messagebox as tkMessageBox
 from PIL import Image, ImageTk
-import socket, threading, sys, traceback, os, time
-
-from RtpPacket import RtpPacket
-
-CACHE_FILE_NAME = "cache-"
-CACHE_FILE_EXT = ".jpg"
+import socket, struct, threading, sys, traceback, time, io, random
+from collections import deque
+
+from RtpPacket import RtpPacket, FrameAssembler, RTP_HEADER
+from JitterBuffer import JitterBuffer
+import RtcpPacket
+from RtspParser import RtspParser, InterleavedFrame, formatMessage, formatInterleaved, parseTransport, parseInterleaved
+from Fec import FecDecoder
+
+# Seconds of decoded frames kept for instant local replay; 0 disables the replay buffer
+REPLAY_SECONDS = 3
+RTP_BUFFER_SIZE = 65536
+RTSP_BUFFER_SIZE = 4096
+RTP_SOCKET_BUFFER = 1024 * 1024
+# Decoded frames waiting for the Tk main loop
+DECODED_QUEUE_SIZE = 3
+# Milliseconds between receiver reports sent to the server while playing
+REPORT_INTERVAL = 2000
 
 class Client:
     INIT = 0
@@ -22,8 +34,10 @@ class Client:
     TEARDOWN = 4
     SWITCH = 5
     GET_LIST = 6
+    REPORT = 7
+    GET_PARAMETER = 8
 
-    def __init__(self, master, serveraddr, serverport, rtpport, filename):
+    def __init__(self, master, serveraddr, serverport, rtpport, filename, replaySeconds=REPLAY_SECONDS, fecGroup=0, transport='udp'):
         
         # Create GUI
         self.master = master
@@ -43,9 +57,55 @@ class Client:
 
         self.rtspSeq = 0
         self.sessionId = 0
+        # Seconds of silence after which the server closes the session, from the SETUP reply; 0 if it never does
+        self.sessionTimeout = 0
+        self.lastRequest = 0
         self.requestSent = -1
+        self.pendingRequests = {}
         self.frameNumber = 0
         self.requestedFrame = -1
+        self.frameAssembler = FrameAssembler()
+        # Parity group size asked for at SETUP, 0 for none; the decoder exists once the server agreed
+        self.fecGroup = fecGroup
+        self.fecDecoder = None
+        # 'tcp' takes RTP interleaved on the RTSP connection, for networks that drop the UDP ports
+        self.transport = transport
+        self.interleaved = None
+        # Requests, RTCP and interleaved packets share the RTSP connection
+        self.rtspLock = threading.Lock()
+
+        # Frames per second
+        self.fps = 0
+
+        # Receive thread -> jitter buffer -> decode thread -> decoded queue -> Tk render step
+        self.jitterBuffer = JitterBuffer()
+        self.decodedFrames = deque()
+        self.renderDropped = 0
+        self.totalFrames = 0
+
+        # Receiver report state: RFC 3550 interarrival jitter in 90 kHz units, last reported totals
+        self.jitter = 0.0
+        self.lastTransit = None
+        self.reportedFrames = 0
+        self.reportedReceived = 0
+
+        # RTCP receiver state: packet-level loss, and when the last sender report arrived
+        self.ssrc = random.randint(1, 0xFFFFFFFF)
+        self.receptionStats = RtcpPacket.ReceptionStats()
+        self.lastSenderReport = 0
+        self.lastSenderReportTime = None
+        # Sequence gaps to NACK, sent to where the sender reports come from
+        self.missingPackets = RtcpPacket.MissingPackets()
+        self.senderRtcpAddr = None
+        # Frame count of the first packet: live channels count frames from their own start
+        self.frameCntBase = None
+        # (group, port) of the live channel being received, if it is multicast
+        self.multicastGroup = None
+
+        # Most recently shown frames, for local replay without the server or the disk
+        self.replaySeconds = replaySeconds
+        self.replayBuffer = deque()
+        self.replayQueue = deque()
 
         # Conect to server
         self.connectToServer()
@@ -53,14 +113,15 @@ class Client:
         # Setup video and open rtp port
         self.setupVideo()
 
-        # Frames per second
-        self.fps = 0
-
         # Statistic
         self.startTime = 0
         self.receivedBytes = 0
         self.totalReceivedFrames = 0
 
+        threading.Thread(target=self.decodeFrames, daemon=True).start()
+        self.renderFrame()
+        self.master.after(REPORT_INTERVAL, self.sendReport)
+
 
     def createWidgets(self):
         """Build GUI."""
@@ -126,6 +187,12 @@ class Client:
         self.lossRateLabel.grid(row=4, column=0, columnspan=4, padx=2, pady=2)
         self.setLossRate(0, 0)
 
+        ## jitter buffer: depth, late and dropped frames
+        self.bufferStats = StringVar()
+        self.bufferStatsLabel = Label(self.master, textvariable=self.bufferStats)
+        self.bufferStatsLabel.grid(row=5, column=0, columnspan=4, padx=2, pady=2)
+        self.setBufferStats(0, 0, 0)
+
         # Menu listbox
         self.listMenu = Listbox(self.master, height=35, width=40, bg='#EBECF0', highlightcolor='#D3D3D3', selectmode=SINGLE)
         self.listMenu.grid(row=0, column=4, padx=5, pady=5)
@@ -135,6 +202,12 @@ class Client:
         self.switch['text'] = "SWITCH"
         self.switch['command'] = self.switchVideo
         self.switch.grid(row=1, column=4, padx=2, pady=2)
+
+        # Create replay button
+        self.replay = Button(self.master, width=20, padx=3, pady=3)
+        self.replay['text'] = "REPLAY"
+        self.replay['command'] = self.replayVideo
+        self.replay.grid(row=2, column=4, padx=2, pady=2)
     
 
     def setListMenu(self, lst):
@@ -145,8 +218,9 @@ class Client:
     def setupVideo(self):
         """Setup button handler."""
         if self.state == self.INIT:
-            self.sendRtspRequest(self.SETUP)
+            # Open the port first: the reply may name a multicast group to listen on instead
             self.openRtpPort()
+            self.sendRtspRequest(self.SETUP)
             self.setupFlag.clear()
 
 
@@ -156,6 +230,7 @@ class Client:
         self.clearFrame()
         self.master.destroy()
         self.rtpSocket.close()
+        self.rtcpSocket.close()
     
     
     def describeVideo(self):
@@ -171,6 +246,7 @@ class Client:
     def playVideo(self):
         """Play button handler."""
         if self.state == self.READY:
+            self.replayQueue.clear()
             self.playEvent.clear()
             self.sendRtspRequest(self.PLAY)
             self.startTime = time.time()
@@ -181,6 +257,7 @@ class Client:
             self.sendRtspRequest(self.PAUSE)
             self.playEvent.wait()
             self.requestedFrame = self.frameNumber + self.fps * 5
+            self.resetPipeline(self.requestedFrame)
             self.sendRtspRequest(self.PLAY)
     
 
@@ -192,6 +269,7 @@ class Client:
             self.requestedFrame = self.frameNumber
             if self.requestedFrame < 0:
                 self.requestedFrame = 0
+            self.resetPipeline(self.requestedFrame)
             self.sendRtspRequest(self.PLAY)
     
 
@@ -202,6 +280,9 @@ class Client:
             self.sendRtspRequest(self.TEARDOWN)
             self.setupFlag.wait()
             self.clearFrame()
+            self.resetPipeline()
+            self.receptionStats = RtcpPacket.ReceptionStats()
+            self.missingPackets = RtcpPacket.MissingPackets()
             self.resetVideoRate()
             self.resetLossRate()
             self.setCurrentTime(0)
@@ -215,68 +296,206 @@ class Client:
     
 
     def switchVideo(self):
-        self.filename = str(self.listMenu.get(ACTIVE))
-        if len(self.filename) > 0:
-            self.pauseVideo()
-            if tkMessageBox.askokcancel("Switch?", "Do you want to switch?"):
-                self.sendRtspRequest(self.SWITCH)
-                self.setupFlag.wait()
-                self.clearFrame()
-                self.resetVideoRate()
-                self.resetLossRate()
-                self.setCurrentTime(0)
-                self.rtspSeq = 0
-                self.sessionId = 0
-                self.frameNumber = 0
-                self.sendRtspRequest(self.SETUP)
-                self.setupFlag.clear()
-            else:
-                self.playVideo()
+        """Switch button handler: change the title in one request, keeping the session and playback."""
+        filename = str(self.listMenu.get(ACTIVE))
+        if len(filename) > 0 and not self.state == self.INIT:
+            self.filename = filename
+            self.sendRtspRequest(self.SWITCH)
     
 
     def listenRtp(self):
         """Listen for RTP packets."""
         while True:
             try:
-                data = self.rtpSocket.recv(40960)
+                data = self.rtpSocket.recv(RTP_BUFFER_SIZE)
                 if data:
-                    rtpPacket = RtpPacket()
-                    rtpPacket.decode(data)
-                    currFrameNumber = rtpPacket.seqNum()
-
-                    if currFrameNumber > self.frameNumber:
-                        self.frameNumber = currFrameNumber
-                        self.updateVideo(self.writeFrame(rtpPacket.getPayload()))
-
-                        currentTime = self.frameNumber // self.fps
-                        self.setCurrentTime(currentTime)
-
-                        self.receivedBytes += len(rtpPacket.getPacket())
-                        self.setVideoRate(time.time() - self.startTime, self.receivedBytes)
-
-                        totalFrames = rtpPacket.getFrameCnt()
-                        self.totalReceivedFrames += 1
-                        self.setLossRate(totalFrames, self.totalReceivedFrames)
+                    self.receiveRtp(data)
             except:
                 if self.playEvent.isSet():
                     self.resetVideoRate()
                     break
     
 
-    def writeFrame(self, data):
-        """Write the received frame to a temp image file. Return the image file."""
-        cachename = CACHE_FILE_NAME + str(self.sessionId) + CACHE_FILE_EXT
-        file = open(cachename, 'wb')
-        file.write(data)
-        file.close()
-        return cachename
+    def receiveRtp(self, data):
+        """Handle one RTP packet, from the RTP socket or interleaved on the RTSP connection."""
+        self.receivedBytes += len(data)
+        # Parity packets yield the media packet they repair, if any
+        fecDecoder = self.fecDecoder
+        for datagram in fecDecoder.push(data) if fecDecoder else (data,):
+            rtpPacket = RtpPacket()
+            rtpPacket.decode(datagram)
+            # RTCP reports the loss on the wire, before repair
+            if datagram is data:
+                self.receptionStats.update(rtpPacket.seqNum())
+            self.missingPackets.update(rtpPacket.seqNum(), recovered=datagram is not data)
+            self.receivePacket(rtpPacket)
+        # TCP loses nothing worth a NACK
+        if not self.interleaved:
+            self.sendNack(RTP_HEADER.unpack_from(data, 0)[4])
     
 
-    def updateVideo(self, imageFile):
-        """Update the image file as video frame in the GUI."""
-        img = Image.open(imageFile)
+    def sendNack(self, mediaSsrc):
+        """Ask the server to resend the packets missing from the stream that can still be played in time."""
+        # Live multicast channels are shared, nobody resends for a single viewer
+        if self.senderRtcpAddr is None or self.multicastGroup:
+            return
+        seqnums = self.missingPackets.due()
+        if seqnums:
+            self.sendRtcp(RtcpPacket.makeNack(self.ssrc, mediaSsrc, seqnums))
+    
+
+    def sendRtcp(self, data):
+        """Send an RTCP packet to the server: interleaved on the RTSP connection, or to where its reports come from."""
+        try:
+            if self.interleaved:
+                with self.rtspLock:
+                    self.rtspSocket.sendall(formatInterleaved(self.interleaved[1], data))
+            elif self.senderRtcpAddr:
+                self.rtcpSocket.sendto(data, self.senderRtcpAddr)
+        except OSError:
+            pass
+    
+
+    def receivePacket(self, rtpPacket):
+        """Reassemble a media packet into its frame and buffer the frame once complete."""
+        # Frames arrive as MTU-sized fragments; wait for the last one
+        frame = self.frameAssembler.push(rtpPacket)
+        if frame is None:
+            return
+        self.updateJitter(rtpPacket.timestamp())
+        self.jitterBuffer.push(rtpPacket.getFrameNbr(), frame)
+        if self.frameCntBase is None:
+            self.frameCntBase = rtpPacket.getFrameCnt() - 1
+        self.totalFrames = rtpPacket.getFrameCnt() - self.frameCntBase
+        self.totalReceivedFrames += 1
+    
+
+    def listenRtcp(self):
+        """Answer each RTCP sender report with a receiver report, so the server can measure loss, jitter and RTT."""
+        while not self.exitFlag.isSet():
+            try:
+                data, addr = self.rtcpSocket.recvfrom(2048)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            self.senderRtcpAddr = addr
+            self.receiveRtcp(data)
+
+
+    def receiveRtcp(self, data):
+        """Answer the sender reports in an RTCP packet from the server."""
+        for report in RtcpPacket.parse(data):
+            if report['type'] != RtcpPacket.SR:
+                continue
+            self.lastSenderReport = RtcpPacket.ntpMiddle(*report['ntp'])
+            self.lastSenderReportTime = time.time()
+            stats = self.receptionStats
+            dlsr = int((time.time() - self.lastSenderReportTime) * 65536)
+            self.sendRtcp(RtcpPacket.makeReceiverReport(self.ssrc, report['ssrc'], stats.fractionLost(),
+                stats.cumulativeLost(), stats.extendedMax(), self.jitter, self.lastSenderReport, dlsr))
+
+
+    def updateJitter(self, timestamp):
+        """Update the interarrival jitter estimate with a frame's RTP timestamp (RFC 3550, A.8)."""
+        transit = int(time.time() * 90000) - timestamp
+        if self.lastTransit is not None:
+            d = abs(transit - self.lastTransit)
+            self.jitter += (d - self.jitter) / 16
+        self.lastTransit = transit
+
+
+    def sendReport(self):
+        """Report loss and jitter since the last report so the server can adapt the rendition."""
+        if self.exitFlag.isSet():
+            return
+        if self.state == self.PLAYING:
+            expected = self.totalFrames - self.reportedFrames
+            received = self.totalReceivedFrames - self.reportedReceived
+            self.reportLoss = max(0.0, 1 - received / expected) if expected > 0 else 0.0
+            self.reportJitter = self.jitter / 90
+            self.reportedFrames = self.totalFrames
+            self.reportedReceived = self.totalReceivedFrames
+            self.sendRtspRequest(self.REPORT)
+        elif self.state == self.READY and self.sessionTimeout and time.monotonic() - self.lastRequest > self.sessionTimeout / 2:
+            # Paused sessions send neither reports nor RTCP: keep them from being expired
+            self.sendRtspRequest(self.GET_PARAMETER)
+        self.master.after(REPORT_INTERVAL, self.sendReport)
+
+
+    def decodeFrames(self):
+        """Decode and resize frames from the jitter buffer, off the receive thread."""
+        while not self.exitFlag.isSet():
+            item = self.jitterBuffer.pop(0.5)
+            if item is None:
+                continue
+            frameNbr, data = item
+            try:
+                image = self.decodeFrame(data)
+            except:
+                continue
+            # Keep the queue short so the picture stays close to live
+            if len(self.decodedFrames) >= DECODED_QUEUE_SIZE:
+                self.decodedFrames.popleft()
+                self.renderDropped += 1
+            self.decodedFrames.append((frameNbr, image))
+
+
+    def renderFrame(self):
+        """Show the next decoded frame. Runs on the Tk main loop at the advertised frame rate."""
+        if self.exitFlag.isSet():
+            return
+        if self.replayQueue and self.fps:
+            frameNbr, image = self.replayQueue.popleft()
+            self.updateVideo(image)
+            self.setCurrentTime(frameNbr // self.fps)
+        elif self.state == self.PLAYING and self.decodedFrames and self.fps:
+            frameNbr, image = self.decodedFrames.popleft()
+            self.frameNumber = frameNbr
+            self.updateVideo(image)
+            self.keepForReplay(frameNbr, image)
+            self.setCurrentTime(self.frameNumber // self.fps)
+            self.setVideoRate(time.time() - self.startTime, self.receivedBytes)
+            self.setLossRate(self.totalFrames, self.totalReceivedFrames)
+        self.setBufferStats(self.jitterBuffer.depth(), self.jitterBuffer.late,
+            self.jitterBuffer.dropped + self.renderDropped)
+        interval = 1000 // self.fps if self.fps else 40
+        self.master.after(interval, self.renderFrame)
+
+
+    def keepForReplay(self, frameNbr, image):
+        """Remember a shown frame in the replay ring buffer."""
+        size = self.replaySeconds * self.fps
+        if self.replayBuffer.maxlen != size:
+            self.replayBuffer = deque(self.replayBuffer, maxlen=size)
+        if size:
+            self.replayBuffer.append((frameNbr, image))
+
+
+    def replayVideo(self):
+        """Replay button handler: pause and show the last seconds again from memory."""
+        if self.replayBuffer:
+            self.pauseVideo()
+            self.replayQueue = deque(self.replayBuffer)
+
+
+    def resetPipeline(self, lastFrame=0):
+        """Drop buffered and decoded frames, e.g. after a seek."""
+        self.frameAssembler.reset()
+        self.jitterBuffer.reset(lastFrame)
+        self.decodedFrames.clear()
+    
+
+    def decodeFrame(self, data):
+        """Decode the received JPEG straight from memory and scale it to the display height."""
+        img = Image.open(io.BytesIO(data))
         photoWidth = int(img.size[0]/img.size[1]*500)
-        photo = ImageTk.PhotoImage(img.resize((photoWidth,500), Image.ANTIALIAS))
+        return img.resize((photoWidth,500), Image.LANCZOS)
+
+
+    def updateVideo(self, image):
+        """Update the decoded image as video frame in the GUI."""
+        photo = ImageTk.PhotoImage(image)
         self.label.configure(image=photo, height=500)
         self.label.image = photo
     
@@ -299,50 +518,91 @@ class Client:
         """Send RTSP request to the server."""
         if requestCode == self.SETUP and (self.state == self.INIT or self.state == self.SWITCHING):
             self.rtspSeq += 1
-            request = "SETUP {} RTSP/1.0\nCSeq: {}\nTransport: RTP/UDP; client_port= {}".format(self.filename, str(self.rtspSeq), str(self.rtpPort))
+            startLine = "SETUP {} RTSP/1.0".format(self.filename)
+            if self.transport == 'tcp':
+                headers = [("CSeq", self.rtspSeq), ("Transport", "RTP/AVP/TCP;interleaved=0-1")]
+            else:
+                headers = [("CSeq", self.rtspSeq), ("Transport", "RTP/UDP; client_port= {}".format(self.rtpPort))]
+            if self.fecGroup and self.transport != 'tcp':
+                headers.append(("FEC", "group={}".format(self.fecGroup)))
             self.requestSent = self.SETUP
         elif requestCode == self.DESCRIBE:
             self.rtspSeq += 1
-            request = "DESCRIBE {} RTSP/1.0\ncSeq: {}\nSession: {}".format(self.filename, str(self.rtspSeq), str(self.sessionId))
+            startLine = "DESCRIBE {} RTSP/1.0".format(self.filename)
+            headers = [("CSeq", self.rtspSeq), ("Session", self.sessionId)]
             self.requestSent = self.DESCRIBE
         elif requestCode == self.PLAY:
-            threading.Thread(target=self.listenRtp).start()
+            if not self.interleaved:
+                threading.Thread(target=self.listenRtp).start()
             self.rtspSeq += 1
-            request = "PLAY {} RTSP/1.0\ncSeq: {}\nSession: {}\nFrame: {}".format(self.filename, str(self.rtspSeq), str(self.sessionId), self.requestedFrame)
+            startLine = "PLAY {} RTSP/1.0".format(self.filename)
+            headers = [("CSeq", self.rtspSeq), ("Session", self.sessionId), ("Frame", self.requestedFrame)]
             self.requestedFrame = -1
             self.requestSent = self.PLAY
         elif requestCode == self.PAUSE and self.state == self.PLAYING:
             self.rtspSeq += 1
-            request = "PAUSE {} RTSP/1.0\ncSeq: {}\nSession: {}".format(self.filename, str(self.rtspSeq), str(self.sessionId))
+            startLine = "PAUSE {} RTSP/1.0".format(self.filename)
+            headers = [("CSeq", self.rtspSeq), ("Session", self.sessionId)]
             self.requestSent = self.PAUSE
         elif requestCode == self.TEARDOWN and not self.state == self.INIT:
             self.rtspSeq += 1
-            request = "TEARDOWN {} RTSP/1.0\ncSeq: {}\nSession: {}".format(self.filename, str(self.rtspSeq), str(self.sessionId))
+            startLine = "TEARDOWN {} RTSP/1.0".format(self.filename)
+            headers = [("CSeq", self.rtspSeq), ("Session", self.sessionId)]
             self.requestSent = self.TEARDOWN
         elif requestCode == self.SWITCH and not self.state == self.INIT:
             self.rtspSeq += 1
-            request = "SWITCH {} RTSP/1.0\ncSeq: {}\nSession: {}".format(self.filename, str(self.rtspSeq), str(self.sessionId))
+            startLine = "SWITCH {} RTSP/1.0".format(self.filename)
+            headers = [("CSeq", self.rtspSeq), ("Session", self.sessionId)]
             self.requestSent = self.SWITCH
         elif requestCode == self.GET_LIST:
             self.rtspSeq += 1
-            request = "GET_LIST RTSP/1.0\ncSeq: {}".format(str(self.rtspSeq))
+            startLine = "GET_LIST * RTSP/1.0"
+            headers = [("CSeq", self.rtspSeq)]
             self.requestSent = self.GET_LIST
+        elif requestCode == self.REPORT and self.state == self.PLAYING:
+            self.rtspSeq += 1
+            startLine = "REPORT {} RTSP/1.0".format(self.filename)
+            headers = [("CSeq", self.rtspSeq), ("Session", self.sessionId),
+                ("Loss", "{:.4f}".format(self.reportLoss)), ("Jitter", "{:.2f}".format(self.reportJitter))]
+            if self.fecDecoder:
+                headers += [("Recovered", self.fecDecoder.recovered), ("Unrecovered", self.fecDecoder.unrecoverable)]
+            self.requestSent = self.REPORT
+        elif requestCode == self.GET_PARAMETER and not self.state == self.INIT:
+            self.rtspSeq += 1
+            startLine = "GET_PARAMETER {} RTSP/1.0".format(self.filename)
+            headers = [("CSeq", self.rtspSeq), ("Session", self.sessionId)]
+            self.requestSent = self.GET_PARAMETER
         else:
             return
-        self.rtspSocket.sendall(request.encode())
-        print('\nData sent:\n' + request)
+        # Replies are matched by CSeq, so requests can be in flight back to back
+        self.pendingRequests[self.rtspSeq] = requestCode
+        request = formatMessage(startLine, headers)
+        with self.rtspLock:
+            self.rtspSocket.sendall(request)
+        self.lastRequest = time.monotonic()
+        print('\nData sent:\n' + request.decode())
     
 
     def receiveRtspReply(self):
         """Receive RTSP reply from the server."""
+        # Replies may arrive split across reads or several to a read
+        parser = RtspParser()
         while True:
             try:
-                reply = self.rtspSocket.recv(1024)
-                if reply:
-                    print('\n--------Reply--------\n')
-                    print(reply.decode('utf-8'))
-                    print('\n------------------------\n')
-                    self.parseRtspReply(reply.decode('utf-8'))
+                data = self.rtspSocket.recv(RTSP_BUFFER_SIZE)
+                if data:
+                    for reply in parser.feed(data):
+                        # RTP and RTCP interleaved between the replies
+                        if isinstance(reply, InterleavedFrame):
+                            if reply.channel == self.interleaved[0]:
+                                self.receiveRtp(reply.data)
+                            elif reply.channel == self.interleaved[1]:
+                                self.receiveRtcp(reply.data)
+                            continue
+                        print('\n--------Reply--------\n')
+                        print('\n'.join([reply.startLine] + ['{}: {}'.format(name, value) for name, value in reply.headers.items()]))
+                        print('\n------------------------\n')
+                        self.parseRtspReply(reply)
             except:
                 if self.exitFlag.isSet():
                     self.rtspSocket.shutdown(socket.SHUT_RDWR)
@@ -350,59 +610,124 @@ class Client:
                     break
     
 
-    def parseRtspReply(self, data):
-        """Parse the RTSP reply from the server."""
-        reply = data.split('\n')
-        seq = int(reply[1].split(' ')[1])
-        if seq == self.rtspSeq:
-            if not self.requestSent == self.GET_LIST:
-                session = int(reply[2].split(' ')[1])
+    def parseRtspReply(self, reply):
+        """Parse the RTSP reply (an RtspMessage) from the server."""
+        seq = reply.cseq()
+        requestSent = self.pendingRequests.pop(seq, None)
+        if requestSent is not None:
+            if not requestSent == self.GET_LIST:
+                # "id;timeout=seconds" on SETUP and SWITCH replies
+                fields = reply.header('Session', '0').split(';')
+                session = int(fields[0])
+                for field in fields[1:]:
+                    name, _, value = field.strip().partition('=')
+                    if name == 'timeout':
+                        self.sessionTimeout = int(value)
                 if self.sessionId == 0:
                     self.sessionId = session
-            if self.requestSent == self.GET_LIST or session == self.sessionId:
-                code = int(reply[0].split(' ')[1])
+            if requestSent == self.GET_LIST or session == self.sessionId:
+                code = reply.status
                 if code == 200:
-                    if self.requestSent == self.SETUP:
+                    if requestSent == self.SETUP:
                         self.state = self.READY
-                        frameCnt = int(reply[3].split(' ')[1])
-                        self.fps = int(reply[4].split(' ')[1])
+                        frameCnt = int(reply.header('Frames', 0))
+                        self.fps = int(reply.header('Fps', 0))
                         totalTime = int(frameCnt/self.fps)
                         self.setTotalTime(totalTime)
-                    elif self.requestSent == self.DESCRIBE:
-                        self.writeDescriptionFile('\n'.join(reply[3:]))
-                    elif self.requestSent == self.PLAY:
+                        self.applyTransport(reply.header('Transport', ''))
+                        self.interleaved = parseInterleaved(reply.header('Transport', ''))
+                        self.fecDecoder = FecDecoder() if reply.header('FEC') else None
+                        self.missingPackets.delay = RtcpPacket.NACK_FEC_DELAY if self.fecDecoder else 0.0
+                    elif requestSent == self.DESCRIBE:
+                        self.writeDescriptionFile(reply.body.decode())
+                    elif requestSent == self.PLAY:
                         self.state = self.PLAYING
-                    elif self.requestSent == self.PAUSE:
+                    elif requestSent == self.PAUSE:
                         self.state = self.READY
                         self.playEvent.set()
-                    elif self.requestSent == self.TEARDOWN:
+                    elif requestSent == self.TEARDOWN:
                         self.state = self.INIT
                         self.setupFlag.set()
-                    elif self.requestSent == self.SWITCH:
-                        self.state = self.SWITCHING
-                        self.setupFlag.set()
-                    elif self.requestSent == self.GET_LIST:
-                        self.videoList = reply[2:]
+                    elif requestSent == self.SWITCH:
+                        # Frames of the new title start over at 1
+                        self.clearFrame()
+                        self.resetPipeline()
+                        self.resetVideoRate()
+                        self.resetLossRate()
+                        self.frameNumber = 0
+                        self.setCurrentTime(0)
+                        frameCnt = int(reply.header('Frames', 0))
+                        self.fps = int(reply.header('Fps', self.fps))
+                        self.setTotalTime(int(frameCnt/self.fps))
+                        self.applyTransport(reply.header('Transport', ''))
+                    elif requestSent == self.GET_LIST:
+                        # Lines are "name<TAB>frames<TAB>fps<TAB>duration"
+                        self.videoList = [line.split('\t')[0] for line in reply.body.decode().splitlines()]
                         self.setupFlag.set()
+                elif requestSent == self.SETUP:
+                    # 453 or 503: the server is at its session or decoder limit
+                    message = 'The server refused the session: {}'.format(reply.startLine.split(' ', 1)[-1])
+                    self.master.after(0, lambda: tkMessageBox.showwarning('Setup Failed', message))
     
     
     def openRtpPort(self):
         """Open RTP socket binded to a specified port."""
         self.rtpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Room for the bursts of fragments that make up one frame
+        self.rtpSocket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RTP_SOCKET_BUFFER)
         self.rtpSocket.settimeout(0.5)
         try:
             self.rtpSocket.bind(('', self.rtpPort))
         except:
             tkMessageBox.showwarning('Unable to Bind', 'Unable to bind PORT=%d' %self.rtpPort)
 
+        # RTCP uses the next port up
+        self.rtcpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.rtcpSocket.settimeout(0.5)
+        try:
+            self.rtcpSocket.bind(('', self.rtpPort + 1))
+        except:
+            tkMessageBox.showwarning('Unable to Bind', 'Unable to bind PORT=%d' %(self.rtpPort + 1))
+        threading.Thread(target=self.listenRtcp, daemon=True).start()
+
+
+
+    def applyTransport(self, transport):
+        """Join the multicast group of a live channel when the server names one; unicast needs nothing."""
+        params = parseTransport(transport)
+        if 'multicast' not in params or 'destination' not in params:
+            return
+        group = params['destination']
+        port = int(params.get('port', '0').split('-')[0])
+        if (group, port) == self.multicastGroup:
+            return
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Other viewers on this host listen to the same group and port
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RTP_SOCKET_BUFFER)
+        sock.settimeout(0.5)
+        try:
+            sock.bind((group, port))
+            # Join on the interface that reaches the server
+            interface = self.rtspSocket.getsockname()[0]
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton(interface)))
+        except OSError:
+            sock.close()
+            tkMessageBox.showwarning('Unable to Join', 'Unable to join %s:%d' %(group, port))
+            return
+        # listenRtp picks up the new socket on its next read
+        self.rtpSocket, old = sock, self.rtpSocket
+        old.close()
+        self.multicastGroup = (group, port)
+
     
     def clearFrame(self):
-        """Clear cache and video frame in the GUI."""
+        """Clear the video frame in the GUI and the replay buffer."""
         self.label.configure(image='')
         self.label['height'] = 35
-        cachename = CACHE_FILE_NAME + str(self.sessionId) + CACHE_FILE_EXT
-        if os.path.isfile(cachename):
-            os.remove(cachename)
+        self.replayBuffer.clear()
+        self.replayQueue.clear()
     
 
     def setLossRate(self, totalFrames, totalReceivedFrames):
@@ -411,11 +736,17 @@ class Client:
             lossFrames = 0
         packetCount = "Loss / Total (packets) = {:5d} / {:5d}".format(lossFrames,totalFrames)
         lossRate = "Loss rate = {:.2f} %".format(0 if totalFrames == 0 else lossFrames/totalFrames*100)
+        if self.fecDecoder:
+            lossRate += "\t\tFEC recovered / unrecoverable = {} / {}".format(self.fecDecoder.recovered, self.fecDecoder.unrecoverable)
+        missing = self.missingPackets
+        if missing.requested:
+            lossRate += "\t\tNACKed / repaired = {} / {}".format(missing.requested, missing.repaired)
         self.lossRatePercent.set(packetCount + '\t\t' + lossRate)
 
 
     def resetLossRate(self):
         self.totalReceivedFrames = 0
+        self.frameCntBase = None
         self.setLossRate(0, 0)
 
 
@@ -423,6 +754,10 @@ class Client:
         self.videoRateSpeed.set("Video rate = {:.2f} KB/s".format(0 if period == 0 else (receivedBytes/period)/1024))
 
 
+    def setBufferStats(self, depth, late, dropped):
+        self.bufferStats.set("Buffer = {:3d} frames\t\tLate = {:5d}\t\tDropped = {:5d}".format(depth, late, dropped))
+
+
     def resetVideoRate(self):
         self.receivedBytes = 0
         self.startTime = 0
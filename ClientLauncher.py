@@ -1,6 +1,6 @@
 import sys
 from tkinter import Tk
-from Client import Client
+from Client import Client, REPLAY_SECONDS
 
 if __name__ == "__main__":
 	try:
@@ -8,12 +8,17 @@ if __name__ == "__main__":
 		serverPort = sys.argv[2]
 		rtpPort = sys.argv[3]
 		fileName = sys.argv[4]	
+		replaySeconds = int(sys.argv[5]) if len(sys.argv) > 5 else REPLAY_SECONDS
+		# Media packets per parity packet asked of the server, e.g. 10; FEC is off unless asked for
+		fecGroup = int(sys.argv[6]) if len(sys.argv) > 6 else 0
+		# udp, or tcp to take RTP on the RTSP connection
+		transport = sys.argv[7] if len(sys.argv) > 7 else 'udp'
 	except:
-		print("[Usage: ClientLauncher.py Server_name Server_port RTP_port Video_file]\n")	
+		print("[Usage: ClientLauncher.py Server_name Server_port RTP_port Video_file [Replay_seconds] [Fec_group] [udp|tcp]]\n")	
 	
 	root = Tk()
 	
 	# Create a new client
-	app = Client(root, serverAddr, serverPort, rtpPort, fileName)
+	app = Client(root, serverAddr, serverPort, rtpPort, fileName, replaySeconds, fecGroup, transport)
 	app.master.title("RTPClient")	
 	root.mainloop()
@@ -0,0 +1,149 @@
+import struct
+from collections import OrderedDict
+
+from RtpPacket import RTP_HEADER, HEADER_SIZE
+
+# Parity packets share the media port and SSRC, with this payload type and their own sequence numbers
+FEC_PAYLOAD_TYPE = 127
+# Media packets protected by one parity packet, so the overhead is 1/FEC_GROUP
+FEC_GROUP = 10
+# The 16-bit mask of the level 0 header covers at most 16 packets
+MAX_GROUP = 16
+
+# E/L/P/X/CC recovery, M/PT recovery, SN base, TS recovery, length recovery (RFC 5109, 7.3)
+FEC_HEADER = struct.Struct('!BBHIH')
+# Protection length and mask of the level 0 header with L=0 (RFC 5109, 7.4)
+LEVEL_HEADER = struct.Struct('!HH')
+PARITY_OFFSET = HEADER_SIZE + FEC_HEADER.size + LEVEL_HEADER.size
+
+def parseFec(value):
+    """Return the group size asked for in an FEC header such as "group=10", 0 for the sender's choice, or None."""
+    for field in value.split(';'):
+        name, _, size = field.strip().partition('=')
+        if name == 'group':
+            return int(size) if size.isdigit() else None
+    return 0 if value.strip() else None
+
+class FecEncoder:
+    """XOR parity over the media packets of each frame, one parity packet per `group` packets (RFC 5109).
+
+    Groups never span frames, so a lost fragment can be rebuilt as soon as
+    its frame and the parity right behind it are in, without waiting for
+    the next frame.
+    """
+
+    def __init__(self, group, ssrc, seqnum=0):
+        self.group = max(2, min(group, MAX_GROUP))
+        self.ssrc = ssrc
+        self.seqnum = seqnum
+
+    def protect(self, packets):
+        """Return the parity packets, as [header, body], of a frame's media packets given as (header, fragment)."""
+        return [self.parity(packets[start : start + self.group]) for start in range(0, len(packets), self.group)]
+
+    def parity(self, packets):
+        # Everything after the fixed RTP header is protected: the extension, the JPEG header and the fragment
+        sizes = [len(header) - HEADER_SIZE + len(fragment) for header, fragment in packets]
+        protection = max(sizes)
+        first = second = timestamp = length = 0
+        bits = 0
+        for (header, fragment), size in zip(packets, sizes):
+            flags, marker, seqnum, ts, ssrc = RTP_HEADER.unpack_from(header, 0)
+            first ^= flags
+            second ^= marker
+            timestamp ^= ts
+            length ^= size
+            # Shorter packets are padded with zeros at the end
+            bits ^= int.from_bytes(header[HEADER_SIZE:], 'big') << 8 * (protection - len(header) + HEADER_SIZE)
+            bits ^= int.from_bytes(fragment, 'big') << 8 * (protection - size)
+        base = RTP_HEADER.unpack_from(packets[0][0], 0)[2]
+        mask = (0xFFFF << (16 - len(packets))) & 0xFFFF
+        header = (RTP_HEADER.pack(0x80, FEC_PAYLOAD_TYPE, self.seqnum, ts, self.ssrc)
+            + FEC_HEADER.pack(first & 0x3F, second, base, timestamp, length) + LEVEL_HEADER.pack(protection, mask))
+        self.seqnum = (self.seqnum + 1) & 0xFFFF
+        return [header, bits.to_bytes(protection, 'big')]
+
+class FecDecoder:
+    """Rebuild a media packet lost from its group out of the group's parity packet and the packets that did arrive.
+
+    Recent media packets are kept by sequence number. A parity packet whose
+    group misses more than one packet waits for late arrivals, and counts
+    as unrecoverable if it is still incomplete maxPending parity packets later.
+    """
+
+    def __init__(self, window=256, maxPending=32):
+        self.window = window
+        self.maxPending = maxPending
+        # Sequence number -> media datagram
+        self.media = OrderedDict()
+        # Parity sequence number -> (sequence numbers protected, parity datagram)
+        self.pending = OrderedDict()
+        self.recovered = 0
+        self.unrecoverable = 0
+
+    def push(self, datagram):
+        """Add a received datagram. Return the media datagrams it makes available: itself and any it recovers."""
+        if len(datagram) < HEADER_SIZE:
+            return []
+        seqnum = datagram[2] << 8 | datagram[3]
+        if datagram[1] & 0x7F == FEC_PAYLOAD_TYPE:
+            if len(datagram) < PARITY_OFFSET:
+                return []
+            base = FEC_HEADER.unpack_from(datagram, HEADER_SIZE)[2]
+            mask = LEVEL_HEADER.unpack_from(datagram, HEADER_SIZE + FEC_HEADER.size)[1]
+            protected = [(base + i) & 0xFFFF for i in range(16) if mask & (0x8000 >> i)]
+            # Groups more than maxPending parity packets old will not see their missing packets any more
+            for key in [key for key in self.pending if (seqnum - key) & 0xFFFF > self.maxPending]:
+                self.expire(key, self.pending.pop(key))
+            self.pending[seqnum] = (protected, bytes(datagram))
+            return self.recover(seqnum)
+
+        if seqnum in self.media:
+            return []
+        self.media[seqnum] = bytes(datagram)
+        while len(self.media) > self.window:
+            self.media.popitem(last=False)
+        datagrams = [datagram]
+        for key in [key for key, (protected, parity) in self.pending.items() if seqnum in protected]:
+            datagrams += self.recover(key)
+        return datagrams
+
+    def expire(self, key, entry):
+        protected, parity = entry
+        if any(seqnum not in self.media for seqnum in protected):
+            self.unrecoverable += 1
+
+    def recover(self, key):
+        protected, parity = self.pending[key]
+        missing = [seqnum for seqnum in protected if seqnum not in self.media]
+        if len(missing) > 1:
+            return []
+        del self.pending[key]
+        if not missing:
+            return []
+
+        first, second, base, timestamp, length = FEC_HEADER.unpack_from(parity, HEADER_SIZE)
+        protection = LEVEL_HEADER.unpack_from(parity, HEADER_SIZE + FEC_HEADER.size)[0]
+        bits = int.from_bytes(memoryview(parity)[PARITY_OFFSET:], 'big')
+        for seqnum in protected:
+            if seqnum == missing[0]:
+                continue
+            packet = self.media[seqnum]
+            size = len(packet) - HEADER_SIZE
+            first ^= packet[0]
+            second ^= packet[1]
+            timestamp ^= RTP_HEADER.unpack_from(packet, 0)[3]
+            length ^= size
+            bits ^= int.from_bytes(memoryview(packet)[HEADER_SIZE:], 'big') << 8 * (protection - size)
+        if length > protection:
+            self.unrecoverable += 1
+            return []
+        ssrc = RTP_HEADER.unpack_from(parity, 0)[4]
+        packet = RTP_HEADER.pack(0x80 | first & 0x3F, second, missing[0], timestamp, ssrc) + bits.to_bytes(protection, 'big')[:length]
+        self.media[missing[0]] = packet
+        self.recovered += 1
+        return [packet]
+
+    def reset(self):
+        self.media.clear()
+        self.pending.clear()
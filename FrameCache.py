@@ -0,0 +1,104 @@
+import threading
+from collections import OrderedDict
+
+CACHE_BYTES = 256 * 1024 * 1024
+
+class _Pending:
+	"""A frame being encoded by one session while others wait for it."""
+
+	def __init__(self):
+		self.event = threading.Event()
+		self.value = None
+
+class FrameCache:
+	"""Byte-bounded LRU cache of encoded frames shared by every session of the process.
+
+	Keys are (filename, frame index). Concurrent misses on the same key are
+	coalesced: the first caller runs the loader, the others wait for its result.
+	"""
+
+	def __init__(self, maxBytes=CACHE_BYTES):
+		self.maxBytes = maxBytes
+		self.size = 0
+		self.entries = OrderedDict()
+		self.pending = {}
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.coalesced = 0
+		self.evictions = 0
+
+	def get(self, key, loader):
+		"""Return the cached frame for key, calling loader() to produce it on a miss."""
+		with self.lock:
+			data = self.entries.get(key)
+			if data is not None:
+				self.entries.move_to_end(key)
+				self.hits += 1
+				return data
+			pending = self.pending.get(key)
+			if pending is None:
+				owner = True
+				pending = self.pending[key] = _Pending()
+				self.misses += 1
+			else:
+				owner = False
+				self.coalesced += 1
+
+		if not owner:
+			pending.event.wait()
+			if pending.value is not None:
+				return pending.value
+			# The owner failed to produce the frame; try with our own loader
+			return loader()
+
+		data = None
+		try:
+			data = loader()
+		finally:
+			with self.lock:
+				if data:
+					self.put(key, data)
+					pending.value = data
+				del self.pending[key]
+			pending.event.set()
+		return data
+
+	def peek(self, key):
+		"""Return the cached frame for key, or None without loading it."""
+		with self.lock:
+			data = self.entries.get(key)
+			if data is not None:
+				self.entries.move_to_end(key)
+				self.hits += 1
+			return data
+
+	def put(self, key, data):
+		"""Insert a frame and evict the least recently used ones. Caller holds the lock."""
+		if len(data) > self.maxBytes:
+			return
+		old = self.entries.pop(key, None)
+		if old is not None:
+			self.size -= len(old)
+		self.entries[key] = data
+		self.size += len(data)
+		while self.size > self.maxBytes:
+			_, evicted = self.entries.popitem(last=False)
+			self.size -= len(evicted)
+			self.evictions += 1
+
+	def stats(self):
+		"""Return the cache counters, for sizing the cache."""
+		with self.lock:
+			return {
+				'hits': self.hits,
+				'misses': self.misses,
+				'coalesced': self.coalesced,
+				'evictions': self.evictions,
+				'entries': len(self.entries),
+				'bytes': self.size,
+				'maxBytes': self.maxBytes,
+			}
+
+# Shared by every VideoStream of the process
+frameCache = FrameCache()
@@ -0,0 +1,108 @@
+import os, sys, io, mmap, struct
+import imageio
+
+STORE_DIR = '.framestore'
+STORE_EXT = '.mjpk'
+MAGIC = b'MJPK'
+VERSION = 1
+
+# magic, version, frame count, fps, width, height, source size, source mtime, index offset
+HEADER = struct.Struct('<4sHIdHHQdQ')
+OFFSET = struct.Struct('<Q')
+
+def storePath(filename):
+	"""Return the path of the packed MJPEG store for a video file."""
+	directory, name = os.path.split(filename)
+	return os.path.join(directory, STORE_DIR, name + STORE_EXT)
+
+class FrameStore:
+	"""Read-only, memory-mapped access to a packed MJPEG file.
+
+	The file is a fixed header, the JPEG frames back to back, then a table of
+	frameCnt + 1 offsets so frame i spans index[i]:index[i + 1].
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		with open(path, 'rb') as f:
+			# Copy-on-write rather than read-only so the send loop can take the address of a frame; nothing writes to it
+			self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+		self.view = memoryview(self.mm)
+		magic, version, self.frameCnt, self.fps, self.width, self.height, \
+			self.sourceSize, self.sourceMtime, indexOffset = HEADER.unpack_from(self.mm, 0)
+		if magic != MAGIC or version != VERSION:
+			self.close()
+			raise IOError("Not a frame store: " + path)
+		self.index = self.view[indexOffset : indexOffset + OFFSET.size * (self.frameCnt + 1)].cast('Q')
+
+	@classmethod
+	def open(cls, filename):
+		"""Open the store of a video file if it exists and matches the source. Return None otherwise."""
+		path = storePath(filename)
+		try:
+			store = cls(path)
+			st = os.stat(filename)
+		except (OSError, ValueError):
+			return None
+		if store.sourceSize != st.st_size or store.sourceMtime != st.st_mtime:
+			store.close()
+			return None
+		return store
+
+	def frame(self, index):
+		"""Return frame `index` as a zero-copy memoryview into the mapping."""
+		return self.view[self.index[index] : self.index[index + 1]]
+
+	def close(self):
+		try:
+			if hasattr(self, 'index'):
+				self.index.release()
+			self.view.release()
+			self.mm.close()
+		except BufferError:
+			# Frames are still referenced by a sender; the mapping goes away with them
+			pass
+
+def ingest(filename):
+	"""Transcode a video once into a packed MJPEG store. Return the store path."""
+	path = storePath(filename)
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	st = os.stat(filename)
+	reader = imageio.get_reader(filename, 'ffmpeg')
+	meta = reader.get_meta_data()
+	width, height = meta.get('size', (0, 0))
+	offsets = []
+
+	tmp = path + '.tmp'
+	with open(tmp, 'wb') as f:
+		f.write(bytes(HEADER.size))
+		try:
+			for data in reader:
+				buffer = io.BytesIO()
+				imageio.imwrite(buffer, data, format='JPEG')
+				offsets.append(f.tell())
+				f.write(buffer.getbuffer())
+		finally:
+			reader.close()
+		offsets.append(f.tell())
+		indexOffset = f.tell()
+		for offset in offsets:
+			f.write(OFFSET.pack(offset))
+		f.seek(0)
+		f.write(HEADER.pack(MAGIC, VERSION, len(offsets) - 1, meta.get('fps') or 25, width, height,
+			st.st_size, st.st_mtime, indexOffset))
+	os.replace(tmp, path)
+	return path
+
+if __name__ == "__main__":
+	from Server import VIDEO_FILE_EXT, VIDEO_DIR
+
+	files = sys.argv[1:] or [file for file in os.listdir(VIDEO_DIR) if file.endswith(VIDEO_FILE_EXT)]
+	for file in files:
+		store = FrameStore.open(file)
+		if store:
+			store.close()
+			print("Up to date: " + file)
+			continue
+		print("Ingesting " + file)
+		ingest(file)
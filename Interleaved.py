@@ -0,0 +1,99 @@
+import socket, select, threading
+from collections import deque
+
+# Bytes of RTP a session may have waiting for a slow TCP reader before whole frames are dropped
+TCP_QUEUE_BYTES = 256 * 1024
+# Kernel send buffer of such a connection; left to autotune it grows to megabytes, seconds of video behind
+TCP_SEND_BUFFER = 64 * 1024
+# Seconds an RTSP reply waits for a connection that does not drain before giving up
+REPLY_TIMEOUT = 5.0
+
+def limitSendBuffer(sock):
+	"""Keep the kernel from buffering what TCP_QUEUE_BYTES is meant to bound, so a slow reader loses frames instead of falling behind."""
+	try:
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, TCP_SEND_BUFFER)
+	except OSError:
+		pass
+
+class InterleavedQueue:
+	"""Bytes bound for one RTSP connection carrying interleaved RTP, written without blocking the sender.
+
+	The send loop queues whole frames and the socket takes what it can
+	with non-blocking writes; the rest goes out on the next frame. A frame
+	that would take the backlog past maxBytes is dropped entirely rather
+	than cut, so the reader sees fewer frames, never a torn one. RTSP
+	replies share the queue, so they cannot land in the middle of a frame,
+	and are never dropped.
+	"""
+
+	def __init__(self, sock, maxBytes=TCP_QUEUE_BYTES):
+		self.sock = sock
+		self.maxBytes = maxBytes
+		self.lock = threading.Lock()
+		self.chunks = deque()
+		# Bytes of the first chunk already written
+		self.offset = 0
+		self.queued = 0
+		# Bytes handed to the socket so far
+		self.written = 0
+		self.framesDropped = 0
+		self.closed = False
+
+	def room(self, size=0):
+		"""Flush what the socket takes now. Return whether `size` more bytes of RTP may be queued."""
+		with self.lock:
+			self.flush()
+			return self.queued + size <= self.maxBytes
+
+	def write(self, data):
+		"""Queue a frame or an RTCP packet. Return False if it was dropped for want of room."""
+		with self.lock:
+			if self.queued + len(data) > self.maxBytes:
+				self.framesDropped += 1
+				return False
+			self.chunks.append(data)
+			self.queued += len(data)
+			self.flush()
+			return True
+
+	def writeAll(self, data, timeout=REPLY_TIMEOUT):
+		"""Queue an RTSP reply and wait until the connection has taken it; raise OSError if it does not."""
+		with self.lock:
+			self.chunks.append(data)
+			self.queued += len(data)
+			# Frames queued after the reply do not hold it up
+			target = self.written + self.queued
+		while True:
+			with self.lock:
+				self.flush()
+				if self.closed:
+					raise OSError("connection closed")
+				if self.written >= target:
+					return
+			# Wait for room without the lock, so the send loop keeps queueing or dropping frames meanwhile
+			if not select.select([], [self.sock], [], timeout)[1]:
+				raise OSError("RTSP reply timed out")
+
+	def drain(self, timeout=REPLY_TIMEOUT):
+		"""Wait until everything queued so far is written; raise OSError if the connection does not take it."""
+		self.writeAll(b'', timeout)
+
+	def flush(self):
+		"""Write queued bytes until the socket would block; called with the lock held."""
+		while self.chunks and not self.closed:
+			chunk = self.chunks[0]
+			try:
+				sent = self.sock.send(memoryview(chunk)[self.offset:], socket.MSG_DONTWAIT)
+			except BlockingIOError:
+				return
+			except OSError:
+				self.closed = True
+				self.chunks.clear()
+				self.queued = 0
+				return
+			self.offset += sent
+			self.queued -= sent
+			self.written += sent
+			if self.offset == len(chunk):
+				self.chunks.popleft()
+				self.offset = 0
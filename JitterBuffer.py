@@ -0,0 +1,61 @@
+import heapq, threading, time
+
+class JitterBuffer:
+    """Bounded buffer of received frames, handed out in frame-number order.
+
+    A frame is released once targetDepth frames are buffered or it has
+    waited maxDelay seconds, which absorbs reordering and arrival jitter.
+    Frames older than the last one released are counted as late and
+    discarded; when the buffer is full the oldest frame is dropped.
+    """
+
+    def __init__(self, maxFrames=50, targetDepth=2, maxDelay=0.1):
+        self.maxFrames = maxFrames
+        self.targetDepth = targetDepth
+        self.maxDelay = maxDelay
+        self.cond = threading.Condition()
+        self.heap = []
+        self.lastFrame = 0
+        self.late = 0
+        self.dropped = 0
+
+    def push(self, frameNbr, data):
+        with self.cond:
+            if frameNbr <= self.lastFrame:
+                self.late += 1
+                return
+            heapq.heappush(self.heap, (frameNbr, time.monotonic(), data))
+            while len(self.heap) > self.maxFrames:
+                self.lastFrame = heapq.heappop(self.heap)[0]
+                self.dropped += 1
+            self.cond.notify()
+
+    def pop(self, timeout):
+        """Return the next (frameNbr, data) when it is due, or None after timeout seconds."""
+        end = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                remaining = end - now
+                wait = remaining
+                if self.heap:
+                    frameNbr, arrival, data = self.heap[0]
+                    due = arrival + self.maxDelay - now
+                    if len(self.heap) >= self.targetDepth or due <= 0:
+                        heapq.heappop(self.heap)
+                        self.lastFrame = frameNbr
+                        return frameNbr, data
+                    wait = min(due, remaining)
+                if remaining <= 0:
+                    return None
+                self.cond.wait(wait)
+
+    def reset(self, lastFrame=0):
+        """Forget buffered frames, e.g. after a seek. Frames up to lastFrame count as late."""
+        with self.cond:
+            self.heap = []
+            self.lastFrame = lastFrame
+
+    def depth(self):
+        with self.cond:
+            return len(self.heap)
@@ -0,0 +1,77 @@
+import sys, os, time, json, socket, argparse, subprocess, tempfile
+import imageio_ffmpeg
+
+from LoadClient import runLoad, MIXES
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Server.py')
+
+# Synthetic titles as (name, size, seconds); the lavfi test pattern needs no media files
+TEST_VIDEOS = (('test-360p.mp4', '640x360', 30), ('test-240p.mp4', '320x240', 30))
+TEST_FPS = 25
+
+def makeTestVideo(path, size, seconds, fps=TEST_FPS):
+    """Render an H.264 test pattern with a keyframe every two seconds."""
+    subprocess.run([imageio_ffmpeg.get_ffmpeg_exe(), '-y', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', 'testsrc=size={}:rate={}:duration={}'.format(size, fps, seconds),
+        '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-g', str(2 * fps), path], check=True)
+
+def startServer(directory, port, engine, workers):
+    """Start a server in `directory` and wait until it accepts RTSP connections."""
+    process = subprocess.Popen([sys.executable, SERVER, str(port), '--engine', engine,
+        '--workers', str(workers), '--log-level', 'warning'], cwd=directory)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("server did not start")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end load benchmark on synthetic videos.")
+    parser.add_argument('--port', type=int, default=8554)
+    parser.add_argument('--engines', nargs='+', choices=('thread', 'asyncio'), default=['thread', 'asyncio'])
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 10, 50])
+    parser.add_argument('--mixes', nargs='+', choices=sorted(MIXES), default=['play', 'mixed'])
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--dir', help="directory for the test videos (default: a temporary one)")
+    parser.add_argument('--output', help="write the JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    directory = args.dir or tempfile.mkdtemp(prefix='videostream-bench-')
+    os.makedirs(directory, exist_ok=True)
+    titles = []
+    for name, size, seconds in TEST_VIDEOS:
+        path = os.path.join(directory, name)
+        if not os.path.exists(path):
+            makeTestVideo(path, size, seconds)
+        titles.append(name)
+
+    runs = []
+    for engine in args.engines:
+        for mix in args.mixes:
+            for sessions in args.sessions:
+                # A fresh server per run, so caches and counters do not carry over
+                server = startServer(directory, args.port, engine, args.workers)
+                try:
+                    report = runLoad('127.0.0.1', args.port, titles, sessions, args.duration, mix, serverPid=server.pid)
+                finally:
+                    server.terminate()
+                    server.wait()
+                report.update(engine=engine, workers=args.workers)
+                runs.append(report)
+                print("{} {} x{}: {:.1f} fps, {} sustained".format(engine, mix, sessions,
+                    report['framesPerSecond'], report['sessionsSustained']), file=sys.stderr)
+
+    results = {'python': sys.version.split()[0], 'fps': TEST_FPS, 'runs': runs}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
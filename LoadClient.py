@@ -0,0 +1,531 @@
+import sys, os, time, json, random, socket, struct, argparse, threading, statistics
+
+from RtpPacket import RtpPacket, FrameAssembler, RTP_HEADER
+from RtspParser import RtspParser, InterleavedFrame, formatMessage, parseTransport
+import RtcpPacket
+from Fec import FecDecoder
+
+RTP_BUFFER_SIZE = 65536
+RTP_SOCKET_BUFFER = 1024 * 1024
+RTSP_BUFFER_SIZE = 4096
+MJPEG_PAYLOAD_TYPE = 26
+
+# Seconds to wait for an RTSP reply before counting the request as failed
+REPLY_TIMEOUT = 5.0
+# Seconds of playback between two scripted actions of a session
+DWELL_SECONDS = 2.0
+# A session is sustained while it receives at least this fraction of the nominal frame rate
+SUSTAINED_FRACTION = 0.9
+
+# Relative weights of the actions a session takes after each dwell
+MIXES = {
+    'play': {'play': 1},
+    'seek': {'play': 1, 'seek': 1},
+    'switch': {'play': 1, 'switch': 1},
+    'mixed': {'play': 3, 'seek': 2, 'switch': 1},
+}
+
+class LoadSession:
+    """Headless RTSP/RTP session sending the same requests as Client, and measuring what it receives."""
+
+    def __init__(self, serverAddr, serverPort, filename, fecGroup=0, loss=0.0, nack=False, tcp=False):
+        self.filename = filename
+        # Take RTP interleaved on the RTSP connection rather than on a UDP port
+        self.tcp = tcp
+        # Parity group size asked for at SETUP, 0 for none
+        self.fecGroup = fecGroup
+        self.fecDecoder = None
+        # Fraction of the received datagrams thrown away, to measure a lossy link on loopback
+        self.loss = loss
+        self.dropped = 0
+        self.rtspSeq = 0
+        self.sessionId = 0
+        self.fps = 25
+        self.frameCnt = 0
+        self.playing = False
+
+        self.frames = 0
+        self.bytes = 0
+        self.playSeconds = 0.0
+        self.playStart = None
+        self.lastArrival = None
+        self.intervals = []
+        self.seekLatencies = []
+        self.seekTarget = None
+        self.seekStart = None
+        self.switchLatencies = []
+        self.switchStart = None
+        self.errors = 0
+
+        self.rtspSocket = socket.create_connection((serverAddr, serverPort), timeout=REPLY_TIMEOUT)
+        self.parser = RtspParser()
+        self.replies = {}
+        # Over TCP a reader thread owns the RTSP socket and hands the replies over
+        self.replyReady = threading.Condition()
+        self.rtpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.rtpSocket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RTP_SOCKET_BUFFER)
+        self.rtpSocket.bind(('', 0))
+        self.rtpSocket.settimeout(0.5)
+        self.rtpPort = self.rtpSocket.getsockname()[1]
+        self.multicastGroup = None
+        self.assembler = FrameAssembler()
+        # NACKs go out from the port above the RTP one, where the server expects RTCP, to where its reports come from
+        self.missingPackets = RtcpPacket.MissingPackets() if nack else None
+        self.rtcpSocket = None
+        self.senderRtcpAddr = None
+        if nack and not tcp:
+            try:
+                self.rtcpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self.rtcpSocket.bind(('', self.rtpPort + 1))
+                self.rtcpSocket.setblocking(False)
+            except OSError:
+                self.rtcpSocket.close()
+                self.rtcpSocket = None
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        threading.Thread(target=self.listenRtsp if tcp else self.listenRtp, daemon=True).start()
+
+    def send(self, method, *headers, uri=None):
+        """Send one request without waiting for its reply. Return its CSeq."""
+        self.rtspSeq += 1
+        startLine = "{} {} RTSP/1.0".format(method, uri or self.filename)
+        request = formatMessage(startLine, (("CSeq", self.rtspSeq),) + headers)
+        self.rtspSocket.sendall(request)
+        return self.rtspSeq
+
+    def reply(self, cseq):
+        """Wait for the reply to request `cseq`. Return it if it is a 200 OK, or None."""
+        if self.tcp:
+            with self.replyReady:
+                self.replyReady.wait_for(lambda: cseq in self.replies or self.closed.is_set(), REPLY_TIMEOUT)
+                reply = self.replies.pop(cseq, None)
+            if reply is not None and reply.status == 200:
+                return reply
+            self.errors += 1
+            return None
+        try:
+            while cseq not in self.replies:
+                data = self.rtspSocket.recv(RTSP_BUFFER_SIZE)
+                if not data:
+                    break
+                for message in self.parser.feed(data):
+                    self.replies[message.cseq()] = message
+        except (OSError, ValueError):
+            pass
+        reply = self.replies.pop(cseq, None)
+        if reply is not None and reply.status == 200:
+            return reply
+        self.errors += 1
+        return None
+
+    def request(self, method, *headers, uri=None):
+        """Send one request and wait for its reply."""
+        try:
+            return self.reply(self.send(method, *headers, uri=uri))
+        except OSError:
+            self.errors += 1
+            return None
+
+    def listTitles(self):
+        """GET_LIST, as Client does on start-up. Return the titles."""
+        reply = self.request("GET_LIST", uri='*')
+        if reply is None:
+            return []
+        return [line.split('\t')[0] for line in reply.body.decode().splitlines()]
+
+    def setup(self):
+        if self.tcp:
+            headers = [("Transport", "RTP/AVP/TCP;interleaved=0-1")]
+        else:
+            headers = [("Transport", "RTP/UDP; client_port= {}".format(self.rtpPort))]
+        if self.fecGroup and not self.tcp:
+            headers.append(("FEC", "group={}".format(self.fecGroup)))
+        reply = self.request("SETUP", *headers)
+        if reply:
+            self.fecDecoder = FecDecoder() if reply.header('FEC') else None
+            if self.missingPackets and self.fecDecoder:
+                self.missingPackets.delay = RtcpPacket.NACK_FEC_DELAY
+            self.sessionId = int(reply.header('Session', '0').split(';')[0])
+            self.frameCnt = int(reply.header('Frames', 0))
+            self.fps = int(reply.header('Fps', 25))
+            self.joinChannel(reply.header('Transport', ''))
+        return reply is not None
+
+    def joinChannel(self, transport):
+        """Listen to the multicast group of a live channel, as Client does, when the reply names one."""
+        params = parseTransport(transport)
+        if 'multicast' not in params or 'destination' not in params:
+            return
+        group = params['destination']
+        port = int(params.get('port', '0').split('-')[0])
+        if (group, port) == self.multicastGroup:
+            return
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RTP_SOCKET_BUFFER)
+        sock.settimeout(0.5)
+        try:
+            sock.bind((group, port))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton(self.rtspSocket.getsockname()[0])))
+        except OSError:
+            sock.close()
+            self.errors += 1
+            return
+        self.rtpSocket, old = sock, self.rtpSocket
+        old.close()
+        self.multicastGroup = (group, port)
+
+    def startSeek(self, frame):
+        if frame != -1:
+            with self.lock:
+                self.seekTarget = frame
+                self.seekStart = time.monotonic()
+
+    def started(self, reply):
+        if reply:
+            self.playing = True
+            self.playStart = time.monotonic()
+        return reply is not None
+
+    def play(self, frame=-1):
+        self.startSeek(frame)
+        return self.started(self.request("PLAY", ("Session", self.sessionId), ("Frame", frame)))
+
+    def pause(self):
+        reply = self.request("PAUSE", ("Session", self.sessionId))
+        self.stopClock()
+        return reply is not None
+
+    def seek(self, frame):
+        """Seek the way Client does, PAUSE then PLAY with the requested frame, but pipelined."""
+        try:
+            self.startSeek(frame)
+            pause = self.send("PAUSE", ("Session", self.sessionId))
+            play = self.send("PLAY", ("Session", self.sessionId), ("Frame", frame))
+        except OSError:
+            self.errors += 1
+            return False
+        paused = self.reply(pause)
+        self.stopClock()
+        return paused is not None and self.started(self.reply(play))
+
+    def switch(self, filename):
+        """SWITCH the playing session to another title in one request."""
+        self.stopClock()
+        self.filename = filename
+        with self.lock:
+            self.switchStart = time.monotonic()
+        reply = self.request("SWITCH", ("Session", self.sessionId))
+        if reply:
+            self.frameCnt = int(reply.header('Frames', 0))
+            self.fps = int(reply.header('Fps', self.fps))
+            self.joinChannel(reply.header('Transport', ''))
+        self.assembler.reset()
+        return self.started(reply)
+
+    def keepalive(self):
+        """GET_PARAMETER, so the server does not expire a session that sends no RTCP."""
+        return self.request("GET_PARAMETER", ("Session", self.sessionId)) is not None
+
+    def teardown(self):
+        self.request("TEARDOWN", ("Session", self.sessionId))
+        self.stopClock()
+
+    def stopClock(self):
+        with self.lock:
+            if self.playing:
+                self.playSeconds += time.monotonic() - self.playStart
+            self.playing = False
+            self.lastArrival = None
+
+    def close(self):
+        self.closed.set()
+        self.rtspSocket.close()
+        self.rtpSocket.close()
+        if self.rtcpSocket:
+            self.rtcpSocket.close()
+
+    def listenRtp(self):
+        while not self.closed.is_set():
+            try:
+                data = self.rtpSocket.recv(RTP_BUFFER_SIZE)
+            except socket.timeout:
+                continue
+            except OSError:
+                # Closed, or replaced by the socket of a multicast group
+                if self.closed.is_set():
+                    break
+                continue
+            if self.loss and random.random() < self.loss:
+                self.dropped += 1
+                continue
+            self.receiveRtp(data)
+
+    def listenRtsp(self):
+        """Read the RTSP connection over TCP: replies for reply(), interleaved RTP for the assembler."""
+        while not self.closed.is_set():
+            try:
+                data = self.rtspSocket.recv(RTP_BUFFER_SIZE)
+                if not data:
+                    break
+                messages = self.parser.feed(data)
+            except socket.timeout:
+                continue
+            except (OSError, ValueError):
+                break
+            for message in messages:
+                # RTCP sender reports on channel 1 are not answered
+                if isinstance(message, InterleavedFrame):
+                    if message.channel == 0:
+                        self.receiveRtp(message.data)
+                    continue
+                with self.replyReady:
+                    self.replies[message.cseq()] = message
+                    self.replyReady.notify_all()
+        with self.replyReady:
+            self.closed.set()
+            self.replyReady.notify_all()
+
+    def receiveRtp(self, data):
+        fecDecoder = self.fecDecoder
+        for datagram in fecDecoder.push(data) if fecDecoder else (data,):
+            rtpPacket = RtpPacket()
+            rtpPacket.decode(datagram)
+            # RTCP sender reports may land here when the port above ours belongs to another session
+            if rtpPacket.payloadType() != MJPEG_PAYLOAD_TYPE:
+                continue
+            if self.rtcpSocket:
+                self.missingPackets.update(rtpPacket.seqNum(), recovered=datagram is not data)
+            frame = self.assembler.push(rtpPacket)
+            if frame is None:
+                continue
+            self.frameReceived(rtpPacket.getFrameNbr(), len(frame))
+        if self.rtcpSocket:
+            self.sendNack(RTP_HEADER.unpack_from(data, 0)[4])
+
+    def sendNack(self, mediaSsrc):
+        # Sender reports are only read for the address NACKs go to
+        while True:
+            try:
+                report, self.senderRtcpAddr = self.rtcpSocket.recvfrom(2048)
+            except OSError:
+                break
+        seqnums = self.missingPackets.due()
+        if seqnums and self.senderRtcpAddr and not self.multicastGroup:
+            try:
+                self.rtcpSocket.sendto(RtcpPacket.makeNack(0, mediaSsrc, seqnums), self.senderRtcpAddr)
+            except OSError:
+                pass
+
+    def frameReceived(self, frameNbr, size):
+        now = time.monotonic()
+        with self.lock:
+            self.frames += 1
+            self.bytes += size
+            if self.playing and self.lastArrival is not None:
+                self.intervals.append(now - self.lastArrival)
+            self.lastArrival = now
+            # The server numbers frames from 1, so a seek to frame k shows up as frame k + 1
+            if self.seekTarget is not None and self.seekTarget < frameNbr <= self.seekTarget + self.fps:
+                self.seekLatencies.append(now - self.seekStart)
+                self.seekTarget = None
+            # The new title of a SWITCH starts over at frame 1
+            if self.switchStart is not None and frameNbr <= self.fps:
+                self.switchLatencies.append(now - self.switchStart)
+                self.switchStart = None
+
+    def results(self):
+        with self.lock:
+            playSeconds = self.playSeconds
+            if self.playing:
+                playSeconds += time.monotonic() - self.playStart
+            fps = self.frames / playSeconds if playSeconds else 0.0
+            return {
+                'frames': self.frames,
+                'bytes': self.bytes,
+                'playSeconds': playSeconds,
+                'fps': fps,
+                'sustained': fps >= SUSTAINED_FRACTION * self.fps,
+                'intervals': list(self.intervals),
+                'seekLatencies': list(self.seekLatencies),
+                'switchLatencies': list(self.switchLatencies),
+                'errors': self.errors,
+                'packetsDropped': self.dropped,
+                'fecRecovered': self.fecDecoder.recovered if self.fecDecoder else 0,
+                'fecUnrecoverable': self.fecDecoder.unrecoverable if self.fecDecoder else 0,
+                'nacked': self.missingPackets.requested if self.missingPackets else 0,
+                'nackRepaired': self.missingPackets.repaired if self.missingPackets else 0,
+                'nackAbandoned': self.missingPackets.abandoned if self.missingPackets else 0,
+            }
+
+def runSession(serverAddr, serverPort, titles, duration, mix, seed, results, fecGroup=0, loss=0.0, nack=False, tcp=False):
+    """Play titles for `duration` seconds, taking an action from `mix` after every dwell."""
+    rng = random.Random(seed)
+    try:
+        session = LoadSession(serverAddr, serverPort, rng.choice(titles), fecGroup, loss, nack, tcp)
+    except OSError:
+        results.append({'errors': 1, 'connectFailed': True})
+        return
+    actions = list(MIXES[mix])
+    weights = [MIXES[mix][action] for action in actions]
+    try:
+        session.listTitles()
+        if session.setup() and session.play():
+            end = time.monotonic() + duration
+            while time.monotonic() + DWELL_SECONDS < end:
+                time.sleep(DWELL_SECONDS)
+                action = rng.choices(actions, weights)[0]
+                if action == 'seek' and session.frameCnt:
+                    session.seek(rng.randrange(session.frameCnt))
+                elif action == 'switch':
+                    session.switch(rng.choice(titles))
+                else:
+                    session.keepalive()
+            time.sleep(max(0.0, end - time.monotonic()))
+            session.teardown()
+    finally:
+        session.close()
+        results.append(session.results())
+
+class ProcessSampler:
+    """Sample the CPU time and resident memory of a process and its children from /proc."""
+
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.rss = []
+        self.stopEvent = threading.Event()
+        self.ticks = os.sysconf('SC_CLK_TCK')
+
+    def pids(self):
+        try:
+            with open('/proc/{0}/task/{0}/children'.format(self.pid)) as f:
+                return [self.pid] + [int(child) for child in f.read().split()]
+        except OSError:
+            return [self.pid]
+
+    def cpuSeconds(self):
+        total = 0
+        for pid in self.pids():
+            try:
+                with open('/proc/{}/stat'.format(pid)) as f:
+                    # Fields after the parenthesised command name; utime and stime are fields 14 and 15
+                    fields = f.read().rsplit(')', 1)[1].split()
+                total += int(fields[11]) + int(fields[12])
+            except (OSError, IndexError):
+                pass
+        return total / self.ticks
+
+    def rssKb(self):
+        total = 0
+        for pid in self.pids():
+            try:
+                with open('/proc/{}/status'.format(pid)) as f:
+                    for line in f:
+                        if line.startswith('VmRSS:'):
+                            total += int(line.split()[1])
+            except OSError:
+                pass
+        return total
+
+    def run(self):
+        while not self.stopEvent.wait(self.interval):
+            self.rss.append(self.rssKb())
+
+    def start(self):
+        self.startCpu = self.cpuSeconds()
+        self.startTime = time.monotonic()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.stopEvent.set()
+        elapsed = time.monotonic() - self.startTime
+        cpu = self.cpuSeconds() - self.startCpu
+        return {
+            'serverCpuPercent': 100 * cpu / elapsed if elapsed else 0.0,
+            'serverRssKbMax': max(self.rss, default=self.rssKb()),
+            'serverRssKbMean': statistics.mean(self.rss) if self.rss else self.rssKb(),
+        }
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+def runLoad(serverAddr, serverPort, titles, sessions, duration, mix='play', ramp=0.05, serverPid=None, seed=0, fecGroup=0, loss=0.0, nack=False, tcp=False):
+    """Run `sessions` concurrent sessions against a server and return the aggregate results as a dict."""
+    sampler = ProcessSampler(serverPid) if serverPid else None
+    if sampler:
+        sampler.start()
+    results = []
+    threads = []
+    start = time.monotonic()
+    for i in range(sessions):
+        thread = threading.Thread(target=runSession,
+            args=(serverAddr, serverPort, titles, duration, mix, seed + i, results, fecGroup, loss, nack, tcp), daemon=True)
+        thread.start()
+        threads.append(thread)
+        time.sleep(ramp)
+    for thread in threads:
+        thread.join(duration + 4 * REPLY_TIMEOUT)
+    elapsed = time.monotonic() - start
+
+    intervals = [interval for result in results for interval in result.get('intervals', ())]
+    seeks = [latency for result in results for latency in result.get('seekLatencies', ())]
+    switches = [latency for result in results for latency in result.get('switchLatencies', ())]
+    frames = sum(result.get('frames', 0) for result in results)
+    report = {
+        'sessions': sessions,
+        'mix': mix,
+        'duration': duration,
+        'sessionsSustained': sum(1 for result in results if result.get('sustained')),
+        'framesPerSecond': frames / elapsed if elapsed else 0.0,
+        'framesPerSecondPerSession': statistics.mean(result['fps'] for result in results if 'fps' in result) if results else 0.0,
+        'frameIntervalMeanMs': 1000 * statistics.mean(intervals) if intervals else None,
+        'frameIntervalJitterMs': 1000 * statistics.pstdev(intervals) if intervals else None,
+        'frameIntervalP99Ms': 1000 * percentile(intervals, 0.99) if intervals else None,
+        'seeks': len(seeks),
+        'seekLatencyMeanMs': 1000 * statistics.mean(seeks) if seeks else None,
+        'seekLatencyP95Ms': 1000 * percentile(seeks, 0.95) if seeks else None,
+        'switches': len(switches),
+        'switchLatencyMeanMs': 1000 * statistics.mean(switches) if switches else None,
+        'switchLatencyP95Ms': 1000 * percentile(switches, 0.95) if switches else None,
+        'errors': sum(result.get('errors', 0) for result in results),
+        'packetsDropped': sum(result.get('packetsDropped', 0) for result in results),
+        'fecRecovered': sum(result.get('fecRecovered', 0) for result in results),
+        'fecUnrecoverable': sum(result.get('fecUnrecoverable', 0) for result in results),
+        'nacked': sum(result.get('nacked', 0) for result in results),
+        'nackRepaired': sum(result.get('nackRepaired', 0) for result in results),
+        'nackAbandoned': sum(result.get('nackAbandoned', 0) for result in results),
+    }
+    if sampler:
+        report.update(sampler.stop())
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless load generator for the RTSP/RTP server.")
+    parser.add_argument('host')
+    parser.add_argument('port', type=int)
+    parser.add_argument('titles', nargs='+', help="video files to request, as listed by the server")
+    parser.add_argument('--sessions', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=20, help="seconds each session runs")
+    parser.add_argument('--mix', choices=sorted(MIXES), default='play')
+    parser.add_argument('--ramp', type=float, default=0.05, help="seconds between session starts")
+    parser.add_argument('--server-pid', type=int, help="sample CPU and RSS of this server process")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fec', type=int, default=0, metavar='GROUP',
+        help="ask for one XOR parity packet per GROUP media packets (default: no FEC)")
+    parser.add_argument('--loss', type=float, default=0.0,
+        help="fraction of received RTP datagrams to drop at random, to simulate a lossy link")
+    parser.add_argument('--nack', action='store_true',
+        help="ask the server to resend the packets missing from each stream with RTCP NACKs")
+    parser.add_argument('--tcp', action='store_true',
+        help="take RTP interleaved on the RTSP connection instead of UDP (no loss, FEC or NACK)")
+    args = parser.parse_args()
+
+    report = runLoad(args.host, args.port, args.titles, args.sessions, args.duration,
+        args.mix, args.ramp, args.server_pid, args.seed, args.fec, args.loss, args.nack, args.tcp)
+    json.dump(report, sys.stdout, indent=2)
+    print()
@@ -0,0 +1,241 @@
+import os, re, json, math, bisect, subprocess, threading, time, logging
+import imageio
+import imageio_ffmpeg
+
+logger = logging.getLogger(__name__)
+
+CATALOG_FILE = '.catalog.json'
+CATALOG_VERSION = 2
+
+# Seconds between two scans of the video directory for new, changed or removed files
+RESCAN_INTERVAL = 5.0
+
+PTS_TIME = re.compile(rb'pts_time:\s*(-?[0-9.]+)')
+
+class MediaCatalog:
+	"""On-disk cache of per-file media metadata, keyed by path, size and mtime.
+
+	The catalog doubles as the server's serverInfo: it reads like a dict of
+	filename -> metadata, and also serves the encoded GET_LIST listing,
+	which is built once per change of the directory. A change replaces the
+	entries dict as a whole, under the lock, so readers never see one half
+	updated.
+	"""
+
+	def __init__(self, directory, extensions):
+		self.directory = directory
+		self.extensions = extensions
+		self.path = os.path.join(directory, CATALOG_FILE)
+		self.entries = {}
+		self.lock = threading.Lock()
+		# Sorted titles, their encoded listing lines and the whole listing; None when stale
+		self.names = None
+		self.lines = None
+		self.fullListing = None
+
+	def __getitem__(self, name):
+		return self.entries[name]
+
+	def __contains__(self, name):
+		return name in self.entries
+
+	def __iter__(self):
+		return iter(list(self.entries))
+
+	def __len__(self):
+		return len(self.entries)
+
+	def get(self, name, default=None):
+		return self.entries.get(name, default)
+
+	def load(self):
+		"""Load the catalog file. A missing or unreadable catalog is treated as empty."""
+		try:
+			with open(self.path, 'r') as f:
+				data = json.load(f)
+			entries = data.get('entries', {}) if data.get('version') == CATALOG_VERSION else {}
+		except (OSError, ValueError):
+			entries = {}
+		with self.lock:
+			self.entries = entries
+			self.names = self.lines = self.fullListing = None
+
+	def save(self):
+		"""Write the catalog atomically so a crash never leaves a truncated file."""
+		# Another server in the same directory may be writing its own copy
+		tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+		try:
+			with open(tmp, 'w') as f:
+				json.dump({'version': CATALOG_VERSION, 'entries': self.entries}, f)
+			os.replace(tmp, self.path)
+		except OSError:
+			logger.warning("Unable to write catalog %s", self.path)
+
+	def refresh(self):
+		"""Stat every video file and probe only the new or changed ones. Return True if anything changed."""
+		# Probing takes a while; the entries being served stay untouched until the new ones are complete
+		entries = dict(self.entries)
+		changed = False
+		seen = set()
+		for entry in os.scandir(self.directory):
+			if not entry.is_file() or not entry.name.endswith(self.extensions):
+				continue
+			seen.add(entry.name)
+			st = entry.stat()
+			cached = entries.get(entry.name)
+			if cached and cached['size'] == st.st_size and cached['mtime'] == st.st_mtime:
+				continue
+			logger.info("Probing %s", entry.name)
+			try:
+				meta = probe(entry.path)
+			except IOError:
+				continue
+			meta['size'] = st.st_size
+			meta['mtime'] = st.st_mtime
+			entries[entry.name] = meta
+			changed = True
+
+		for name in list(entries):
+			if name not in seen:
+				del entries[name]
+				changed = True
+		if changed:
+			with self.lock:
+				self.entries = entries
+				self.names = self.lines = self.fullListing = None
+		return changed
+
+	def update(self):
+		"""Load the catalog, bring it up to date with the directory and persist it if needed."""
+		self.load()
+		if self.refresh():
+			self.save()
+		return self
+
+	def watch(self, interval=RESCAN_INTERVAL):
+		"""Rescan the directory every `interval` seconds in a daemon thread, so new files get listed.
+
+		One process per directory does this; the others follow() the catalog file it writes.
+		"""
+		threading.Thread(target=self.watchLoop, args=(interval,), daemon=True).start()
+
+	def follow(self, interval=RESCAN_INTERVAL):
+		"""Reload the catalog file every time the watching process has rewritten it, checking every `interval` seconds."""
+		threading.Thread(target=self.followLoop, args=(interval,), daemon=True).start()
+
+	def followLoop(self, interval):
+		version = self.fileVersion()
+		while True:
+			time.sleep(interval)
+			current = self.fileVersion()
+			if current != version:
+				version = current
+				self.load()
+				logger.info("Catalog reloaded, %d titles", len(self.entries))
+
+	def fileVersion(self):
+		"""Identify the catalog file as last written; every save replaces it with a new one."""
+		try:
+			st = os.stat(self.path)
+		except OSError:
+			return None
+		return (st.st_ino, st.st_mtime_ns)
+
+	def watchLoop(self, interval):
+		while True:
+			time.sleep(interval)
+			try:
+				if self.refresh():
+					logger.info("Catalog changed, %d titles", len(self.entries))
+					self.save()
+			except OSError:
+				logger.warning("Unable to scan %s", self.directory)
+
+	def listing(self, prefix='', offset=0, limit=None):
+		"""Return (number of titles starting with `prefix`, encoded listing of a page of them), and the page's titles.
+
+		Each line of the listing is "name<TAB>frames<TAB>fps<TAB>duration".
+		"""
+		with self.lock:
+			if self.names is None:
+				entries = sorted(self.entries.items())
+				self.names = [name for name, meta in entries]
+				self.lines = [listingLine(name, meta) for name, meta in entries]
+				self.fullListing = b'\r\n'.join(self.lines)
+			names, lines, fullListing = self.names, self.lines, self.fullListing
+
+		if not prefix and not offset and limit is None:
+			return (len(names), fullListing), names
+		# Titles are sorted, so the ones with a prefix form one contiguous run
+		lo = bisect.bisect_left(names, prefix)
+		hi = bisect.bisect_left(names, prefix + '\U0010ffff') if prefix else len(names)
+		start = min(lo + offset, hi)
+		end = hi if limit is None else min(start + limit, hi)
+		return (hi - lo, b'\r\n'.join(lines[start:end])), names[start:end]
+
+def listingLine(name, meta):
+	return '{}\t{}\t{:g}\t{:.2f}'.format(name, meta['frames'], meta['fps'], meta['duration']).encode()
+
+def probe(filename):
+	"""Read frame count, fps, resolution and duration of a video.
+
+	Container metadata is used when it carries a frame count; otherwise frames are
+	counted by ffmpeg without decoding, and a full decode is the last resort.
+	"""
+	try:
+		reader = imageio.get_reader(filename, 'ffmpeg')
+	except Exception:
+		raise IOError
+	try:
+		meta = reader.get_meta_data()
+		fps = meta.get('fps') or 25
+		width, height = meta.get('size', (0, 0))
+		duration = meta.get('duration') or 0
+
+		frameCnt = meta.get('nframes')
+		if not frameCnt or math.isinf(frameCnt):
+			try:
+				frameCnt = reader.count_frames()
+			except Exception:
+				frameCnt = decodeCount(reader)
+	finally:
+		reader.close()
+
+	if not duration:
+		duration = frameCnt / fps
+	return {
+		'frames': int(frameCnt),
+		'fps': fps,
+		'width': width,
+		'height': height,
+		'duration': duration,
+		'keyframes': probeKeyframes(filename, fps),
+	}
+
+def probeKeyframes(filename, fps):
+	"""Return the sorted frame indexes of the keyframes of a video, or None if they cannot be read.
+
+	ffmpeg is told to skip every non-key frame, so only keyframes get decoded.
+	"""
+	cmd = [imageio_ffmpeg.get_ffmpeg_exe(), '-hide_banner', '-nostats', '-skip_frame', 'nokey',
+		'-i', filename, '-map', '0:v:0', '-vf', 'showinfo', '-f', 'null', '-']
+	try:
+		output = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE).stderr
+	except OSError:
+		return None
+	times = [float(t) for t in PTS_TIME.findall(output)]
+	if not times:
+		return None
+	start = times[0]
+	return sorted(set(int(round((t - start) * fps)) for t in times))
+
+def decodeCount(reader):
+	"""Count frames by decoding every one of them."""
+	frameCnt = 0
+	while True:
+		try:
+			reader.get_next_data()
+			frameCnt += 1
+		except Exception:
+			break
+	return frameCnt
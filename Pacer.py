@@ -0,0 +1,60 @@
+import time
+
+class Pacer:
+	"""Frame pacing against absolute presentation deadlines.
+
+	Frame k after the first one is due at anchor + k / fps on the monotonic clock, so
+	processing time never accumulates into drift. When the sender falls more
+	than a frame behind, the frames it can no longer show in time are skipped.
+	"""
+
+	def __init__(self, fps):
+		self.interval = 1 / fps
+		self.frames = 0
+		self.dropped = 0
+		self.deadlineMisses = 0
+		self.jitterSum = 0.0
+		self.jitterMax = 0.0
+		self.restart()
+
+	def restart(self, now=None):
+		"""Anchor the schedule at `now`, when the first frame goes out. Metrics are kept for the whole session."""
+		self.anchor = time.monotonic() if now is None else now
+		self.count = 0
+
+	def deadline(self):
+		"""Return the monotonic time at which the next frame is due."""
+		return self.anchor + self.count * self.interval
+
+	def tick(self, now=None):
+		"""Account for the frame due now. Return how many frames to skip to get back on schedule."""
+		if now is None:
+			now = time.monotonic()
+		lateness = now - self.deadline()
+		jitter = abs(lateness)
+		self.jitterSum += jitter
+		self.jitterMax = max(self.jitterMax, jitter)
+		self.frames += 1
+
+		skipped = self.behind(now)
+		if skipped:
+			self.deadlineMisses += 1
+			self.dropped += skipped
+		self.count += 1 + skipped
+		return skipped
+
+	def behind(self, now=None):
+		"""Return how many frames tick() would skip at `now`, without accounting for a frame."""
+		if now is None:
+			now = time.monotonic()
+		lateness = now - self.deadline()
+		return int(lateness / self.interval) if lateness > self.interval else 0
+
+	def stats(self):
+		return {
+			'frames': self.frames,
+			'dropped': self.dropped,
+			'deadlineMisses': self.deadlineMisses,
+			'jitterMeanMs': 1000 * self.jitterSum / self.frames if self.frames else 0.0,
+			'jitterMaxMs': 1000 * self.jitterMax,
+		}
@@ -0,0 +1,88 @@
+import os, sys, threading, time, logging
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# Seconds between stack samples
+SAMPLE_INTERVAL = 0.005
+
+class SamplingProfiler:
+	"""Statistical profiler that periodically samples the stack of every server thread.
+
+	Threads tag themselves with the RTSP session they work for, and the
+	samples of each session are written as folded stacks (one
+	"frame;frame;frame count" line per distinct stack) to
+	<directory>/<session>.folded, ready for flamegraph.pl or speedscope.
+	Untagged threads, such as the asyncio event loop, go to server.folded.
+	"""
+
+	def __init__(self):
+		self.enabled = False
+		self.lock = threading.Lock()
+		self.labels = {}
+		self.samples = {}
+		self.directory = None
+		self.interval = SAMPLE_INTERVAL
+
+	def start(self, directory, interval=SAMPLE_INTERVAL):
+		self.directory = directory
+		self.interval = interval
+		os.makedirs(directory, exist_ok=True)
+		self.enabled = True
+		threading.Thread(target=self.run, daemon=True).start()
+		logger.info("Profiling every %.1f ms into %s", interval * 1000, directory)
+
+	def tagThread(self, label):
+		"""Attribute the samples of the calling thread to `label`."""
+		if self.enabled:
+			with self.lock:
+				self.labels[threading.get_ident()] = str(label)
+
+	def untagThread(self):
+		if self.enabled:
+			with self.lock:
+				self.labels.pop(threading.get_ident(), None)
+
+	def run(self):
+		me = threading.get_ident()
+		while True:
+			time.sleep(self.interval)
+			frames = sys._current_frames()
+			with self.lock:
+				for ident, frame in frames.items():
+					if ident == me:
+						continue
+					label = self.labels.get(ident, 'server')
+					self.samples.setdefault(label, Counter())[foldStack(frame)] += 1
+			del frames
+
+	def flush(self, label=None):
+		"""Append the samples of one label, or of all of them, to their folded-stack files."""
+		if not self.enabled:
+			return
+		with self.lock:
+			if label is None:
+				samples, self.samples = self.samples, {}
+			else:
+				label = str(label)
+				samples = {label: self.samples.pop(label)} if label in self.samples else {}
+		for name, stacks in samples.items():
+			path = os.path.join(self.directory, name + '.folded')
+			try:
+				with open(path, 'a') as f:
+					for stack, count in stacks.items():
+						f.write('{} {}\n'.format(stack, count))
+			except OSError:
+				logger.warning("Unable to write profile %s", path)
+
+def foldStack(frame):
+	"""Return the stack ending at `frame` as 'module:function' entries joined by ';', outermost first."""
+	names = []
+	while frame is not None:
+		code = frame.f_code
+		names.append('{}:{}'.format(os.path.splitext(os.path.basename(code.co_filename))[0], code.co_name))
+		frame = frame.f_back
+	return ';'.join(reversed(names))
+
+# Profiler of the current process, off unless the server runs with --profile
+profiler = SamplingProfiler()
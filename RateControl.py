@@ -0,0 +1,38 @@
+from VideoStream import RENDITIONS
+
+# Receiver-report thresholds for stepping down and back up the rendition ladder
+LOSS_HIGH = 0.10
+LOSS_SEVERE = 0.25
+LOSS_LOW = 0.02
+GOOD_REPORTS_TO_STEP_UP = 3
+
+class RateController:
+	"""Pick a rendition level for one session from the client's receiver reports.
+
+	Congestion steps the session down the ladder at once, while stepping back
+	up needs several clean reports in a row so the quality does not oscillate.
+	"""
+
+	def __init__(self, fps):
+		self.frameInterval = 1000 / fps
+		self.level = 0
+		self.goodReports = 0
+
+	def update(self, loss, jitterMs):
+		"""Account for one receiver report. Return the rendition level to use."""
+		congested = loss > LOSS_HIGH or jitterMs > 2 * self.frameInterval
+		if loss > LOSS_SEVERE:
+			self.level += 2
+			self.goodReports = 0
+		elif congested:
+			self.level += 1
+			self.goodReports = 0
+		elif loss < LOSS_LOW and jitterMs < self.frameInterval:
+			self.goodReports += 1
+			if self.goodReports >= GOOD_REPORTS_TO_STEP_UP:
+				self.level -= 1
+				self.goodReports = 0
+		else:
+			self.goodReports = 0
+		self.level = max(0, min(self.level, len(RENDITIONS) - 1))
+		return self.level
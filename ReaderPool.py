@@ -0,0 +1,204 @@
+import threading, time
+from collections import Counter
+import imageio
+
+# ffmpeg processes open at once in this server process, idle or in use
+MAX_READERS = 32
+# Idle readers kept per title
+MAX_IDLE_PER_TITLE = 2
+# Seconds an idle reader is kept before its ffmpeg process is stopped
+IDLE_TIMEOUT = 30.0
+# Most requested titles that always have a reader waiting at their first frame
+POPULAR_TITLES = 4
+# Seconds to wait for a free reader slot before giving up
+OPEN_TIMEOUT = 10.0
+
+def openReader(filename, keyframe=0, fps=25):
+	"""Open an ffmpeg reader whose next frame is `keyframe`."""
+	if keyframe == 0:
+		return imageio.get_reader(filename, 'ffmpeg')
+	# Without accurate seeking ffmpeg starts at the last keyframe before the
+	# requested time; aim half a frame past it to stay clear of rounding
+	start = (keyframe + 0.5) / fps
+	return imageio.get_reader(filename, 'ffmpeg', input_params=['-noaccurate_seek', '-ss', '%.6f' % start])
+
+class ReaderPool:
+	"""Bounded set of ffmpeg readers shared by every VideoStream of the process.
+
+	A stream that closes gives its reader back together with the index of
+	the frame it would decode next, so a later stream of the same title
+	that starts at or after that frame skips the ffmpeg start-up. The total
+	number of readers is capped: idle ones are evicted to make room, and
+	beyond that opening waits for a slot. Readers idle for too long are
+	stopped, and the most requested titles keep one reader pre-opened at
+	their first frame.
+	"""
+
+	def __init__(self, maxReaders=MAX_READERS, maxIdlePerTitle=MAX_IDLE_PER_TITLE,
+			idleTimeout=IDLE_TIMEOUT, popularTitles=POPULAR_TITLES):
+		self.maxReaders = maxReaders
+		self.maxIdlePerTitle = maxIdlePerTitle
+		self.idleTimeout = idleTimeout
+		self.popularTitles = popularTitles
+		self.cond = threading.Condition()
+		# filename -> list of (position, reader, idle since)
+		self.idle = {}
+		self.readers = 0
+		self.popularity = Counter()
+		self.warming = set()
+		self.reaper = None
+		self.opened = 0
+		self.reused = 0
+		self.evicted = 0
+
+	def open(self, filename, keyframe=0, fps=25, timeout=OPEN_TIMEOUT):
+		"""Open a reader at `keyframe` once the cap allows it.
+
+		Return None if no slot frees up within `timeout` seconds; raise IOError if ffmpeg fails to open the title.
+		"""
+		deadline = time.monotonic() + timeout
+		with self.cond:
+			while self.readers >= self.maxReaders:
+				victim = self.popOldestIdle()
+				if victim:
+					self.cond.release()
+					try:
+						victim.close()
+					finally:
+						self.cond.acquire()
+					continue
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					return None
+				self.cond.wait(remaining)
+			self.readers += 1
+			self.opened += 1
+			if self.reaper is None:
+				self.reaper = threading.Thread(target=self.reap, daemon=True)
+				self.reaper.start()
+		try:
+			return openReader(filename, keyframe, fps)
+		except Exception:
+			self.forget()
+			raise IOError("unable to open " + filename)
+
+	def acquire(self, filename, index):
+		"""Return (reader, position) of the idle reader closest before frame `index`, or (None, 0)."""
+		with self.cond:
+			self.popularity[filename] += 1
+			reader, position = None, 0
+			readers = self.idle.get(filename)
+			if readers:
+				best = None
+				for i, entry in enumerate(readers):
+					if entry[0] <= index and (best is None or entry[0] > readers[best][0]):
+						best = i
+				if best is not None:
+					position, reader, since = readers.pop(best)
+					self.reused += 1
+			warm = self.needsWarmReader(filename)
+		if warm:
+			threading.Thread(target=self.warm, args=(filename,), daemon=True).start()
+		return reader, position
+
+	def release(self, filename, reader, position):
+		"""Keep a reader for later streams, or close it when the title already has enough idle ones."""
+		with self.cond:
+			readers = self.idle.setdefault(filename, [])
+			if len(readers) < self.maxIdlePerTitle:
+				readers.append((position, reader, time.monotonic()))
+				return
+		self.discard(reader)
+
+	def discard(self, reader):
+		"""Close a reader that is not coming back to the pool."""
+		try:
+			reader.close()
+		finally:
+			self.forget()
+
+	def forget(self):
+		with self.cond:
+			self.readers -= 1
+			self.cond.notify()
+
+	def popOldestIdle(self):
+		"""Take the longest idle reader out of the pool; the caller holds the lock and closes it."""
+		oldest = None
+		for filename, readers in self.idle.items():
+			for i, entry in enumerate(readers):
+				if oldest is None or entry[2] < oldest[2]:
+					oldest = (filename, i, entry[2])
+		if oldest is None:
+			return None
+		filename, i, since = oldest
+		self.readers -= 1
+		self.evicted += 1
+		return self.idle[filename].pop(i)[1]
+
+	def needsWarmReader(self, filename):
+		"""True if a popular title has no idle reader at its first frame and there is room to open one."""
+		if filename in self.warming or self.readers >= self.maxReaders:
+			return False
+		if filename not in dict(self.popularity.most_common(self.popularTitles)):
+			return False
+		if any(entry[0] == 0 for entry in self.idle.get(filename, ())):
+			return False
+		self.warming.add(filename)
+		return True
+
+	def warm(self, filename):
+		try:
+			reader = self.open(filename, timeout=0)
+			if reader:
+				self.release(filename, reader, 0)
+		except IOError:
+			pass
+		finally:
+			with self.cond:
+				self.warming.discard(filename)
+
+	def reap(self):
+		"""Stop readers idle for longer than idleTimeout, and let title popularity fade."""
+		while True:
+			time.sleep(self.idleTimeout / 2)
+			now = time.monotonic()
+			victims = []
+			with self.cond:
+				popular = dict(self.popularity.most_common(self.popularTitles))
+				for filename, readers in self.idle.items():
+					for entry in list(readers):
+						# The pre-opened reader of a popular title stays
+						if entry[0] == 0 and filename in popular:
+							continue
+						if now - entry[2] > self.idleTimeout:
+							readers.remove(entry)
+							victims.append(entry[1])
+				for filename in list(self.popularity):
+					self.popularity[filename] //= 2
+					if not self.popularity[filename]:
+						del self.popularity[filename]
+			for reader in victims:
+				self.evicted += 1
+				self.discard(reader)
+
+	def stats(self):
+		with self.cond:
+			return {
+				'readers': self.readers,
+				'idle': sum(len(readers) for readers in self.idle.values()),
+				'maxReaders': self.maxReaders,
+				'opened': self.opened,
+				'reused': self.reused,
+				'evicted': self.evicted,
+			}
+
+	def close(self):
+		with self.cond:
+			idle, self.idle = self.idle, {}
+		for readers in idle.values():
+			for position, reader, since in readers:
+				self.discard(reader)
+
+# Readers shared by every stream of the current process
+readerPool = ReaderPool()
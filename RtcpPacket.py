@@ -0,0 +1,209 @@
+import struct, time
+
+SR = 200
+RR = 201
+# Transport-layer feedback (RFC 4585); format 1 is the generic NACK
+RTPFB = 205
+NACK_FMT = 1
+
+# Seconds a missing packet is asked for, and between two requests for the same packet
+NACK_DEADLINE = 0.15
+NACK_RETRY = 0.05
+# Seconds before the first request when FEC may repair the packet first
+NACK_FEC_DELAY = 0.02
+
+# Seconds between the NTP epoch (1900) and the Unix epoch (1970)
+NTP_OFFSET = 2208988800
+
+# V/P/RC, PT, length in 32-bit words minus one, sender SSRC
+COMMON_HEADER = struct.Struct('!BBHI')
+# NTP timestamp (msw, lsw), RTP timestamp, sender's packet count, sender's octet count
+SENDER_INFO = struct.Struct('!IIIII')
+# SSRC, fraction lost and cumulative lost, extended highest sequence number, jitter, LSR, DLSR
+REPORT_BLOCK = struct.Struct('!IIIIII')
+# Media source SSRC of a feedback message, then per NACK item a packet id and a bitmask of the 16 following
+MEDIA_SSRC = struct.Struct('!I')
+NACK_ITEM = struct.Struct('!HH')
+
+def ntpTime(now=None):
+    """Return the 64-bit NTP timestamp of a Unix time as (msw, lsw)."""
+    if now is None:
+        now = time.time()
+    seconds = now + NTP_OFFSET
+    return int(seconds) & 0xFFFFFFFF, int((seconds % 1) * (1 << 32)) & 0xFFFFFFFF
+
+def ntpMiddle(msw, lsw):
+    """Return the middle 32 bits of an NTP timestamp, the unit of LSR/DLSR arithmetic (1/65536 s)."""
+    return ((msw & 0xFFFF) << 16) | (lsw >> 16)
+
+def makeSenderReport(ssrc, rtpTimestamp, packetCount, octetCount, now=None):
+    """Build an RTCP SR packet without report blocks."""
+    msw, lsw = ntpTime(now)
+    length = (COMMON_HEADER.size + SENDER_INFO.size) // 4 - 1
+    return COMMON_HEADER.pack(0x80, SR, length, ssrc) + \
+        SENDER_INFO.pack(msw, lsw, rtpTimestamp & 0xFFFFFFFF, packetCount & 0xFFFFFFFF, octetCount & 0xFFFFFFFF)
+
+def makeReceiverReport(ssrc, sourceSsrc, fractionLost, cumulativeLost, highestSeq, jitter, lsr, dlsr):
+    """Build an RTCP RR packet with one report block about sourceSsrc."""
+    length = (COMMON_HEADER.size + REPORT_BLOCK.size) // 4 - 1
+    # Cumulative loss is a signed 24-bit field
+    cumulativeLost = max(-0x800000, min(cumulativeLost, 0x7FFFFF)) & 0xFFFFFF
+    return COMMON_HEADER.pack(0x81, RR, length, ssrc) + \
+        REPORT_BLOCK.pack(sourceSsrc, (fractionLost & 0xFF) << 24 | cumulativeLost, highestSeq & 0xFFFFFFFF,
+            int(jitter) & 0xFFFFFFFF, lsr & 0xFFFFFFFF, dlsr & 0xFFFFFFFF)
+
+def makeNack(ssrc, mediaSsrc, seqnums):
+    """Build an RTCP generic NACK asking mediaSsrc to resend the packets `seqnums`."""
+    items = []
+    for seqnum in sorted(seqnums):
+        # A packet within 16 of the last item's id only sets a bit of its mask
+        if items and 0 < (seqnum - items[-1][0]) & 0xFFFF <= 16:
+            items[-1][1] |= 1 << ((seqnum - items[-1][0]) & 0xFFFF) - 1
+        else:
+            items.append([seqnum, 0])
+    length = (COMMON_HEADER.size + MEDIA_SSRC.size + NACK_ITEM.size * len(items)) // 4 - 1
+    return COMMON_HEADER.pack(0x80 | NACK_FMT, RTPFB, length, ssrc) + MEDIA_SSRC.pack(mediaSsrc) + \
+        b''.join(NACK_ITEM.pack(pid, mask) for pid, mask in items)
+
+def parse(data):
+    """Parse a compound RTCP packet. Return a list of dicts, one per SR, RR or generic NACK; other types are skipped."""
+    reports = []
+    offset = 0
+    while offset + COMMON_HEADER.size <= len(data):
+        first, pt, length, ssrc = COMMON_HEADER.unpack_from(data, offset)
+        end = offset + 4 * (length + 1)
+        if first >> 6 != 2 or end > len(data):
+            break
+        count = first & 0x1F
+        report = {'type': pt, 'ssrc': ssrc, 'blocks': []}
+        pos = offset + COMMON_HEADER.size
+        if pt == SR:
+            msw, lsw, rtpTimestamp, packets, octets = SENDER_INFO.unpack_from(data, pos)
+            report.update(ntp=(msw, lsw), rtpTimestamp=rtpTimestamp, packetCount=packets, octetCount=octets)
+            pos += SENDER_INFO.size
+        if pt in (SR, RR):
+            for _ in range(count):
+                if pos + REPORT_BLOCK.size > end:
+                    break
+                source, loss, highest, jitter, lsr, dlsr = REPORT_BLOCK.unpack_from(data, pos)
+                cumulative = loss & 0xFFFFFF
+                if cumulative & 0x800000:
+                    cumulative -= 0x1000000
+                report['blocks'].append({'ssrc': source, 'fractionLost': loss >> 24, 'cumulativeLost': cumulative,
+                    'highestSeq': highest, 'jitter': jitter, 'lsr': lsr, 'dlsr': dlsr})
+                pos += REPORT_BLOCK.size
+            reports.append(report)
+        elif pt == RTPFB and count == NACK_FMT and pos + MEDIA_SSRC.size <= end:
+            report['mediaSsrc'] = MEDIA_SSRC.unpack_from(data, pos)[0]
+            lost = report['lost'] = []
+            for pos in range(pos + MEDIA_SSRC.size, end - NACK_ITEM.size + 1, NACK_ITEM.size):
+                pid, mask = NACK_ITEM.unpack_from(data, pos)
+                lost.append(pid)
+                lost.extend((pid + bit + 1) & 0xFFFF for bit in range(16) if mask & (1 << bit))
+            reports.append(report)
+        offset = end
+    return reports
+
+class ReceptionStats:
+    """Per-source reception statistics of RFC 3550, appendix A.1 and A.3."""
+
+    def __init__(self):
+        self.baseSeq = None
+        self.maxSeq = 0
+        self.cycles = 0
+        self.received = 0
+        self.expectedPrior = 0
+        self.receivedPrior = 0
+
+    def update(self, seq):
+        if self.baseSeq is None:
+            self.baseSeq = self.maxSeq = seq
+        elif (seq - self.maxSeq) & 0xFFFF < 0x8000:
+            # In order, possibly with a gap; a smaller value means the sequence wrapped
+            if seq < self.maxSeq:
+                self.cycles += 0x10000
+            self.maxSeq = seq
+        self.received += 1
+
+    def extendedMax(self):
+        return self.cycles + self.maxSeq
+
+    def expected(self):
+        if self.baseSeq is None:
+            return 0
+        return self.extendedMax() - self.baseSeq + 1
+
+    def cumulativeLost(self):
+        return self.expected() - self.received
+
+    def fractionLost(self):
+        """Return the fraction lost since the previous call, in 1/256 units."""
+        expected = self.expected()
+        expectedInterval = expected - self.expectedPrior
+        receivedInterval = self.received - self.receivedPrior
+        self.expectedPrior = expected
+        self.receivedPrior = self.received
+        lostInterval = expectedInterval - receivedInterval
+        if expectedInterval <= 0 or lostInterval <= 0:
+            return 0
+        return min((lostInterval << 8) // expectedInterval, 255)
+
+class MissingPackets:
+    """Sequence gaps of one source still worth asking the sender to fill with generic NACKs.
+
+    A packet is asked for `delay` seconds after a later one shows it
+    missing, again every `retry` seconds while it stays missing, and given
+    up once the jitter buffer would have played its frame without it.
+    Only a packet that arrives after it was asked for counts as repaired;
+    one that was merely reordered or that FEC rebuilt does not.
+    """
+
+    def __init__(self, deadline=NACK_DEADLINE, retry=NACK_RETRY, delay=0.0, maxGap=256):
+        self.deadline = deadline
+        self.retry = retry
+        self.delay = delay
+        self.maxGap = maxGap
+        self.highest = None
+        # Sequence number -> (time it was found missing, time it was last asked for or None)
+        self.missing = {}
+        self.requested = 0
+        self.repaired = 0
+        self.abandoned = 0
+
+    def update(self, seq, now=None, recovered=False):
+        """Note a packet received, or `recovered` by FEC."""
+        if now is None:
+            now = time.monotonic()
+        if self.highest is None:
+            self.highest = seq
+            return
+        delta = (seq - self.highest) & 0xFFFF
+        if 0 < delta < 0x8000:
+            # Larger gaps mean a new stream, not loss worth repairing
+            if delta <= self.maxGap:
+                for missing in range(self.highest + 1, self.highest + delta):
+                    self.missing[missing & 0xFFFF] = (now, None)
+            self.highest = seq
+        else:
+            entry = self.missing.pop(seq, None)
+            if entry and entry[1] is not None and not recovered:
+                self.repaired += 1
+
+    def due(self, now=None):
+        """Return the missing sequence numbers to ask for now, forgetting those past their deadline."""
+        if now is None:
+            now = time.monotonic()
+        seqnums = []
+        for seq, (since, asked) in list(self.missing.items()):
+            if now - since > self.deadline:
+                del self.missing[seq]
+                self.abandoned += 1
+            elif now - since >= self.delay if asked is None else now - asked >= self.retry:
+                self.missing[seq] = (since, now)
+                seqnums.append(seq)
+        self.requested += len(seqnums)
+        return seqnums
+
+    def reset(self):
+        self.highest = None
+        self.missing.clear()
@@ -0,0 +1,66 @@
+import sys, time, socket
+
+from RtpPacket import RtpPacket, JpegPacketizer, MAX_FRAGMENT_SIZE
+
+FRAME_SIZE = 64 * 1024
+
+def drain(sock):
+    try:
+        while True:
+            sock.recv(65536)
+    except BlockingIOError:
+        pass
+
+def benchCopy(frame, count, tx, rx, addr):
+    """Packetize with RtpPacket.encode/getPacket and sendto: one fresh packet copy per fragment."""
+    sent = 0
+    start = time.perf_counter()
+    while sent < count:
+        for offset in range(0, len(frame), MAX_FRAGMENT_SIZE):
+            fragment = frame[offset : offset + MAX_FRAGMENT_SIZE]
+            rtpPacket = RtpPacket()
+            rtpPacket.encode(2, 0, 1, 0, sent, 0, 26, 0, fragment, 0, 2, frameCnt=sent, frameNbr=sent, fragmentOffset=offset)
+            tx.sendto(rtpPacket.getPacket(), addr)
+            sent += 1
+        drain(rx)
+    return sent / (time.perf_counter() - start)
+
+def benchZeroCopy(frame, count, tx, rx, addr):
+    """Packetize with JpegPacketizer and sendmsg: reused header buffer, payload never copied."""
+    packetizer = JpegPacketizer()
+    sent = 0
+    start = time.perf_counter()
+    while sent < count:
+        for packet in packetizer.packets(frame, sent, sent):
+            tx.sendmsg(packet, [], 0, addr)
+            sent += 1
+        drain(rx)
+    return sent / (time.perf_counter() - start)
+
+def benchDecode(count):
+    """Decode a full-size packet and read its fields."""
+    packetizer = JpegPacketizer()
+    header, fragment = next(packetizer.packets(bytes(MAX_FRAGMENT_SIZE), 1, 1))
+    datagram = bytes(header) + bytes(fragment)
+    start = time.perf_counter()
+    for _ in range(count):
+        rtpPacket = RtpPacket()
+        rtpPacket.decode(datagram)
+        rtpPacket.seqNum()
+        rtpPacket.getFrameNbr()
+        rtpPacket.fragmentOffset()
+        rtpPacket.getPayload()
+    return count / (time.perf_counter() - start)
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rx.bind(('127.0.0.1', 0))
+    rx.setblocking(False)
+    tx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    addr = rx.getsockname()
+    frame = bytes(FRAME_SIZE)
+
+    print("encode + sendto (copy):     {:10.0f} packets/s".format(benchCopy(frame, count, tx, rx, addr)))
+    print("pack_into + sendmsg:        {:10.0f} packets/s".format(benchZeroCopy(frame, count, tx, rx, addr)))
+    print("decode:                     {:10.0f} packets/s".format(benchDecode(count)))
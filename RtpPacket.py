@@ -1,50 +1,74 @@
-import sys
+import sys, struct
 from time import time
+from collections import OrderedDict
 
 HEADER_SIZE = 12
+JPEG_HEADER_SIZE = 8
+
+# Largest JPEG fragment per packet, so that a packet with all headers fits a 1500-byte MTU
+MAX_FRAGMENT_SIZE = 1400
+
+# RFC 2435 leaves JPEG types 128-255 to the session; type 128 carries complete JFIF images
+JPEG_TYPE = 128
+JPEG_QUALITY = 75
+
+# RTP clock rate of video payloads (RFC 3551)
+CLOCK_RATE = 90000
+
+# V/P/X/CC, M/PT, sequence number, timestamp, SSRC
+RTP_HEADER = struct.Struct('!BBHII')
+# Extension id and length, then one 32-bit word each for frame count and frame number
+EXTENSION_HEADER = struct.Struct('!HH')
+EXTENSION_WORD = struct.Struct('!I')
+# Type-specific and fragment offset, type, Q, width/8, height/8
+JPEG_HEADER = struct.Struct('!IBBBB')
+# Every header of an MJPEG packet sent by the server, packed in one call
+MJPEG_HEADERS = struct.Struct('!BBHIIHHIIIBBBB')
 
 class RtpPacket:
-    
+
     def encode(self, version, padding, extension, cc, seqnum, marker, pt, ssrc, payload, extid=0, extlen=0, *args, **kwargs):
-        timestamp = int(time())
-        self.header = bytearray(HEADER_SIZE)
-        self.header[0] = (version << 6) | (padding << 5) | (extension << 4) | cc
-        self.header[1] = (marker << 7) | pt
-        self.header[2] = seqnum >> 8
-        self.header[3] = seqnum & 255
-        self.header[4] = timestamp >> 24
-        self.header[5] = timestamp >> 16 & 255
-        self.header[6] = timestamp >> 8 & 255
-        self.header[7] = timestamp & 255
-        self.header[8] = ssrc >> 24
-        self.header[9] = ssrc >> 16 & 255
-        self.header[10] = ssrc >> 8 & 255
-        self.header[11] = ssrc & 255
+        timestamp = kwargs.get('timestamp', mediaClock()) & 0xFFFFFFFF
+        self.header = bytearray(RTP_HEADER.pack((version << 6) | (padding << 5) | (extension << 4) | cc,
+            (marker << 7) | pt, seqnum & 0xFFFF, timestamp, ssrc))
         self.extensionHeader = bytearray(4*(extlen + 1))
-        self.extensionHeader[0] = extid >> 8
-        self.extensionHeader[1] = extid & 255
-        self.extensionHeader[2] = extlen >> 8
-        self.extensionHeader[3] = extlen & 255
-        self.extensionHeader[4] = kwargs['frameCnt'] >> 24
-        self.extensionHeader[5] = kwargs['frameCnt'] >> 16 & 255
-        self.extensionHeader[6] = kwargs['frameCnt'] >> 8 & 255
-        self.extensionHeader[7] = kwargs['frameCnt'] & 255
+        EXTENSION_HEADER.pack_into(self.extensionHeader, 0, extid, extlen)
+        EXTENSION_WORD.pack_into(self.extensionHeader, 4, kwargs['frameCnt'])
+        if extlen > 1:
+            EXTENSION_WORD.pack_into(self.extensionHeader, 8, kwargs.get('frameNbr', 0))
+        self.jpegHeader = bytearray(0)
+        if pt == 26:
+            self.jpegHeader = bytearray(JPEG_HEADER.pack(kwargs.get('fragmentOffset', 0), JPEG_TYPE, JPEG_QUALITY,
+                min(kwargs.get('width', 0) // 8, 255), min(kwargs.get('height', 0) // 8, 255)))
         self.payload = payload
-    
+
     def decode(self, byteStream):
-        self.header = bytearray(byteStream[:HEADER_SIZE])
-        extlen = int(byteStream[HEADER_SIZE + 2] << 8 | byteStream[HEADER_SIZE + 3])
-        self.extensionHeader = bytearray(byteStream[HEADER_SIZE : (HEADER_SIZE + 4*(extlen + 1))])
-        self.payload = byteStream[(HEADER_SIZE + 4*(extlen + 1)):]
-    
+        """Decode a datagram. Headers and payload are views into byteStream, nothing is copied."""
+        view = memoryview(byteStream)
+        extlen = EXTENSION_HEADER.unpack_from(view, HEADER_SIZE)[1]
+        start = HEADER_SIZE + 4*(extlen + 1)
+        self.header = view[:HEADER_SIZE]
+        self.extensionHeader = view[HEADER_SIZE : start]
+        self.jpegHeader = view[start : start]
+        if view[1] & 127 == 26:
+            self.jpegHeader = view[start : start + JPEG_HEADER_SIZE]
+            start += JPEG_HEADER_SIZE
+        self.payload = view[start:]
+
     def version(self):
         return int(self.header[0] >> 6)
-    
+
     def seqNum(self):
         return int(self.header[2] << 8 | self.header[3])
-    
+
     def timestamp(self):
-        return int(self.header[4] << 24 | self.header[5] << 16 | self.header[6] << 8 | self.header[7])
+        return RTP_HEADER.unpack_from(self.header, 0)[3]
+
+    def ssrc(self):
+        return RTP_HEADER.unpack_from(self.header, 0)[4]
+
+    def marker(self):
+        return int(self.header[1] >> 7)
 
     def payloadType(self):
         return int(self.header[1] & 127)
@@ -53,7 +77,104 @@ class RtpPacket:
         return self.payload
 
     def getFrameCnt(self):
-        return int(self.extensionHeader[4] << 24 | self.extensionHeader[5] << 16 | self.extensionHeader[6] << 8 | self.extensionHeader[7])
-    
+        return EXTENSION_WORD.unpack_from(self.extensionHeader, 4)[0]
+
+    def getFrameNbr(self):
+        """Return the frame number carried in the extension, or the sequence number for older senders."""
+        if len(self.extensionHeader) < 12:
+            return self.seqNum()
+        return EXTENSION_WORD.unpack_from(self.extensionHeader, 8)[0]
+
+    def fragmentOffset(self):
+        if not self.jpegHeader:
+            return 0
+        return JPEG_HEADER.unpack_from(self.jpegHeader, 0)[0] & 0xFFFFFF
+
     def getPacket(self):
-        return self.header + self.extensionHeader + self.payload
+        return bytes(self.header) + bytes(self.extensionHeader) + bytes(self.jpegHeader) + bytes(self.payload)
+
+class JpegPacketizer:
+    """Split JPEG frames into RTP packets without copying the frame.
+
+    Every packet is yielded as [header, fragment]: the headers are packed into
+    one reusable buffer and the fragment is a memoryview of the frame, ready
+    for socket.sendmsg. The header buffer is overwritten by the next packet.
+    """
+
+    def __init__(self, seqnum=0, ssrc=0, maxFragment=MAX_FRAGMENT_SIZE):
+        self.seqnum = seqnum
+        self.ssrc = ssrc
+        self.maxFragment = maxFragment
+        self.header = bytearray(MJPEG_HEADERS.size)
+
+    def packets(self, payload, frameCnt, frameNbr, timestamp=None):
+        view = memoryview(payload)
+        width, height = jpegSize(view)
+        width = min(width // 8, 255)
+        height = min(height // 8, 255)
+        if timestamp is None:
+            timestamp = mediaClock()
+        timestamp &= 0xFFFFFFFF
+        size = len(view)
+        for offset in range(0, size, self.maxFragment):
+            end = min(offset + self.maxFragment, size)
+            # V=2, X=1; the marker bit flags the last fragment of the frame
+            MJPEG_HEADERS.pack_into(self.header, 0, 0x90, (end == size) << 7 | 26, self.seqnum, timestamp, self.ssrc,
+                0, 2, frameCnt, frameNbr, offset, JPEG_TYPE, JPEG_QUALITY, width, height)
+            self.seqnum = (self.seqnum + 1) & 0xFFFF
+            yield [self.header, view[offset:end]]
+
+def mediaClock():
+    """Return the current wall-clock time in units of the 90 kHz RTP video clock."""
+    return int(time() * CLOCK_RATE)
+
+def jpegSize(data):
+    """Return (width, height) of a JPEG image from its SOF marker, or (0, 0) if there is none."""
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            break
+        marker = data[i + 1]
+        length = data[i + 2] << 8 | data[i + 3]
+        # SOF0-SOF15, except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            return (data[i + 7] << 8 | data[i + 8], data[i + 5] << 8 | data[i + 6])
+        i += 2 + length
+    return (0, 0)
+
+class FrameAssembler:
+    """Reassemble JPEG frames from RFC 2435 fragments that may arrive out of order."""
+
+    def __init__(self, maxPending=4):
+        self.maxPending = maxPending
+        self.pending = OrderedDict()
+
+    def push(self, rtpPacket):
+        """Add a decoded packet. Return the frame as a bytearray once all its fragments are in, else None."""
+        frameNbr = rtpPacket.getFrameNbr()
+        frame = self.pending.get(frameNbr)
+        if frame is None:
+            frame = self.pending[frameNbr] = {'fragments': {}, 'received': 0, 'size': None}
+            # Give up on the oldest incomplete frames
+            while len(self.pending) > self.maxPending:
+                self.pending.popitem(last=False)
+
+        payload = rtpPacket.getPayload()
+        offset = rtpPacket.fragmentOffset()
+        if offset in frame['fragments']:
+            return None
+        frame['fragments'][offset] = payload
+        frame['received'] += len(payload)
+        if rtpPacket.marker():
+            frame['size'] = offset + len(payload)
+
+        if frame['size'] is None or frame['received'] < frame['size']:
+            return None
+        del self.pending[frameNbr]
+        data = bytearray(frame['size'])
+        for offset, payload in frame['fragments'].items():
+            data[offset : offset + len(payload)] = payload
+        return data
+
+    def reset(self):
+        self.pending.clear()
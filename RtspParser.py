@@ -0,0 +1,162 @@
+import re, struct
+
+# Largest header block accepted before the connection is considered broken
+MAX_HEADER_BYTES = 64 * 1024
+
+HEADER_END = re.compile(rb'\r?\n\r?\n')
+
+# '$', channel, length: the framing of RTP and RTCP interleaved on the RTSP connection (RFC 2326, 10.12)
+INTERLEAVED_HEADER = struct.Struct('!BBH')
+INTERLEAVED_MAGIC = 0x24
+
+class RtspMessage:
+    """One RTSP request or reply: the start line, the headers and the body."""
+
+    def __init__(self, startLine, headers, body=b''):
+        self.startLine = startLine
+        self.headers = headers
+        self.body = body
+        parts = startLine.split(' ', 2)
+        # Requests are "METHOD uri RTSP/1.0", replies are "RTSP/1.0 code reason"
+        self.isReply = parts[0].startswith('RTSP/')
+        if self.isReply:
+            self.method = ''
+            self.uri = ''
+            self.status = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
+        else:
+            self.method = parts[0]
+            self.uri = parts[1] if len(parts) > 2 else '*'
+            self.status = 0
+
+    def header(self, name, default=None):
+        """Return the value of a header; names are case-insensitive."""
+        return self.headers.get(name.lower(), default)
+
+    def cseq(self):
+        try:
+            return int(self.header('CSeq', -1))
+        except ValueError:
+            return -1
+
+class InterleavedFrame:
+    """One RTP or RTCP packet carried on the RTSP connection, and the channel it came on."""
+
+    def __init__(self, channel, data):
+        self.channel = channel
+        self.data = data
+
+class RtspParser:
+    """Incremental RTSP framer.
+
+    Bytes are fed as they arrive from the socket; complete messages are cut
+    at the blank line that ends the headers (CRLF CRLF, or LF LF from older
+    peers) plus Content-Length bytes of body. Pipelined messages that share
+    a read come out in order, and a message split across reads is held until
+    the rest arrives. Packets interleaved between messages with a '$' header
+    come out as InterleavedFrame objects.
+    """
+
+    def __init__(self, maxHeaderBytes=MAX_HEADER_BYTES):
+        self.buffer = bytearray()
+        self.maxHeaderBytes = maxHeaderBytes
+        # Where the search for the end of the headers resumes, so bytes are scanned once
+        self.scanFrom = 0
+        # Header block and body length of a message waiting for its body
+        self.pending = None
+
+    def feed(self, data):
+        """Add received bytes. Return the list of messages and interleaved frames they completed."""
+        self.buffer += data
+        messages = []
+        while True:
+            message = self.next()
+            if message is None:
+                return messages
+            messages.append(message)
+
+    def next(self):
+        while self.pending is None:
+            if self.buffer[:1] == b'$':
+                return self.nextFrame()
+            match = HEADER_END.search(self.buffer, self.scanFrom)
+            if match is None:
+                if len(self.buffer) > self.maxHeaderBytes:
+                    raise ValueError("RTSP header block too large")
+                # The terminator may straddle the next read
+                self.scanFrom = max(0, len(self.buffer) - 3)
+                return None
+            head = self.buffer[:match.start()]
+            del self.buffer[:match.end()]
+            self.scanFrom = 0
+            # Blank lines between messages are skipped
+            if head.strip():
+                self.pending = self.parseHead(head.decode('utf-8', 'replace'))
+
+        startLine, headers, length = self.pending
+        if len(self.buffer) < length:
+            return None
+        body = bytes(self.buffer[:length])
+        del self.buffer[:length]
+        self.pending = None
+        return RtspMessage(startLine, headers, body)
+
+    def nextFrame(self):
+        if len(self.buffer) < INTERLEAVED_HEADER.size:
+            return None
+        magic, channel, length = INTERLEAVED_HEADER.unpack_from(self.buffer, 0)
+        end = INTERLEAVED_HEADER.size + length
+        if len(self.buffer) < end:
+            return None
+        data = bytes(self.buffer[INTERLEAVED_HEADER.size : end])
+        del self.buffer[:end]
+        self.scanFrom = 0
+        return InterleavedFrame(channel, data)
+
+    def parseHead(self, head):
+        lines = head.lstrip('\r\n').splitlines()
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        try:
+            length = max(0, int(headers.get('content-length', 0)))
+        except ValueError:
+            length = 0
+        return lines[0].strip(), headers, length
+
+def parseTransport(value):
+    """Split a Transport header into its parameters; flags such as 'multicast' map to ''."""
+    params = {}
+    for part in value.split(';'):
+        name, sep, arg = part.strip().partition('=')
+        if name:
+            params[name.lower()] = arg.strip()
+    return params
+
+def parseInterleaved(transport):
+    """Return the (RTP, RTCP) channels of an "RTP/AVP/TCP;interleaved=0-1" Transport header, or None for UDP."""
+    params = parseTransport(transport)
+    if 'rtp/avp/tcp' not in params:
+        return None
+    channels = params.get('interleaved', '0-1').split('-')
+    try:
+        rtp = int(channels[0])
+        rtcp = int(channels[1]) if len(channels) > 1 else rtp + 1
+    except ValueError:
+        return None
+    return rtp, rtcp
+
+def formatInterleaved(channel, data):
+    """Frame a packet for the RTSP connection."""
+    return INTERLEAVED_HEADER.pack(INTERLEAVED_MAGIC, channel, len(data)) + bytes(data)
+
+def formatMessage(startLine, headers, body=b''):
+    """Serialize a message with CRLF line endings; a body gets its Content-Length."""
+    if isinstance(body, str):
+        body = body.encode()
+    lines = [startLine]
+    lines.extend('{}: {}'.format(name, value) for name, value in headers)
+    if body:
+        lines.append('Content-Length: {}'.format(len(body)))
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode() + body
@@ -0,0 +1,58 @@
+import time
+
+# Packets kept per session for retransmission; a power of two
+HISTORY_SIZE = 1024
+# Seconds after it was sent that a packet is still worth resending; the client has played its frame by then
+RETRANSMIT_DEADLINE = 0.2
+
+class SendHistory:
+	"""Ring of the RTP packets recently sent to one client, indexed by sequence number.
+
+	A slot holds a copy of the packet's header and the fragment as sent, a
+	view into the frame payload held by the frame cache or the frame store,
+	so the history shares the payloads rather than copying them. Clearing
+	it drops those references, so the stream can release its store.
+	"""
+
+	def __init__(self, size=HISTORY_SIZE, deadline=RETRANSMIT_DEADLINE):
+		self.slots = [None] * size
+		self.mask = size - 1
+		self.deadline = deadline
+		self.resent = 0
+		self.tooLate = 0
+		self.unknown = 0
+
+	def add(self, packets, now=None):
+		"""Remember packets given as (header bytes, fragment)."""
+		if now is None:
+			now = time.monotonic()
+		for header, fragment in packets:
+			seqnum = header[2] << 8 | header[3]
+			self.slots[seqnum & self.mask] = (seqnum, header, fragment, now)
+
+	def lookup(self, seqnums, delay=0.0, now=None):
+		"""Return the packets, as [header, fragment], to resend for the sequence numbers a client asked for.
+
+		Packets that would reach the client, `delay` seconds from now, after
+		the deadline are not worth the bandwidth and are left out, as are
+		those no longer in the ring.
+		"""
+		if now is None:
+			now = time.monotonic()
+		packets = []
+		for seqnum in seqnums:
+			slot = self.slots[seqnum & self.mask]
+			if slot is None or slot[0] != seqnum:
+				self.unknown += 1
+			elif now + delay - slot[3] > self.deadline:
+				self.tooLate += 1
+			else:
+				packets.append([slot[1], slot[2]])
+				self.resent += 1
+		return packets
+
+	def clear(self):
+		self.slots = [None] * len(self.slots)
+
+	def stats(self):
+		return {'retransmitted': self.resent, 'retransmitTooLate': self.tooLate, 'retransmitUnknown': self.unknown}
@@ -0,0 +1,302 @@
+import socket, struct, threading, itertools, heapq, time, errno, ctypes, logging
+
+logger = logging.getLogger(__name__)
+
+# Sessions due within this many seconds of each other go out in the same batch
+GROUP_SLACK = 0.002
+# Seconds before a session whose frame is still being encoded is looked at again
+RETRY_DELAY = 0.005
+# Datagrams per sendmmsg call
+MAX_BATCH = 1024
+SEND_BUFFER = 4 * 1024 * 1024
+
+class IoVec(ctypes.Structure):
+	_fields_ = [('base', ctypes.c_void_p), ('length', ctypes.c_size_t)]
+
+class MsgHdr(ctypes.Structure):
+	_fields_ = [('name', ctypes.c_void_p), ('namelen', ctypes.c_uint32),
+		('iov', ctypes.POINTER(IoVec)), ('iovlen', ctypes.c_size_t),
+		('control', ctypes.c_void_p), ('controllen', ctypes.c_size_t), ('flags', ctypes.c_int)]
+
+class MMsgHdr(ctypes.Structure):
+	_fields_ = [('hdr', MsgHdr), ('len', ctypes.c_uint)]
+
+def bufferAddress(buffer):
+	"""Return (address, keepalive) of a bytes object or a writable buffer, without copying it."""
+	if isinstance(buffer, bytes):
+		keep = ctypes.c_char_p(buffer)
+		return ctypes.cast(keep, ctypes.c_void_p).value, keep
+	keep = (ctypes.c_char * len(buffer)).from_buffer(buffer)
+	return ctypes.addressof(keep), keep
+
+class SendBatch:
+	"""RTP packets of every session due on one tick.
+
+	Headers are copied into one buffer; fragments stay where they are, so
+	sessions sending the same frame of the same title all point into the
+	one encoded payload held by the frame cache or the frame store.
+	"""
+
+	def __init__(self):
+		self.headers = bytearray()
+		# (header offset, header length, payload, fragment offset, fragment length, address)
+		self.datagrams = []
+
+	def addFrame(self, packets, payload, address):
+		"""Queue the [header, fragment] packets of one frame. Return the bytes queued."""
+		queued = 0
+		offset = 0
+		for header, fragment in packets:
+			size = len(fragment)
+			self.datagrams.append((len(self.headers), len(header), payload, offset, size, address))
+			self.headers += header
+			offset += size
+			queued += len(header) + size
+		return queued
+
+	def __len__(self):
+		return len(self.datagrams)
+
+	def clear(self):
+		"""Drop the references to the payloads, so the streams owning them can close."""
+		self.datagrams = []
+		self.headers = bytearray()
+
+class MmsgSender:
+	"""Send a batch with as few sendmmsg(2) calls as possible, straight from the payload buffers."""
+
+	def __init__(self, sock):
+		libc = ctypes.CDLL(None, use_errno=True)
+		self.sendmmsg = libc.sendmmsg
+		self.sendmmsg.argtypes = (ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int)
+		self.sendmmsg.restype = ctypes.c_int
+		self.fd = sock.fileno()
+		# Packed sockaddr_in per client address
+		self.addresses = {}
+
+	def sockaddr(self, address):
+		packed = self.addresses.get(address)
+		if packed is None:
+			if len(self.addresses) > 4096:
+				self.addresses.clear()
+			packed = ctypes.create_string_buffer(struct.pack('=HH4s8x', socket.AF_INET,
+				socket.htons(address[1]), socket.inet_aton(address[0])), 16)
+			self.addresses[address] = packed
+		return packed
+
+	def send(self, batch):
+		"""Return (datagrams sent, syscalls made, datagrams dropped)."""
+		count = len(batch)
+		messages = (MMsgHdr * count)()
+		iovecs = (IoVec * (2 * count))()
+		headers, keepHeaders = bufferAddress(batch.headers)
+		payloads = {}
+		keep = [keepHeaders]
+		for i, (headerOffset, headerLength, payload, offset, length, address) in enumerate(batch.datagrams):
+			base = payloads.get(id(payload))
+			if base is None:
+				base, ref = bufferAddress(payload)
+				payloads[id(payload)] = base
+				keep.append(ref)
+			iovecs[2 * i].base = headers + headerOffset
+			iovecs[2 * i].length = headerLength
+			iovecs[2 * i + 1].base = base + offset
+			iovecs[2 * i + 1].length = length
+			name = self.sockaddr(address)
+			hdr = messages[i].hdr
+			hdr.name = ctypes.addressof(name)
+			hdr.namelen = 16
+			hdr.iov = ctypes.cast(ctypes.byref(iovecs, 2 * i * ctypes.sizeof(IoVec)), ctypes.POINTER(IoVec))
+			hdr.iovlen = 2
+
+		sent = calls = dropped = 0
+		while sent + dropped < count:
+			first = sent + dropped
+			n = min(count - first, MAX_BATCH)
+			calls += 1
+			result = self.sendmmsg(self.fd, ctypes.byref(messages, first * ctypes.sizeof(MMsgHdr)), n, 0)
+			if result > 0:
+				sent += result
+				continue
+			error = ctypes.get_errno()
+			if error == errno.EINTR:
+				continue
+			if error in (errno.EAGAIN, errno.ENOBUFS):
+				# A full socket buffer drops the rest of the tick, as the network would
+				dropped = count - sent
+			else:
+				# Skip the datagram the kernel refused and carry on with the others
+				dropped += 1
+		del keep
+		return sent, calls, dropped
+
+class SendmsgSender:
+	"""Fallback without sendmmsg: one sendmsg(2) per datagram on the shared non-blocking socket."""
+
+	def __init__(self, sock):
+		self.sock = sock
+
+	def send(self, batch):
+		sent = dropped = 0
+		headers = bytes(batch.headers)
+		for headerOffset, headerLength, payload, offset, length, address in batch.datagrams:
+			packet = [headers[headerOffset : headerOffset + headerLength], memoryview(payload)[offset : offset + length]]
+			try:
+				self.sock.sendmsg(packet, [], 0, address)
+				sent += 1
+			except OSError:
+				dropped += 1
+		return sent, sent + dropped, dropped
+
+class SendLoop:
+	"""One thread sending the RTP of every playing session of the thread engine.
+
+	Sessions wait in a heap ordered by their next frame deadline. On each
+	wake-up every session due within GROUP_SLACK queues its frame into one
+	batch, which goes out through a single shared UDP socket with batched
+	sendmmsg calls. A session whose frame is not in the cache yet is not
+	waited for: its stream encodes it in the background and the session is
+	looked at again RETRY_DELAY later.
+
+	Sessions implement queueFrame(batch, now), returning the bytes queued or
+	None when the frame is not ready, frameSent(seconds) once the batch is
+	out, and a `pacer`.
+	"""
+
+	def __init__(self, slack=GROUP_SLACK, retryDelay=RETRY_DELAY):
+		self.slack = slack
+		self.retryDelay = retryDelay
+		self.cond = threading.Condition()
+		# (deadline, token, session); entries whose token is no longer active are dropped
+		self.heap = []
+		self.active = {}
+		self.tokens = itertools.count()
+		# Sessions whose packets are in the batch being sent
+		self.sending = set()
+		self.thread = None
+		self.sock = None
+		self.sender = None
+		self.ticks = 0
+		self.datagrams = 0
+		self.syscalls = 0
+		self.dropped = 0
+
+	def rtpSocket(self):
+		"""Return the shared RTP socket, creating it and the sender on first use."""
+		with self.cond:
+			if self.sock is None:
+				self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+				self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER)
+				self.sock.bind(('0.0.0.0', 0))
+				self.sock.setblocking(False)
+				try:
+					self.sender = MmsgSender(self.sock)
+				except (OSError, AttributeError):
+					logger.info("sendmmsg is not available, sending one datagram per call")
+					self.sender = SendmsgSender(self.sock)
+			return self.sock
+
+	def add(self, session, deadline):
+		"""Start sending frames for a session, the first one at `deadline` on the monotonic clock."""
+		self.rtpSocket()
+		with self.cond:
+			token = self.active[session] = next(self.tokens)
+			heapq.heappush(self.heap, (deadline, token, session))
+			if self.thread is None:
+				self.thread = threading.Thread(target=self.run, daemon=True)
+				self.thread.start()
+			self.cond.notify()
+
+	def remove(self, session):
+		"""Stop sending for a session; a frame of it in flight is finished before this returns."""
+		with self.cond:
+			self.active.pop(session, None)
+			if threading.current_thread() is not self.thread:
+				while session in self.sending:
+					self.cond.wait()
+
+	def run(self):
+		while True:
+			due = self.nextDue()
+			try:
+				self.sendTick(due)
+			except Exception:
+				logger.exception("Send loop tick failed")
+			finally:
+				with self.cond:
+					self.sending.clear()
+					self.cond.notify_all()
+
+	def nextDue(self):
+		"""Wait for the earliest deadline. Return [(session, token)] of every session due by then."""
+		with self.cond:
+			while True:
+				while self.heap and self.active.get(self.heap[0][2]) != self.heap[0][1]:
+					heapq.heappop(self.heap)
+				if not self.heap:
+					self.cond.wait()
+					continue
+				now = time.monotonic()
+				delay = self.heap[0][0] - now
+				if delay > 0:
+					self.cond.wait(delay)
+					continue
+				due = []
+				while self.heap and self.heap[0][0] <= now + self.slack:
+					deadline, token, session = heapq.heappop(self.heap)
+					if self.active.get(session) == token:
+						due.append((session, token))
+				self.sending = {session for session, token in due}
+				return due
+
+	def sendTick(self, due):
+		now = time.monotonic()
+		batch = SendBatch()
+		queued, waiting = [], set()
+		for session, token in due:
+			try:
+				size = session.queueFrame(batch, now)
+			except Exception:
+				logger.debug("Unable to queue a frame", exc_info=True)
+				# Its schedule did not move on; look again later rather than spin on it
+				size = None
+			if size is None:
+				waiting.add(session)
+			elif size:
+				queued.append(session)
+
+		start = time.perf_counter()
+		if len(batch):
+			sent, calls, dropped = self.sender.send(batch)
+			self.datagrams += sent
+			self.syscalls += calls
+			self.dropped += dropped
+		seconds = time.perf_counter() - start
+		batch.clear()
+		self.ticks += 1
+
+		for session in queued:
+			session.frameSent(seconds / len(queued))
+
+		with self.cond:
+			for session, token in due:
+				if self.active.get(session) != token:
+					continue
+				if session in waiting:
+					deadline = now + self.retryDelay
+				else:
+					deadline = session.pacer.deadline()
+				heapq.heappush(self.heap, (deadline, token, session))
+
+	def stats(self):
+		with self.cond:
+			return {
+				'sessions': len(self.active),
+				'ticks': self.ticks,
+				'datagrams': self.datagrams,
+				'syscalls': self.syscalls,
+				'dropped': self.dropped,
+			}
+
+# Sends the RTP of every thread-engine session of the current process
+sendLoop = SendLoop()
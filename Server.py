@@ -1,7 +1,16 @@
-import os, sys, socket
+import os, sys, socket, signal, argparse, multiprocessing, threading, time, logging, atexit
 
 from ServerWorker import ServerWorker
-from VideoStream import VideoStream
+from AsyncServer import AsyncServer
+from Broadcast import BroadcastWorker, channels, MULTICAST_PORT, MULTICAST_TTL
+from MediaCatalog import MediaCatalog, RESCAN_INTERVAL
+from ServerStats import FIELDS, serverStats, publishStats, readStats
+from Profiler import profiler
+from SessionManager import sessionManager, SESSION_TIMEOUT
+from Fec import FEC_GROUP
+from SendHistory import RETRANSMIT_DEADLINE
+
+logger = logging.getLogger(__name__)
 
 VIDEO_FILE_EXT = ('.webm','.mpg','.mp2','.mpeg','.mpe','.mpv','.mjpeg','.mp4','.m4p','.m4v','.avi','.wmv','.mov','.qt')
 VIDEO_DIR = os.getcwd()
@@ -9,36 +18,150 @@ VIDEO_DIR = os.getcwd()
 class Server:
 
 	def __init__(self):
-		print("Preparing server...")
+		self.rescanInterval = RESCAN_INTERVAL
+		self.workerClass = ServerWorker
+		logger.info("Preparing server...")
 		self.getServerInfo()
-		print("Server done.\n")
+		logger.info("Server done.")
 
 	def getServerInfo(self):
-		self.serverInfo = {}
-		for file in os.listdir(VIDEO_DIR):
-			if file.endswith(VIDEO_FILE_EXT):
-				videoSream = VideoStream(file)
-				videoSream.countFrame()
-				self.serverInfo[file] = videoSream.frameCnt
+		# Only files that are new or changed since the last run get probed
+		self.catalog = MediaCatalog(VIDEO_DIR, VIDEO_FILE_EXT)
+		self.serverInfo = self.catalog.update()
 	
-	def main(self):
-		try:
-			SERVER_PORT = int(sys.argv[1])
-		except:
-			print("[Usage: Server.py Server_port]\n")
+	def main(self, args):
+		self.rescanInterval = args.rescan_interval
+		sessionManager.configure(args.session_timeout, args.max_sessions, args.max_decoders)
+		ServerWorker.fecGroup = args.fec_group
+		ServerWorker.retransmitDeadline = args.retransmit_deadline
+		if args.broadcast:
+			channels.configure(args.multicast, args.multicast_port, args.multicast_ttl, args.multicast_interface)
+			self.workerClass = BroadcastWorker
+		if args.profile:
+			profiler.start(args.profile)
+			atexit.register(profiler.flush)
+
+		if args.workers > 1:
+			self.runWorkers(args.engine, args.port, args.workers, args.stats_interval)
+		else:
+			self.catalog.watch(self.rescanInterval)
+			self.serve(args.engine, args.port)
+
+	def serve(self, engine, port, reusePort=False):
+		"""Serve RTSP clients in this process until it is killed."""
+		signal.signal(signal.SIGUSR1, self.dumpStats)
+		if engine == 'asyncio':
+			AsyncServer(self.serverInfo, port, reusePort).run()
+			return
+
 		rtspSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		rtspSocket.bind(('', SERVER_PORT))
+		if reusePort:
+			rtspSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+		rtspSocket.bind(('', port))
 		rtspSocket.listen(5) 
 
 		# Receive client info (address,port) through RTSP/TCP session
 		while True:
 			clientInfo = {}
 			clientInfo['rtspSocket'] = rtspSocket.accept()
-			clientInfo['rtspPort'] = SERVER_PORT
+			clientInfo['rtspPort'] = port
 			serverInfo = self.serverInfo
-			ServerWorker(clientInfo, serverInfo).run()
+			self.workerClass(clientInfo, serverInfo).run()
+
+	def runWorkers(self, engine, port, workers, statsInterval):
+		"""Fork worker processes that share the RTSP port and report their load."""
+		# Forked workers inherit the catalog computed once by this process
+		ctx = multiprocessing.get_context('fork')
+		statsArray = ctx.Array('q', workers * len(FIELDS), lock=False)
+		processes = []
+		for slot in range(workers):
+			process = ctx.Process(target=self.runWorker, args=(engine, port, slot, statsArray), daemon=True)
+			process.start()
+			processes.append(process)
+		logger.info("Started %d workers on port %d", workers, port)
+		# Only this process probes new files; started after the forks, so no worker inherits a lock it holds
+		self.catalog.watch(self.rescanInterval)
+		# Make sure the workers go away with the parent, and let it pass on stats dumps
+		signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+		def forwardDump(signum, frame):
+			for process in processes:
+				os.kill(process.pid, signal.SIGUSR1)
+		signal.signal(signal.SIGUSR1, forwardDump)
+
+		try:
+			while any(process.is_alive() for process in processes):
+				time.sleep(statsInterval)
+				perWorker, total = readStats(statsArray, workers)
+				for slot, counters in enumerate(perWorker):
+					logger.info("worker %d (pid %d): %s", slot, processes[slot].pid, counters)
+				logger.info("total: %s", total)
+		except KeyboardInterrupt:
+			pass
+		finally:
+			for process in processes:
+				process.terminate()
+
+	def runWorker(self, engine, port, slot, statsArray):
+		threading.Thread(target=publishStats, args=(serverStats, statsArray, slot), daemon=True).start()
+		# Threads do not survive the fork; pick up the parent's rescans from the catalog file
+		self.catalog.follow(self.rescanInterval)
+		self.serve(engine, port, reusePort=True)
+
+	def dumpStats(self, signum, frame):
+		"""SIGUSR1: write the counters and stage timings of this process to stderr, and flush the profiles."""
+		sys.stderr.write("# pid {}\n{}".format(os.getpid(), serverStats.format()))
+		sys.stderr.flush()
+		profiler.flush()
+
+def parseArgs():
+	parser = argparse.ArgumentParser(description="RTSP/RTP video streaming server.")
+	parser.add_argument('port', type=int, help="RTSP port to listen on")
+	parser.add_argument('--engine', choices=('thread', 'asyncio'), default='thread',
+		help="thread: one worker thread per client; asyncio: one event loop for every client")
+	parser.add_argument('--workers', type=int, default=1,
+		help="number of server processes sharing the RTSP port through SO_REUSEPORT")
+	parser.add_argument('--stats-interval', type=float, default=10,
+		help="seconds between per-worker statistics reports when --workers > 1")
+	parser.add_argument('--log-level', choices=('debug', 'info', 'warning', 'error', 'off'), default='info',
+		help="debug also logs every RTSP request; off disables logging")
+	parser.add_argument('--rescan-interval', type=float, default=RESCAN_INTERVAL,
+		help="seconds between scans of the video directory for new or removed files")
+	parser.add_argument('--profile', nargs='?', const='profiles', metavar='DIR',
+		help="sample thread stacks and write per-session folded stacks to DIR (default: profiles)")
+	parser.add_argument('--broadcast', action='store_true',
+		help="serve every title as a live channel, encoded once for all of its viewers")
+	parser.add_argument('--multicast', metavar='GROUP',
+		help="with --broadcast, send the channels to multicast groups from GROUP upwards instead of to each viewer")
+	parser.add_argument('--multicast-port', type=int, default=MULTICAST_PORT)
+	parser.add_argument('--multicast-ttl', type=int, default=MULTICAST_TTL)
+	parser.add_argument('--multicast-interface', metavar='ADDR',
+		help="address of the interface multicast goes out on, e.g. 127.0.0.1 for loopback")
+	parser.add_argument('--session-timeout', type=float, default=SESSION_TIMEOUT,
+		help="seconds a client may stay silent, without RTSP requests or RTCP reports, before its session is closed; 0 never")
+	parser.add_argument('--max-sessions', type=int, default=0,
+		help="sessions per process; further SETUPs get 453 Not Enough Bandwidth (default: no limit)")
+	parser.add_argument('--max-decoders', type=int, default=0,
+		help="ffmpeg decoders in use per process; further SETUPs of titles without a frame store get 503 (default: the reader cap of the pool)")
+	parser.add_argument('--fec-group', type=int, default=FEC_GROUP,
+		help="media packets per XOR parity packet for clients asking for FEC without a group size, "
+		"i.e. an overhead of 1/N; 0 refuses FEC")
+	parser.add_argument('--retransmit-deadline', type=float, default=RETRANSMIT_DEADLINE,
+		help="seconds after sending a packet during which a NACK for it is answered; 0 disables retransmission")
+	args = parser.parse_args()
+	# A channel is paced and encoded by one process
+	if args.broadcast and (args.engine != 'thread' or args.workers > 1):
+		parser.error("--broadcast needs the thread engine and a single worker")
+	if args.multicast and not args.broadcast:
+		parser.error("--multicast needs --broadcast")
+	return args
 
 if __name__ == "__main__":
-	(Server()).main()
+	args = parseArgs()
+	logging.basicConfig(level=logging.INFO, format='%(asctime)s %(process)d %(name)s %(levelname)s %(message)s')
+	if args.log_level == 'off':
+		logging.disable(logging.CRITICAL)
+	else:
+		logging.getLogger().setLevel(args.log_level.upper())
+	(Server()).main(args)
 
 
@@ -0,0 +1,133 @@
+import threading, time, bisect
+from FrameCache import frameCache
+from ReaderPool import readerPool
+from SendLoop import sendLoop
+from SessionManager import sessionManager
+
+FIELDS = ('sessions', 'sessionsTotal', 'framesSent', 'bytesSent', 'sendErrors', 'deadlineMisses', 'framesSkipped',
+	'sessionsRejected', 'sessionsExpired', 'fecPackets', 'retransmits', 'tcpFramesDropped')
+
+# Hot-path stages of the frame pipeline, and the upper bounds of their latency buckets in seconds
+STAGES = ('fetch', 'decode', 'encode', 'transcode', 'packetize', 'send')
+BUCKETS = tuple(0.0001 * 2 ** k for k in range(14))
+
+class StageTimings:
+	"""Latency histograms of the frame pipeline stages, cheap enough to update for every frame."""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		with self.lock:
+			# The last bucket of each stage catches everything above BUCKETS[-1]
+			self.counts = {stage: [0] * (len(BUCKETS) + 1) for stage in STAGES}
+			self.sums = dict.fromkeys(STAGES, 0.0)
+			self.maxima = dict.fromkeys(STAGES, 0.0)
+
+	def record(self, stage, seconds):
+		bucket = bisect.bisect_left(BUCKETS, seconds)
+		with self.lock:
+			self.counts[stage][bucket] += 1
+			self.sums[stage] += seconds
+			if seconds > self.maxima[stage]:
+				self.maxima[stage] = seconds
+
+	def snapshot(self):
+		with self.lock:
+			return {stage: (list(self.counts[stage]), self.sums[stage], self.maxima[stage]) for stage in STAGES}
+
+	def format(self):
+		"""Return the histograms in Prometheus text format."""
+		lines = []
+		for stage, (counts, total, maximum) in self.snapshot().items():
+			cumulative = 0
+			for bound, count in zip(BUCKETS + (float('inf'),), counts):
+				cumulative += count
+				le = '+Inf' if bound == float('inf') else '{:g}'.format(bound)
+				lines.append('videostream_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(stage, le, cumulative))
+			lines.append('videostream_stage_seconds_sum{{stage="{}"}} {}'.format(stage, total))
+			lines.append('videostream_stage_seconds_count{{stage="{}"}} {}'.format(stage, cumulative))
+			lines.append('videostream_stage_seconds_max{{stage="{}"}} {}'.format(stage, maximum))
+		return '\n'.join(lines) + '\n'
+
+class ServerStats:
+	"""Thread-safe counters of one server process."""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.counters = dict.fromkeys(FIELDS, 0)
+		# Session id -> worker, for the per-session QoS statistics
+		self.sessions = {}
+		# Title -> live channel of the broadcast mode
+		self.channels = {}
+
+	def incr(self, name, n=1):
+		with self.lock:
+			self.counters[name] += n
+
+	def snapshot(self):
+		with self.lock:
+			return dict(self.counters)
+
+	def registerSession(self, session, worker):
+		with self.lock:
+			self.sessions[session] = worker
+
+	def unregisterSession(self, session):
+		with self.lock:
+			self.sessions.pop(session, None)
+
+	def registerChannel(self, name, channel):
+		with self.lock:
+			self.channels[name] = channel
+
+	def format(self):
+		"""Return the counters, the frame cache, reader pool and send loop statistics, the live session counts, the stage timings, the per-session QoS and the live channels in Prometheus text format."""
+		with self.lock:
+			counters = dict(self.counters)
+			sessions = list(self.sessions.items())
+			channels = list(self.channels.items())
+		lines = []
+		for name, value in counters.items():
+			lines.append('videostream_{} {}'.format(name, value))
+		for name, value in frameCache.stats().items():
+			lines.append('videostream_cache_{} {}'.format(name, value))
+		for name, value in readerPool.stats().items():
+			lines.append('videostream_readers_{} {}'.format(name, value))
+		for name, value in sendLoop.stats().items():
+			lines.append('videostream_sendloop_{} {}'.format(name, value))
+		for name, value in sessionManager.stats().items():
+			lines.append('videostream_live_{} {}'.format(name, value))
+		for session, worker in sessions:
+			stats = worker.sessionStats()
+			labels = 'session="{}",filename="{}"'.format(session, stats.pop('filename'))
+			for name, value in stats.items():
+				if value is not None:
+					lines.append('videostream_session_{}{{{}}} {}'.format(name, labels, value))
+		for name, channel in channels:
+			for stat, value in channel.stats().items():
+				lines.append('videostream_channel_{}{{channel="{}"}} {}'.format(stat, name, value))
+		return '\n'.join(lines) + '\n' + stageTimings.format()
+
+def publishStats(stats, array, slot, interval=1.0):
+	"""Copy the counters of this process into its slot of a shared array, forever."""
+	base = slot * len(FIELDS)
+	while True:
+		snapshot = stats.snapshot()
+		for i, name in enumerate(FIELDS):
+			array[base + i] = snapshot[name]
+		time.sleep(interval)
+
+def readStats(array, workers):
+	"""Return the per-worker counters published in a shared array, and their total."""
+	perWorker = []
+	for slot in range(workers):
+		base = slot * len(FIELDS)
+		perWorker.append({name: array[base + i] for i, name in enumerate(FIELDS)})
+	total = {name: sum(worker[name] for worker in perWorker) for name in FIELDS}
+	return perWorker, total
+
+# Counters and stage timings of the current process
+serverStats = ServerStats()
+stageTimings = StageTimings()
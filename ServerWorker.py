@@ -1,8 +1,27 @@
 from random import randint
-import sys, traceback, threading, socket, os
+import sys, traceback, threading, socket, os, re, time, logging
 
-from VideoStream import VideoStream
-from RtpPacket import RtpPacket
+from VideoStream import VideoStream, primeTitles
+from RtpPacket import JpegPacketizer, CLOCK_RATE, MJPEG_HEADERS
+from ServerStats import serverStats, stageTimings
+from Pacer import Pacer
+from RateControl import RateController
+import RtcpPacket
+from Profiler import profiler
+from RtspParser import RtspParser, InterleavedFrame, formatMessage, formatInterleaved, parseInterleaved, INTERLEAVED_HEADER, INTERLEAVED_MAGIC
+from SendLoop import sendLoop
+from SessionManager import sessionManager
+from Fec import FecEncoder, parseFec, FEC_GROUP, FEC_PAYLOAD_TYPE
+from SendHistory import SendHistory, RETRANSMIT_DEADLINE
+from Interleaved import InterleavedQueue, limitSendBuffer
+
+logger = logging.getLogger(__name__)
+
+# Seconds between RTCP sender reports
+RTCP_INTERVAL = 1.0
+
+RTSP_BUFFER_SIZE = 4096
+CLIENT_PORT = re.compile(r'client_port=\s*(\d+)')
 
 class ServerWorker:
 	SETUP = 'SETUP'
@@ -12,6 +31,9 @@ class ServerWorker:
 	TEARDOWN = 'TEARDOWN'
 	SWITCH = 'SWITCH'
 	GET_LIST = 'GET_LIST'
+	REPORT = 'REPORT'
+	GET_STATS = 'GET_STATS'
+	GET_PARAMETER = 'GET_PARAMETER'
 	
 	INIT = 0
 	READY = 1
@@ -22,9 +44,21 @@ class ServerWorker:
 	OK_200 = 0
 	FILE_NOT_FOUND_404 = 1
 	CON_ERR_500 = 2
+	NOT_ENOUGH_BANDWIDTH_453 = 3
+	SERVICE_UNAVAILABLE_503 = 4
+	UNSUPPORTED_TRANSPORT_461 = 5
+	ERRORS = {FILE_NOT_FOUND_404: "404 Not Found", CON_ERR_500: "500 Internal Server Error",
+		NOT_ENOUGH_BANDWIDTH_453: "453 Not Enough Bandwidth", SERVICE_UNAVAILABLE_503: "503 Service Unavailable",
+		UNSUPPORTED_TRANSPORT_461: "461 Unsupported Transport"}
 	
 	clientInfo = {}
 	serverInfo = {}
+	# Parity group size for clients asking for FEC without one; 0 refuses FEC
+	fecGroup = FEC_GROUP
+	# Seconds a sent packet can still be resent on a NACK; 0 keeps no history
+	retransmitDeadline = RETRANSMIT_DEADLINE
+	# Whether RTP may be interleaved on the RTSP connection
+	tcpTransport = True
 	
 	def __init__(self, clientInfo, serverInfo):
 		self.clientInfo = clientInfo
@@ -32,6 +66,32 @@ class ServerWorker:
 		self.requestType = ''
 		self.filename = ''
 		self.fps = 25
+		self.ssrc = randint(1, 0xFFFFFFFF)
+		self.packetizer = JpegPacketizer(randint(0, 0xFFFF), self.ssrc)
+		self.pacer = Pacer(self.fps)
+		# From PLAY until the first frame is ready; waiting for its encode does not put the session behind
+		self.starting = False
+		self.rateController = RateController(self.fps)
+		# RTP timestamps run on the 90 kHz video clock from a random origin
+		self.timestampBase = randint(0, 0xFFFFFFFF)
+		self.lastTimestamp = self.timestampBase
+		# Sender statistics and what the client's RTCP receiver reports say about them
+		self.frameCnt = 0
+		self.packetsSent = 0
+		self.octetsSent = 0
+		self.queuedBytes = 0
+		self.lastSenderReport = 0
+		self.rtcpStats = {'fractionLost': 0.0, 'cumulativeLost': 0, 'jitterMs': 0.0, 'rttMs': None}
+		# XOR parity negotiated at SETUP, and what the client's reports say it repaired with it
+		self.fec = None
+		self.fecPacketsSent = 0
+		self.fecStats = {'fecRecovered': 0, 'fecUnrecoverable': 0}
+		# Packets recently sent, for the ones the client NACKs
+		self.history = SendHistory(deadline=self.retransmitDeadline) if self.retransmitDeadline else None
+		# (RTP, RTCP) channels when the client takes RTP on the RTSP connection, and the frames it was too slow for
+		self.interleaved = None
+		self.tcpQueue = None
+		self.tcpFramesDropped = 0
 		
 	def run(self):
 		threading.Thread(target=self.recvRtspRequest).start()
@@ -39,202 +99,671 @@ class ServerWorker:
 	def recvRtspRequest(self):
 		"""Receive RTSP request from the client."""
 		connSocket = self.clientInfo['rtspSocket'][0]
-		while True:
-			data = connSocket.recv(256)
-			if data:
-				print("Data received:\n" + data.decode("utf-8"))
-				self.processRtspRequest(data.decode("utf-8"))
+		sessionManager.register(self)
+		# Requests may arrive split across reads or several to a read
+		parser = RtspParser()
+		try:
+			while True:
+				try:
+					data = connSocket.recv(RTSP_BUFFER_SIZE)
+				except OSError:
+					break
+				# The client hung up, or the session manager closed an expired session
+				if not data:
+					break
+				sessionManager.touch(self)
+				try:
+					requests = parser.feed(data)
+				except ValueError:
+					logger.warning("Malformed RTSP request, closing the connection")
+					break
+				for request in requests:
+					if isinstance(request, InterleavedFrame):
+						self.receiveInterleaved(request)
+						continue
+					logger.debug("Request received:\n%s", request.startLine)
+					self.processRtspRequest(request)
+		except OSError as e:
+			# A reply the client did not take, e.g. stuck behind interleaved frames it does not read
+			logger.warning("session %s: closing, %s", self.clientInfo.get('session'), e)
+		finally:
+			self.closeSession()
+			connSocket.close()
 	
-	def processRtspRequest(self, data):
-		"""Process RTSP request sent from the client."""
+	def processRtspRequest(self, request):
+		"""Process an RTSP request (an RtspMessage) sent from the client."""
 		# Get the request type
-		request = data.split('\n')
-		line1 = request[0].split(' ')
-		self.requestType = line1[0]
+		self.requestType = request.method
 		
 		# Get the media file name
-		self.filename = line1[1]
+		self.filename = request.uri
 		
 		# Get the RTSP sequence number 
-		seq = request[1].split(' ')
+		seq = request.header('CSeq', '0')
 		
 		# Process SETUP request
 		if self.requestType == self.SETUP:
 			if self.state == self.INIT or self.state == self.SWITCHING:
 				# Update state
-				print("processing SETUP\n")
-				
+				logger.debug("processing SETUP")
+
+				# Only titles in the catalog are served, not whatever else lies in the directory
+				if self.filename not in self.serverInfo:
+					self.replyRtsp(self.FILE_NOT_FOUND_404, seq)
+					return
 				try:
-					self.clientInfo['videoStream'] = VideoStream(self.filename)
-					self.state = self.READY
+					videoStream = VideoStream(self.filename, self.serverInfo.get(self.filename))
 				except IOError:
-					self.replyRtsp(self.FILE_NOT_FOUND_404, seq[1])
+					self.replyRtsp(self.FILE_NOT_FOUND_404, seq)
+					return
+
+				interleaved = parseInterleaved(request.header('Transport', ''))
+				if interleaved and not self.tcpTransport:
+					videoStream.close()
+					self.replyRtsp(self.UNSUPPORTED_TRANSPORT_461, seq)
+					return
+
+				if self.state == self.INIT:
+					# Turn a new session away rather than degrade the running ones
+					exhausted = sessionManager.admit(self, videoStream)
+					if exhausted:
+						videoStream.close()
+						serverStats.incr('sessionsRejected')
+						logger.info("SETUP rejected: no %s left", exhausted)
+						code = self.NOT_ENOUGH_BANDWIDTH_453 if exhausted == 'sessions' else self.SERVICE_UNAVAILABLE_503
+						self.replyRtsp(code, seq)
+						return
+					serverStats.incr('sessions')
+					serverStats.incr('sessionsTotal')
+
+				self.clientInfo['videoStream'] = videoStream
+				self.state = self.READY
 				
 				# Generate a randomized RTSP session ID
+				self.endSession()
 				self.clientInfo['session'] = randint(100000, 999999)
+				serverStats.registerSession(self.clientInfo['session'], self)
 				
-				# Send RTSP reply
-				self.replyRtsp(self.OK_200, seq[1])
+				# Get the RTP/UDP port, or the interleaved channels, from the Transport header
+				self.setTransport(interleaved)
+				match = CLIENT_PORT.search(request.header('Transport', ''))
+				if match and not interleaved:
+					self.clientInfo['rtpPort'] = match.group(1)
+
+				# The client asks for parity with "FEC: group=N", N = 0 leaving the group size to the server;
+				# each SETUP negotiates it afresh, and interleaved RTP is never lost so it gets none
+				group = parseFec(request.header('FEC', ''))
+				self.fec = None
+				if group is not None and self.fecGroup and not self.interleaved:
+					self.fec = FecEncoder(group or self.fecGroup, self.ssrc, randint(0, 0xFFFF))
 				
-				# Get the RTP/UDP port from the last line
-				self.clientInfo['rtpPort'] = request[2].split(' ')[3]
+				# Send RTSP reply
+				self.replyRtsp(self.OK_200, seq)
 
 				# Initialize a frame counter
 				self.frameCnt = 0
 		
 		# Process DESCRIBE request
 		elif self.requestType == self.DESCRIBE:
-			print("processing DESCRIBE\n")
-			self.replyRtsp(self.OK_200, seq[1])
+			logger.debug("processing DESCRIBE")
+			self.replyRtsp(self.OK_200, seq)
 		
 		# Process PLAY request 		
 		elif self.requestType == self.PLAY:
 			if self.state == self.READY:
-				print("processing PLAY\n")
+				logger.debug("processing PLAY")
 				self.state = self.PLAYING
 
-				requestedFrame = int(request[3].split(' ')[1])
-				frameCnt = self.serverInfo[self.filename]
+				try:
+					requestedFrame = int(request.header('Frame', -1))
+				except ValueError:
+					requestedFrame = -1
+				frameCnt = self.serverInfo[self.filename]['frames']
 				if requestedFrame >= frameCnt:
 					requestedFrame = frameCnt - 1
 				self.clientInfo['requestedFrame'] = requestedFrame
 
 				# Create a new socket for RTP/UDP
-				self.clientInfo['rtpSocket'] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+				self.openRtp()
 				
-				self.replyRtsp(self.OK_200, seq[1])
+				self.replyRtsp(self.OK_200, seq)
 				
-				# Create a new thread and start sending RTP packets
-				self.clientInfo['event'] = threading.Event()
-				self.clientInfo['worker']= threading.Thread(target=self.sendRtp) 
-				self.clientInfo['worker'].start()
+				# Start sending RTP packets
+				self.startRtp()
 		
 		# Process PAUSE request
 		elif self.requestType == self.PAUSE:
 			if self.state == self.PLAYING:
-				print("processing PAUSE\n")
+				logger.debug("processing PAUSE")
 				self.state = self.READY
 				
-				self.clientInfo['event'].set()
+				self.stopRtp()
 			
-				self.replyRtsp(self.OK_200, seq[1])
+				self.replyRtsp(self.OK_200, seq)
 		
 		# Process TEARDOWN request
 		elif self.requestType == self.TEARDOWN:
-			print("processing TEARDOWN\n")
+			logger.debug("processing TEARDOWN")
+			if self.state != self.INIT:
+				serverStats.incr('sessions', -1)
+			sessionManager.release(self)
+			self.endSession()
 			self.state = self.INIT
 
-			self.clientInfo['event'].set()
+			self.stopRtp()
 			
-			self.replyRtsp(self.OK_200, seq[1])
+			self.replyRtsp(self.OK_200, seq)
 			
-			# Close the RTP socket
-			self.clientInfo['rtpSocket'].close()
+			# Close the RTP socket and release the decoder; the next SETUP picks its transport and FEC afresh
+			self.closeRtp()
+			self.setTransport(None)
+			self.fec = None
 		
 		# Process SWITCH request
+		# One request changes the title of the session; the session and its RTP socket stay
 		elif self.requestType == self.SWITCH:
-			print("processing SWITCH\n")
-			self.state = self.SWITCHING
+			if self.state == self.READY or self.state == self.PLAYING:
+				logger.debug("processing SWITCH")
+				if self.filename not in self.serverInfo:
+					self.replyRtsp(self.FILE_NOT_FOUND_404, seq)
+					return
+				try:
+					videoStream = VideoStream(self.filename, self.serverInfo.get(self.filename))
+				except IOError:
+					self.replyRtsp(self.FILE_NOT_FOUND_404, seq)
+					return
 
-			self.clientInfo['event'].set()
-			
-			self.replyRtsp(self.OK_200, seq[1])
-			
-			# Close the RTP socket
-			self.clientInfo['rtpSocket'].close()
+				# The new title may need a decoder the old one did not
+				if not sessionManager.retitle(self, videoStream):
+					videoStream.close()
+					logger.info("SWITCH rejected: no decoders left")
+					self.replyRtsp(self.SERVICE_UNAVAILABLE_503, seq)
+					return
+
+				self.stopRtp()
+				self.clientInfo['videoStream'].close()
+				videoStream.level = self.clientInfo['videoStream'].level
+				self.clientInfo['videoStream'] = videoStream
+				self.clientInfo['requestedFrame'] = -1
+				self.frameCnt = 0
+				# Keep the RTP clock moving forward across titles
+				self.timestampBase = (self.lastTimestamp + round(CLOCK_RATE / self.fps)) & 0xFFFFFFFF
+
+				self.replyRtsp(self.OK_200, seq)
+
+				# The head of a listed title is already in the frame cache, so frames flow at once
+				if self.state == self.PLAYING:
+					self.startRtp()
 		
 		# Process GET_LIST request
 		elif self.requestType == self.GET_LIST:
-			print("processing GET_LIST\n")
+			logger.debug("processing GET_LIST")
+			try:
+				offset = max(0, int(request.header('Offset', 0)))
+				limit = request.header('Limit')
+				limit = None if limit is None else max(0, int(limit))
+			except ValueError:
+				offset, limit = 0, None
+			self.listing, names = self.serverInfo.listing(request.header('Prefix', ''), offset, limit)
+			# Titles on screen are the likely next SWITCH targets
+			primeTitles(names, self.serverInfo)
 
-			self.replyRtsp(self.OK_200, seq[1])
+			self.replyRtsp(self.OK_200, seq)
+		
+		# Process GET_PARAMETER request: a keepalive, the connection was touched on receipt
+		elif self.requestType == self.GET_PARAMETER:
+			self.replyRtsp(self.OK_200, seq)
+		
+		# Process GET_STATS request
+		elif self.requestType == self.GET_STATS:
+			logger.debug("processing GET_STATS")
+
+			self.replyRtsp(self.OK_200, seq)
+		
+		# Process REPORT request: receiver statistics driving the rendition choice
+		elif self.requestType == self.REPORT:
+			if self.state == self.READY or self.state == self.PLAYING:
+				try:
+					loss = float(request.header('Loss', 0))
+					jitter = float(request.header('Jitter', 0))
+				except ValueError:
+					loss, jitter = 0, 0
+				if self.fec:
+					try:
+						self.fecStats['fecRecovered'] = int(request.header('Recovered', 0))
+						self.fecStats['fecUnrecoverable'] = int(request.header('Unrecovered', 0))
+					except ValueError:
+						pass
+				level = self.rateController.update(loss, jitter)
+				videoStream = self.clientInfo['videoStream']
+				if level != videoStream.level:
+					logger.info("session %s: switching to rendition %d", self.clientInfo['session'], level)
+					videoStream.level = level
+
+				self.replyRtsp(self.OK_200, seq)
 			
 	
-	def sendRtp(self):
-		"""Send RTP packets over UDP."""
-		while True:
-			self.clientInfo['event'].wait(1/self.fps) 
-			
-			# Stop sending if request is PAUSE or TEARDOWN
-			if self.clientInfo['event'].isSet(): 
-				break
+	def closeSession(self):
+		"""Release everything the connection holds: its session, RTP sender, sockets and decoder."""
+		if self.state != self.INIT:
+			serverStats.incr('sessions', -1)
+			self.state = self.INIT
+		sessionManager.release(self)
+		self.endSession()
+		self.stopRtp()
+		self.closeRtp()
+		sessionManager.unregister(self)
 
-			if self.clientInfo['requestedFrame'] != -1:
-				data = self.clientInfo['videoStream'].getFrame(self.clientInfo['requestedFrame'])
-				self.clientInfo['requestedFrame'] = -1
+	def expire(self):
+		"""Called by the session manager: close the connection, so the receive loop ends and tears the session down."""
+		serverStats.incr('sessionsExpired')
+		try:
+			self.clientInfo['rtspSocket'][0].shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
+
+	def endSession(self):
+		"""Forget the current RTSP session in the statistics and write out its profile."""
+		session = self.clientInfo.get('session')
+		if session is not None:
+			serverStats.unregisterSession(session)
+			profiler.flush(session)
+
+	def openRtp(self):
+		"""Create the RTCP/UDP socket of the session unless it is already open; RTP goes out through the send loop."""
+		if 'rtcpSocket' not in self.clientInfo and not self.interleaved:
+			rtcpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+			rtcpSocket.bind(('', 0))
+			rtcpSocket.setblocking(False)
+			self.clientInfo['rtcpSocket'] = rtcpSocket
+
+	def closeRtp(self):
+		"""Close the RTCP socket and release the video stream."""
+		sock = self.clientInfo.pop('rtcpSocket', None)
+		if sock:
+			sock.close()
+		if 'videoStream' in self.clientInfo:
+			self.clientInfo['videoStream'].close()
+
+	def startRtp(self):
+		"""Hand the session to the shared send loop, first frame due now."""
+		self.clientInfo['videoStream'].startPrefetch()
+		self.starting = True
+		self.pacer.restart()
+		sendLoop.add(self, self.pacer.deadline())
+
+	def stopRtp(self):
+		"""Take the session off the send loop; a frame in flight finishes before the stream is closed or replaced."""
+		sendLoop.remove(self)
+		if self.history:
+			self.history.clear()
+
+	def fetchFrame(self, skipped=0):
+		"""Get the requested frame after a seek, or the next one due after skipping late frames."""
+		start = time.perf_counter()
+		videoStream = self.clientInfo['videoStream']
+		if self.clientInfo['requestedFrame'] != -1:
+			data = videoStream.getFrame(self.clientInfo['requestedFrame'])
+			self.clientInfo['requestedFrame'] = -1
+		elif skipped:
+			serverStats.incr('deadlineMisses')
+			serverStats.incr('framesSkipped', skipped)
+			data = videoStream.getFrame(videoStream.frameNbr() + skipped)
+		else:
+			data = videoStream.nextFrame()
+		stageTimings.record('fetch', time.perf_counter() - start)
+		return data
+
+	def queueFrame(self, batch, now):
+		"""Called by the send loop: add the packets of the frame due now to its batch.
+
+		Return the bytes queued, or None if the frame is still being encoded,
+		in which case the schedule is left alone and the loop asks again.
+		"""
+		profiler.tagThread(self.clientInfo['session'])
+		try:
+			start = time.perf_counter()
+			videoStream = self.clientInfo['videoStream']
+			requestedFrame = self.clientInfo['requestedFrame']
+			skipped = 0
+			if requestedFrame != -1:
+				index = requestedFrame
 			else:
-				data = self.clientInfo['videoStream'].nextFrame()
-			
-			if data:
-				frameNumber = self.clientInfo['videoStream'].frameNbr()
-				try:
-					address = self.clientInfo['rtspSocket'][1][0]
-					port = int(self.clientInfo['rtpPort'])
-					self.clientInfo['rtpSocket'].sendto(self.makeRtp(data, frameNumber),(address,port))
-					self.frameCnt += 1
-				except:
-					print("Connection Error")
-					#print('-'*60)
-					#traceback.print_exc(file=sys.stdout)
-					#print('-'*60)
+				skipped = 0 if self.starting else self.pacer.behind(now)
+				index = videoStream.frameNbr() + skipped
+			data = videoStream.peekFrame(index)
+			stageTimings.record('fetch', time.perf_counter() - start)
+			if data is None:
+				return None
+
+			if self.starting:
+				# The schedule starts with the first frame that is ready
+				self.starting = False
+				self.pacer.restart(now)
+			skipped = self.pacer.tick(now)
+			if requestedFrame != -1:
+				self.clientInfo['requestedFrame'] = -1
+			elif skipped:
+				serverStats.incr('deadlineMisses')
+				serverStats.incr('framesSkipped', skipped)
+			if not data:
+				if self.interleaved:
+					# Past the last frame, the backlog still has to drain
+					self.interleavedRoom(0)
+				return 0
+
+			start = time.perf_counter()
+			if self.interleaved:
+				queued = self.sendInterleaved(data, videoStream.frameNbr())
+				stageTimings.record('packetize', time.perf_counter() - start)
+				self.queuedBytes = queued
+				return queued
+
+			packets = len(batch)
+			rtp = self.makeRtp(data, videoStream.frameNbr())
+			if self.fec or self.history:
+				rtp = [(bytes(header), fragment) for header, fragment in rtp]
+			queued = batch.addFrame(rtp, data, self.rtpAddress())
+			self.packetsSent += len(batch) - packets
+			if self.history:
+				self.history.add(rtp, now)
+			if self.fec:
+				for parity in self.fec.protect(rtp):
+					queued += batch.addFrame([parity], parity[1], self.rtpAddress())
+					self.fecPacketsSent += 1
+					serverStats.incr('fecPackets')
+			stageTimings.record('packetize', time.perf_counter() - start)
+			self.octetsSent += len(data)
+			self.frameCnt += 1
+			self.queuedBytes = queued
+			return queued
+		finally:
+			profiler.untagThread()
+
+	def frameSent(self, seconds):
+		"""Called by the send loop once the batch holding this session's frame is out."""
+		stageTimings.record('send', seconds)
+		serverStats.incr('framesSent')
+		serverStats.incr('bytesSent', self.queuedBytes)
+		try:
+			self.serviceRtcp()
+		except OSError:
+			serverStats.incr('sendErrors')
+			logger.debug("Connection Error", exc_info=True)
+
+	def sendFrame(self, data):
+		"""Packetize a frame and send it to the client."""
+		frameNumber = self.clientInfo['videoStream'].frameNbr()
+		try:
+			if self.interleaved:
+				start = time.perf_counter()
+				sent = self.sendInterleaved(data, frameNumber)
+				stageTimings.record('packetize', time.perf_counter() - start)
+				if sent:
+					serverStats.incr('framesSent')
+					serverStats.incr('bytesSent', sent)
+				self.serviceRtcp()
+				return
+
+			sent = 0
+			start = time.perf_counter()
+			sending = 0.0
+			rtp = self.makeRtp(data, frameNumber)
+			if self.fec or self.history:
+				rtp = [(bytes(header), fragment) for header, fragment in rtp]
+				if self.history:
+					self.history.add(rtp)
+			for packet in rtp:
+				before = time.perf_counter()
+				self.sendPacket(packet)
+				sending += time.perf_counter() - before
+				sent += len(packet[0]) + len(packet[1])
+				self.packetsSent += 1
+				self.octetsSent += len(packet[1])
+			if self.fec:
+				for packet in self.fec.protect(rtp):
+					before = time.perf_counter()
+					self.sendPacket(packet)
+					sending += time.perf_counter() - before
+					sent += len(packet[0]) + len(packet[1])
+					self.fecPacketsSent += 1
+					serverStats.incr('fecPackets')
+			# Packets are built lazily between sends, so packetizing is what the sends leave over
+			stageTimings.record('packetize', time.perf_counter() - start - sending)
+			stageTimings.record('send', sending)
+			self.frameCnt += 1
+			serverStats.incr('framesSent')
+			serverStats.incr('bytesSent', sent)
+			self.serviceRtcp()
+		except OSError:
+			serverStats.incr('sendErrors')
+			logger.debug("Connection Error", exc_info=True)
+
+	def sendInterleaved(self, data, frameNbr):
+		"""Frame the packets of a frame onto the RTSP connection.
+
+		Return the bytes queued, or 0 if the client is reading too slowly
+		and the frame was dropped before it took any sequence numbers.
+		"""
+		packets = -(-len(data) // self.packetizer.maxFragment)
+		size = len(data) + packets * (INTERLEAVED_HEADER.size + MJPEG_HEADERS.size)
+		if not self.interleavedRoom(size):
+			self.tcpFramesDropped += 1
+			serverStats.incr('tcpFramesDropped')
+			return 0
+		channel = self.interleaved[0]
+		parts = []
+		for header, fragment in self.makeRtp(data, frameNbr):
+			parts += [INTERLEAVED_HEADER.pack(INTERLEAVED_MAGIC, channel, len(header) + len(fragment)), bytes(header), fragment]
+		chunk = b''.join(parts)
+		self.writeInterleaved(chunk)
+		self.packetsSent += packets
+		self.octetsSent += len(data)
+		self.frameCnt += 1
+		return len(chunk)
+
+	def setTransport(self, interleaved):
+		"""Send RTP over UDP, or interleaved on the RTSP connection on the (RTP, RTCP) channels given."""
+		if interleaved == self.interleaved:
+			return
+		if self.interleaved:
+			self.stopInterleaved()
+		self.interleaved = interleaved
+		if interleaved:
+			self.startInterleaved()
+			# TCP neither loses packets nor needs them resent
+			self.history = None
+		else:
+			self.history = SendHistory(deadline=self.retransmitDeadline) if self.retransmitDeadline else None
+
+	def startInterleaved(self):
+		"""RTP goes out on the RTSP connection from now on, queued so the send loop never waits for the client."""
+		limitSendBuffer(self.clientInfo['rtspSocket'][0])
+		self.tcpQueue = InterleavedQueue(self.clientInfo['rtspSocket'][0])
+
+	def stopInterleaved(self):
+		"""Write out what is still queued; replies go straight to the connection again."""
+		queue, self.tcpQueue = self.tcpQueue, None
+		queue.drain()
+
+	def interleavedRoom(self, size):
+		return self.tcpQueue.room(size)
+
+	def writeInterleaved(self, data):
+		return self.tcpQueue.write(data)
+
+	def receiveInterleaved(self, frame):
+		"""RTCP from the client on the RTSP connection; anything on other channels is ignored."""
+		if self.interleaved and frame.channel == self.interleaved[1]:
+			self.processRtcp(frame.data)
+
+	def sendPacket(self, packet):
+		"""Send one RTP packet, given as a list of buffers, to the client's RTP port."""
+		sendLoop.rtpSocket().sendmsg(packet, [], 0, self.rtpAddress())
+
+	def rtpAddress(self):
+		return (self.clientInfo['rtspSocket'][1][0], int(self.clientInfo['rtpPort']))
 
 	def makeRtp(self, payload, frameNbr):
-		"""RTP-packetize the video data."""
-		version = 2
-		padding = 0
-		extension = 0
-		cc = 0
-		marker = 0
-		pt = 26 # MJPEG type
-		seqnum = frameNbr
-		ssrc = 0
-
-		extid = 0
-		extlen = 1 # the length of the extension in 32-bit units,
+		"""RTP-packetize the video data into RFC 2435 fragments.
+
+		Yield each packet as [header, fragment] buffers; the header buffer is
+		reused, so every packet must be sent before the next one is requested.
+		"""
 		frameCnt = self.frameCnt + 1
-		
-		rtpPacket = RtpPacket()
-		
-		rtpPacket.encode(version, padding, extension, cc, seqnum, marker, pt, ssrc, payload, extid, extlen, frameCnt=frameCnt)
-		
-		return rtpPacket.getPacket()
+		timestamp = (self.timestampBase + round((frameNbr - 1) * CLOCK_RATE / self.fps)) & 0xFFFFFFFF
+		self.lastTimestamp = timestamp
+		return self.packetizer.packets(payload, frameCnt, frameNbr, timestamp)
+
+	def serviceRtcp(self):
+		"""Send a sender report when one is due and handle the receiver reports that came in."""
+		now = time.monotonic()
+		if now - self.lastSenderReport >= RTCP_INTERVAL:
+			self.lastSenderReport = now
+			self.sendRtcp(RtcpPacket.makeSenderReport(self.ssrc, self.lastTimestamp, self.packetsSent, self.octetsSent))
+		self.receiveRtcp()
+
+	def rtcpAddress(self):
+		"""RTCP goes to the port right above the client's RTP port."""
+		address, port = self.rtpAddress()
+		return (address, port + 1)
+
+	def sendRtcp(self, data):
+		if self.interleaved:
+			self.writeInterleaved(formatInterleaved(self.interleaved[1], data))
+			return
+		self.clientInfo['rtcpSocket'].sendto(data, self.rtcpAddress())
+
+	def receiveRtcp(self):
+		"""Drain the session's RTCP socket without blocking.
+
+		Reports are picked up between frames, so the RTT measured here can be
+		up to one frame interval too long.
+		"""
+		while True:
+			try:
+				data = self.clientInfo['rtcpSocket'].recv(2048)
+			except (BlockingIOError, KeyError, OSError):
+				break
+			self.processRtcp(data)
+
+	def processRtcp(self, data):
+		"""Record the loss, jitter and round-trip time reported by the client, and resend the packets it NACKs."""
+		sessionManager.touch(self)
+		for report in RtcpPacket.parse(data):
+			if report['type'] == RtcpPacket.RTPFB:
+				if report['mediaSsrc'] == self.ssrc:
+					self.retransmit(report['lost'])
+				continue
+			if report['type'] != RtcpPacket.RR:
+				continue
+			for block in report['blocks']:
+				if block['ssrc'] != self.ssrc:
+					continue
+				self.rtcpStats['fractionLost'] = block['fractionLost'] / 256
+				self.rtcpStats['cumulativeLost'] = block['cumulativeLost']
+				self.rtcpStats['jitterMs'] = block['jitter'] * 1000 / CLOCK_RATE
+				if block['lsr']:
+					# RTT = arrival - LSR - DLSR, all in 1/65536 s
+					arrival = RtcpPacket.ntpMiddle(*RtcpPacket.ntpTime())
+					rtt = (arrival - block['lsr'] - block['dlsr']) & 0xFFFFFFFF
+					if rtt < 0x80000000:
+						self.rtcpStats['rttMs'] = rtt * 1000 / 65536
+
+	def retransmit(self, seqnums):
+		"""Resend the NACKed packets that can still reach the client before their frame is played."""
+		if not self.history:
+			return
+		rtt = self.rtcpStats['rttMs']
+		packets = self.history.lookup(seqnums, rtt / 2000 if rtt else 0.0)
+		for packet in packets:
+			try:
+				self.sendPacket(packet)
+			except OSError:
+				# A full socket buffer; the client asks again if there is still time
+				break
+		serverStats.incr('retransmits', len(packets))
+
+	def sessionStats(self):
+		"""Return the QoS statistics of this session."""
+		videoStream = self.clientInfo.get('videoStream')
+		stats = {
+			'filename': videoStream.filename if videoStream else self.filename,
+			'state': self.state,
+			'rendition': self.rateController.level,
+			'framesSent': self.frameCnt,
+			'packetsSent': self.packetsSent,
+			'octetsSent': self.octetsSent,
+		}
+		if self.history:
+			stats.update(self.history.stats())
+		if self.interleaved:
+			stats['tcpFramesDropped'] = self.tcpFramesDropped
+		if self.fec:
+			stats['fecGroup'] = self.fec.group
+			stats['fecPacketsSent'] = self.fecPacketsSent
+			stats.update(self.fecStats)
+		stats.update(self.rtcpStats)
+		stats.update(self.pacer.stats())
+		return stats
 		
 	def replyRtsp(self, code, seq):
 		"""Send RTSP reply to the client."""
 		if code == self.OK_200:
-			# reply = 'RTSP/1.0 200 OK\nCSeq: ' + seq + '\nSession: ' + str(self.clientInfo['session'])
-			reply = "RTSP/1.0 200 OK\nCSeq: {}".format(seq)
+			headers = [('CSeq', seq)]
+			body = b''
 			
-			if self.requestType == self.SETUP:
-				frameCnt = self.serverInfo[self.filename]
-				session = "\nSession: {}".format(self.clientInfo['session'])
-				meta = "\nFrames: {}\nFps: {}".format(frameCnt, self.fps)
-				reply = reply + session + meta
+			if self.requestType == self.SETUP or self.requestType == self.SWITCH:
+				headers += self.streamHeaders()
 			
 			elif self.requestType == self.DESCRIBE:
-				session = "\nSession: {}".format(self.clientInfo['session'])
-				body = "\nv={}\nm=video {} RTP/AVP {}\na=control:streamid={}\na=mimetype:string;\"video/MJPEG\""\
+				body = "v={}\r\nm=video {} RTP/AVP {}\r\na=control:streamid={}\r\na=mimetype:string;\"video/MJPEG\"\r\n"\
 					.format(0, self.clientInfo['rtspPort'], 26, self.clientInfo['session'])
-				content = "\n\nContent-Base: {}\nContent-Type: {}\nContent-Length: {}"\
-					.format(self.filename, "application/sdp", len(body))
-				reply = reply + session + body + content
+				headers += [('Session', self.clientInfo['session']), ('Content-Base', self.filename),
+					('Content-Type', "application/sdp")]
+			
+			elif self.requestType == self.GET_STATS:
+				body = serverStats.format()
+				headers.append(('Content-Type', "text/plain; version=0.0.4"))
 			
 			elif self.requestType == self.GET_LIST:
-				lst = ""
-				for vid in self.serverInfo:
-					lst = lst + '\n' + vid
-				reply = reply + lst
+				# One title per line with its frames, fps and duration, cached by the catalog
+				total, body = self.listing
+				headers += [('Total', total), ('Content-Type', "text/tab-separated-values")]
 
-			else:
-				session = "\nSession: {}".format(self.clientInfo['session'])
-				reply = reply + session
+			# A keepalive or TEARDOWN before any SETUP has no session to name
+			elif 'session' in self.clientInfo:
+				headers.append(('Session', self.clientInfo['session']))
 			
-			connSocket = self.clientInfo['rtspSocket'][0]
-			connSocket.send(reply.encode())
+			self.sendRtspReply(formatMessage("RTSP/1.0 200 OK", headers, body))
 
 		# Error messages
-		elif code == self.FILE_NOT_FOUND_404:
-			print("404 NOT FOUND")
-		elif code == self.CON_ERR_500:
-			print("500 CONNECTION ERROR")
+		else:
+			logger.warning(self.ERRORS[code])
+			self.sendRtspReply(formatMessage("RTSP/1.0 " + self.ERRORS[code], [('CSeq', seq)]))
+
+	def streamHeaders(self):
+		"""Headers of the SETUP and SWITCH replies: the session and what the client is about to receive."""
+		frameCnt = self.clientInfo['videoStream'].frameCnt
+		headers = [('Session', self.sessionHeader()), ('Frames', frameCnt), ('Fps', self.fps)]
+		if self.interleaved:
+			headers.append(('Transport', 'RTP/AVP/TCP;interleaved={}-{}'.format(*self.interleaved)))
+		if self.fec:
+			headers.append(('FEC', 'pt={};group={}'.format(FEC_PAYLOAD_TYPE, self.fec.group)))
+		return headers
+
+	def sessionHeader(self):
+		"""The Session header of the SETUP and SWITCH replies, with the timeout the client has to keep alive within."""
+		if sessionManager.timeout:
+			return '{};timeout={}'.format(self.clientInfo['session'], int(sessionManager.timeout))
+		return self.clientInfo['session']
+
+	def sendRtspReply(self, reply):
+		"""Write an encoded RTSP reply to the client."""
+		# Once RTP is interleaved, replies queue behind the frame being written
+		if self.tcpQueue:
+			self.tcpQueue.writeAll(reply)
+			return
+		connSocket = self.clientInfo['rtspSocket'][0]
+		connSocket.sendall(reply)
 	
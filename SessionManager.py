@@ -0,0 +1,151 @@
+import glob, threading, time, logging
+
+from ReaderPool import readerPool
+
+logger = logging.getLogger(__name__)
+
+# Seconds without an RTSP request or an RTCP report before a session is torn down; 0 never expires
+SESSION_TIMEOUT = 60
+# Sessions allowed at once in this process; 0 means no limit
+MAX_SESSIONS = 0
+# ffmpeg decoders in use allowed at once; 0 means as many as the reader pool opens
+MAX_DECODERS = 0
+
+class SessionManager:
+	"""Every RTSP connection of the process, from accept until its resources are released.
+
+	Workers register when their connection starts and unregister once they
+	have torn everything down. Any request or RTCP report from the client
+	keeps its connection alive; one silent for longer than the timeout is
+	expired, which closes its connection and so runs the same teardown as a
+	client that hangs up. New sessions are admitted only while the session
+	and decoder limits leave room for them; an admitted session holds its
+	slot from SETUP until TEARDOWN, whether or not it has opened a decoder yet.
+	"""
+
+	def __init__(self, timeout=SESSION_TIMEOUT, maxSessions=MAX_SESSIONS, maxDecoders=MAX_DECODERS):
+		self.timeout = timeout
+		self.maxSessions = maxSessions
+		self.maxDecoders = maxDecoders
+		self.lock = threading.Lock()
+		# worker -> monotonic time of its last sign of life
+		self.workers = {}
+		# worker -> whether its session needs a decoder, from SETUP until TEARDOWN
+		self.admitted = {}
+		self.reaper = None
+
+	def configure(self, timeout, maxSessions, maxDecoders):
+		self.timeout = timeout
+		self.maxSessions = maxSessions
+		self.maxDecoders = maxDecoders or readerPool.maxReaders
+		# Admitted sessions should not have to queue for a reader slot
+		readerPool.maxReaders = max(readerPool.maxReaders, self.maxDecoders)
+
+	def register(self, worker):
+		with self.lock:
+			self.workers[worker] = time.monotonic()
+			if self.reaper is None:
+				self.reaper = threading.Thread(target=self.reap, daemon=True)
+				self.reaper.start()
+
+	def unregister(self, worker):
+		with self.lock:
+			self.workers.pop(worker, None)
+			self.admitted.pop(worker, None)
+
+	def touch(self, worker):
+		"""Note a sign of life from the client of `worker`."""
+		with self.lock:
+			if worker in self.workers:
+				self.workers[worker] = time.monotonic()
+
+	def admit(self, worker, videoStream):
+		"""Reserve a slot for the new session of `worker` playing `videoStream`.
+
+		Return None once it is reserved, else the exhausted resource: 'sessions' or 'decoders'.
+		"""
+		# Titles with a frame store are served without a decoder
+		decoder = not videoStream.store
+		with self.lock:
+			if self.maxSessions and len(self.admitted) >= self.maxSessions:
+				return 'sessions'
+			if self.maxDecoders and decoder and sum(self.admitted.values()) >= self.maxDecoders:
+				return 'decoders'
+			self.admitted[worker] = decoder
+			return None
+
+	def retitle(self, worker, videoStream):
+		"""A SWITCH keeps the session's slot; it holds a decoder only if the new title needs one.
+
+		Return False, leaving the slot as it was, if the new title needs a decoder and none is left.
+		"""
+		decoder = not videoStream.store
+		with self.lock:
+			if worker not in self.admitted:
+				return True
+			if self.maxDecoders and decoder and not self.admitted[worker] and sum(self.admitted.values()) >= self.maxDecoders:
+				return False
+			self.admitted[worker] = decoder
+			return True
+
+	def release(self, worker):
+		"""Give back the slot of a session that ended."""
+		with self.lock:
+			self.admitted.pop(worker, None)
+
+	def sessions(self):
+		with self.lock:
+			return len(self.admitted)
+
+	def decodersBusy(self):
+		"""Admitted sessions of titles without a frame store, each of which decodes as soon as it plays."""
+		with self.lock:
+			return sum(self.admitted.values())
+
+	def reap(self):
+		while True:
+			time.sleep(min(max(self.timeout / 4, 0.5), 5.0) if self.timeout else 5.0)
+			if not self.timeout:
+				continue
+			now = time.monotonic()
+			with self.lock:
+				expired = [worker for worker, last in self.workers.items() if now - last > self.timeout]
+				# Expire each one once; it unregisters itself when its teardown is done
+				for worker in expired:
+					del self.workers[worker]
+			for worker in expired:
+				logger.info("session %s: no sign of life for %.0f s, closing it", worker.clientInfo.get('session'), self.timeout)
+				worker.expire()
+
+	def stats(self):
+		"""Return live counts of connections, sessions, threads and ffmpeg processes."""
+		with self.lock:
+			connections = len(self.workers)
+		return {
+			'connections': connections,
+			'sessions': self.sessions(),
+			'threads': threading.active_count(),
+			'decodersBusy': self.decodersBusy(),
+			'ffmpegProcesses': ffmpegProcesses(),
+		}
+
+def ffmpegProcesses():
+	"""Count the ffmpeg child processes of this process, whichever thread started them."""
+	count = 0
+	for path in glob.glob('/proc/self/task/*/children'):
+		try:
+			with open(path) as f:
+				children = f.read().split()
+		except OSError:
+			continue
+		for pid in children:
+			try:
+				with open('/proc/{}/comm'.format(pid)) as f:
+					if f.read().startswith('ffmpeg'):
+						count += 1
+			except OSError:
+				pass
+	return count
+
+# Connections of the current process
+sessionManager = SessionManager()
@@ -1,15 +1,68 @@
-import io
+import io, os, bisect, threading, time
+from concurrent.futures import ThreadPoolExecutor
 import imageio
+from PIL import Image
+
+from FrameStore import FrameStore
+from FrameCache import frameCache
+from ServerStats import stageTimings
+from ReaderPool import readerPool, OPEN_TIMEOUT
+
+# Seconds of frames a playing stream keeps encoded ahead of its playhead
+PREFETCH_SECONDS = 3
+# Threads encoding ahead for every stream of the process
+PREFETCH_WORKERS = 4
+# Frames a stream encodes per turn on those threads before letting the other streams have theirs
+PREFETCH_BATCH = 5
+# Seconds a stream waits before prefetching again after finding every reader slot taken
+PREFETCH_BACKOFF = 0.2
+
+# Frames at the head of a title encoded ahead of time, so SETUP and SWITCH start from the cache
+HEAD_FRAMES = 12
+# Titles of one listing whose heads get primed, at most
+MAX_PRIMED_TITLES = 16
+
+# Rendition ladder as (JPEG quality, scale); level 0 is the source encoding as is
+RENDITIONS = ((None, 1.0), (60, 1.0), (45, 0.75), (35, 0.5), (25, 0.5))
 
 class VideoStream:
-	def __init__(self, filename):
+	def __init__(self, filename, meta=None):
 		self.filename = filename
-		try:
-			self.reader = imageio.get_reader(filename, 'ffmpeg')
-		except:
-			raise IOError
 		self.frameCnt = 0
 		self.frameNum = 0
+		self.readerPos = 0
+		self.fps = 25
+		self.keyframes = None
+		if meta:
+			self.frameCnt = meta['frames']
+			self.fps = meta['fps']
+			self.keyframes = meta.get('keyframes')
+		self.lock = threading.RLock()
+		self.seekGen = 0
+		self.level = 0
+		self.closed = False
+		# The reader is taken from the pool or opened on the first frame missing from the cache
+		self.reader = None
+		# Background encoding ahead of the frame being sent, in turns on the shared prefetch threads
+		self.playhead = -1
+		self.prefetchLock = threading.Lock()
+		self.prefetchOn = False
+		# Whether a turn of this stream is queued or running
+		self.prefetching = False
+		self.prefetchGen = None
+		self.prefetchLevel = 0
+		self.filled = -1
+		# Last frame the prefetching failed to encode, so the send loop skips it instead of waiting
+		self.failedFrame = -1
+		# Monotonic time before which prefetching does not try again for a reader slot
+		self.prefetchRetry = 0
+		# Serve pre-encoded frames straight from the ingested store when there is one
+		self.store = FrameStore.open(filename)
+		if self.store:
+			self.frameCnt = self.store.frameCnt
+			return
+		if not os.path.isfile(filename):
+			raise IOError
 	
 	def countFrame(self):
 		reader = imageio.get_reader(self.filename, 'ffmpeg')
@@ -26,29 +79,265 @@ class VideoStream:
 		
 	def nextFrame(self):
 		"""Get next frame."""
-		try:
-			buffer = io.BytesIO()
-			data = self.reader.get_next_data()
-			imageio.imwrite(buffer, data, format='JPEG')
-			self.frameNum += 1
-			return buffer.getvalue()
-		except:
-			return bytes(0)
+		return self.getFrame(self.frameNum)
 	
 	def getFrame(self, index):
-		try:
-			buffer = io.BytesIO()
-			data = self.reader.get_data(index)
-			imageio.imwrite(buffer, data, format='JPEG')
-			self.frameNum = index
-			return buffer.getvalue()
-		except:
+		"""Get frame `index` as JPEG data in the current rendition and move the stream position after it."""
+		if self.store:
+			if not 0 <= index < self.frameCnt:
+				return bytes(0)
+			data = self.store.frame(index)
+		else:
+			if index != self.frameNum:
+				# A seek: prefetching starts over after the new position
+				self.seek()
+			self.playhead = index
+			self.wakePrefetch()
+			# Sessions watching the same title share one encode per frame
+			data = frameCache.get((self.filename, index), lambda: self.encodeFrame(index))
+			if not data and index < self.frameCnt:
+				# A frame that cannot be decoded is skipped rather than ending the title
+				self.frameNum = index + 1
+		if data and self.level:
+			level = self.level
+			source = data
+			data = frameCache.get((self.filename, index, level), lambda: transcode(source, *RENDITIONS[level])) or source
+		if data:
+			self.frameNum = index + 1
+		return data
+
+	def peekFrame(self, index):
+		"""Like getFrame, but never encode: return None if frame `index` is not in the cache yet.
+
+		The prefetch thread is pointed at the missing frame, so it is there
+		when the caller asks again a little later.
+		"""
+		if self.store:
+			return self.getFrame(index)
+		if self.frameCnt and not 0 <= index < self.frameCnt:
 			return bytes(0)
+		# Restart prefetching unless it is already on its way to this frame
+		if not self.playhead < index <= self.playhead + PREFETCH_SECONDS * self.fps:
+			self.seek()
+		if index == self.failedFrame:
+			# Past the end of a title of unknown length, or a frame that cannot be decoded and is skipped
+			if not self.frameCnt:
+				return bytes(0)
+			self.playhead = index
+			self.frameNum = index + 1
+			return self.peekFrame(index + 1)
+		data = frameCache.peek((self.filename, index))
+		if data and self.level:
+			# The source goes out until prefetching catches up with a new rendition
+			data = frameCache.peek((self.filename, index, self.level)) or data
+		if data is None:
+			self.playhead = index - 1
+			self.startPrefetch()
+			return None
+		self.playhead = index
+		self.wakePrefetch()
+		self.frameNum = index + 1
+		return data
+
+	def seek(self):
+		"""The playhead jumped: prefetching starts over from it, and a frame that failed before is tried again."""
+		self.seekGen += 1
+		self.failedFrame = -1
+	
+	def encodeFrame(self, index, timeout=OPEN_TIMEOUT):
+		"""Decode frame `index` with this stream's reader and encode it to JPEG.
+
+		Return None if no reader slot frees up within `timeout` seconds, and
+		empty data if the frame cannot be decoded.
+		"""
+		with self.lock:
+			# A closed stream has handed its reader back
+			if self.closed:
+				return bytes(0)
+			try:
+				start = time.perf_counter()
+				image = self.decodeFrame(index, timeout)
+				if image is None:
+					return None
+				decoded = time.perf_counter()
+				buffer = io.BytesIO()
+				imageio.imwrite(buffer, image, format='JPEG')
+				stageTimings.record('decode', decoded - start)
+				stageTimings.record('encode', time.perf_counter() - decoded)
+				return buffer.getvalue()
+			except:
+				return bytes(0)
+
+	def decodeFrame(self, index, timeout):
+		"""Decode frame `index`, restarting the reader at the nearest preceding keyframe when that is cheaper.
+
+		Return None if a reader is needed and no slot frees up within `timeout` seconds.
+		"""
+		if self.reader is None:
+			self.reader, self.readerPos = readerPool.acquire(self.filename, index)
+			if self.reader is None:
+				self.reader = readerPool.open(self.filename, timeout=timeout)
+				if self.reader is None:
+					return None
+		if self.keyframes is None:
+			data = self.reader.get_next_data() if index == self.readerPos else self.reader.get_data(index)
+			self.readerPos = index + 1
+			return data
+
+		keyframe = self.keyframes[max(bisect.bisect_right(self.keyframes, index) - 1, 0)]
+		if index < self.readerPos or keyframe > self.readerPos:
+			if not self.seekReader(keyframe, timeout):
+				return None
+		while self.readerPos < index:
+			self.reader.get_next_data()
+			self.readerPos += 1
+		data = self.reader.get_next_data()
+		self.readerPos += 1
+		return data
+
+	def seekReader(self, keyframe, timeout):
+		"""Switch to a reader whose next frame is `keyframe`; the current one goes back to the pool.
+
+		Return False if no reader slot frees up within `timeout` seconds.
+		"""
+		readerPool.release(self.filename, self.reader, self.readerPos)
+		self.reader = None
+		self.reader = readerPool.open(self.filename, keyframe, self.fps, timeout)
+		self.readerPos = keyframe
+		return self.reader is not None
+
+	def startPrefetch(self):
+		"""Keep PREFETCH_SECONDS of frames after the playhead, in the current rendition, in the shared cache."""
+		if not self.store:
+			self.prefetchOn = True
+			self.wakePrefetch()
+
+	def wakePrefetch(self):
+		"""Queue a turn on the prefetch threads if there are frames to encode and no turn is queued already."""
+		with self.prefetchLock:
+			if not self.prefetchOn or self.prefetching or self.closed or not self.prefetchRange():
+				return
+			# Every reader slot was taken a moment ago; the next frame sent tries again
+			if time.monotonic() < self.prefetchRetry:
+				return
+			self.prefetching = True
+		try:
+			prefetcher.submit(self.prefetchFrames)
+		except RuntimeError:
+			# The interpreter is shutting down
+			self.prefetching = False
+
+	def prefetchRange(self):
+		"""Return the frames still to encode ahead of the playhead, starting over after a seek or a rendition change."""
+		if self.prefetchGen != self.seekGen or self.prefetchLevel != self.level:
+			self.prefetchGen = self.seekGen
+			self.prefetchLevel = self.level
+			self.filled = -1
+		start = max(self.playhead + 1, self.filled + 1)
+		end = self.playhead + 1 + int(PREFETCH_SECONDS * self.fps)
+		if self.frameCnt:
+			end = min(end, self.frameCnt)
+		# A frame that failed is not tried again until the playhead has skipped it
+		if start == self.failedFrame:
+			return range(0)
+		return range(start, end)
+
+	def prefetchFrames(self):
+		"""One turn: encode up to PREFETCH_BATCH frames, then queue the next turn behind the other streams'."""
+		try:
+			frames = self.prefetchRange()[:PREFETCH_BATCH]
+			gen = self.prefetchGen
+			level = self.prefetchLevel
+			for index in frames:
+				# Start over as soon as the viewer seeks elsewhere, stop when the stream is closed
+				if gen != self.seekGen or self.closed:
+					break
+				# Never wait for a reader slot here: that would hold a prefetch thread every stream shares
+				data = frameCache.get((self.filename, index), lambda: self.encodeFrame(index, 0))
+				if data is None:
+					self.prefetchRetry = time.monotonic() + PREFETCH_BACKOFF
+					break
+				if not data:
+					self.failedFrame = index
+					break
+				if level:
+					frameCache.get((self.filename, index, level), lambda: transcode(data, *RENDITIONS[level]))
+				self.filled = index
+		finally:
+			with self.prefetchLock:
+				self.prefetching = False
+			self.wakePrefetch()
 		
 	def frameNbr(self):
 		"""Get frame number."""
 		return self.frameNum
 
+	def close(self):
+		"""Release the decoder or the store mapping."""
+		self.seekGen += 1
+		self.closed = True
+		if self.store:
+			self.store.close()
+		else:
+			with self.lock:
+				if self.reader:
+					readerPool.release(self.filename, self.reader, self.readerPos)
+					self.reader = None
+
+prefetcher = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+primer = ThreadPoolExecutor(max_workers=2)
+# Titles whose head is queued or being encoded
+primingTitles = set()
+primingLock = threading.Lock()
+
+def primeTitles(names, catalog):
+	"""Encode the heads of titles a client may switch to next into the shared cache, in the background.
+
+	A title is primed again once its head has been evicted from the cache.
+	"""
+	for name in names[:MAX_PRIMED_TITLES]:
+		if frameCache.peek((name, 0)) is not None:
+			continue
+		with primingLock:
+			if name in primingTitles:
+				continue
+			primingTitles.add(name)
+		primer.submit(primeHead, name, catalog.get(name))
+
+def primeHead(filename, meta):
+	"""Encode the first HEAD_FRAMES frames of a title; its reader stays warm in the pool right after them."""
+	videoStream = None
+	try:
+		videoStream = VideoStream(filename, meta)
+		if not videoStream.store:
+			# Priming is best effort: it gives up rather than wait for a reader slot sessions need
+			for index in range(HEAD_FRAMES):
+				if not frameCache.get((filename, index), lambda: videoStream.encodeFrame(index, 0)):
+					break
+	except IOError:
+		pass
+	finally:
+		if videoStream:
+			videoStream.close()
+		with primingLock:
+			primingTitles.discard(filename)
+
+
+def transcode(data, quality, scale):
+	"""Re-encode a JPEG frame at a lower quality and resolution."""
+	try:
+		start = time.perf_counter()
+		image = Image.open(io.BytesIO(data))
+		if scale != 1.0:
+			size = (max(int(image.size[0] * scale), 8), max(int(image.size[1] * scale), 8))
+			image = image.resize(size, Image.BILINEAR)
+		buffer = io.BytesIO()
+		image.save(buffer, format='JPEG', quality=quality)
+		stageTimings.record('transcode', time.perf_counter() - start)
+		return buffer.getvalue()
+	except Exception:
+		return bytes(0)
+
 
 # class VideoStream:
 # 	def __init__(self, filename):